@@ -0,0 +1,90 @@
+import os
+import threading
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import database
+
+# How often (seconds) the directory is re-read from the users table, as a backstop to the 'admins' invalidations
+ADMIN_DIRECTORY_REFRESH_INTERVAL = int(os.getenv("ADMIN_DIRECTORY_REFRESH_INTERVAL", 300))
+# Account shown to customers when the delivering admin has none on file
+ACC_DEFAULT = os.getenv("ACC_DEFAULT", "1000397137833")
+
+
+@dataclass(slots=True)
+class Admin:
+    user_id: int
+    username: Optional[str] = None
+    # Name given at registration (users.name)
+    name: Optional[str] = None
+    payout_account: Optional[str] = None
+    # Telegram display name, learned from chat member updates and the admin's own clicks
+    full_name: Optional[str] = None
+
+
+class AdminDirectory:
+    """Deliverers and their display names and payout accounts, kept in memory.
+
+    Loaded from the users table (is_deliverer rows and rows with a payout account) at startup,
+    on 'admins' invalidations and every ADMIN_DIRECTORY_REFRESH_INTERVAL. Telegram names come
+    from chat member updates in the admin group, so showing who took an order needs no
+    get_chat_member round trip.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._admins = {}
+        # user_id -> (full_name, username) from Telegram; survives reloads of the database rows
+        self._seen = {}
+
+    def load(self, rows):
+        """Replaces the directory with [(user_id, username, name, payout_account)] rows."""
+        admins = {}
+        for user_id, username, name, payout_account in rows:
+            full_name, seen_username = self._seen.get(user_id, (None, None))
+            admins[user_id] = Admin(user_id, seen_username or username, name, payout_account, full_name)
+        with self._lock:
+            self._admins = admins
+
+    def reload(self):
+        self.load(database.get_admin_directory())
+        return len(self._admins)
+
+    def invalidate_users(self, keys):
+        """'user' invalidation listener: re-reads the directory only if one of the changed users is in it."""
+        if any(int(key) in self._admins for key in keys):
+            self.reload()
+
+    def note(self, user):
+        """Records the Telegram name of a user seen in the admin group (chat member update or callback)."""
+        if user is None:
+            return
+        with self._lock:
+            self._seen[user.id] = (user.full_name, user.username)
+            admin = self._admins.get(user.id)
+            if admin is not None:
+                self._admins[user.id] = replace(admin, full_name=user.full_name, username=user.username or admin.username)
+
+    def get(self, user_id):
+        return self._admins.get(user_id)
+
+    def name(self, user_id, default=None):
+        """Best display name for an admin: Telegram name, then registered name, then @username."""
+        admin = self._admins.get(user_id)
+        if admin is not None:
+            if admin.full_name or admin.name:
+                return admin.full_name or admin.name
+            if admin.username:
+                return f"@{admin.username}"
+        full_name, _ = self._seen.get(user_id, (None, None))
+        return full_name or default
+
+    def payout_account(self, user_id):
+        admin = self._admins.get(user_id)
+        return admin.payout_account if admin and admin.payout_account else ACC_DEFAULT
+
+    def __len__(self):
+        return len(self._admins)
+
+
+admin_directory = AdminDirectory()
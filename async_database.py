@@ -0,0 +1,66 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import metrics
+
+# Helpers that hand out raw connections make no sense across a thread hop
+_NOT_EXPORTED = {'db_connection', 'get_db_connection', 'get_suspicious_connection', 'execute_query', 'execute_many', 'sqlite_connect', 'close_pool'}
+
+
+def _timed(func, args, kwargs):
+    # Measured on the worker thread, so executor queueing is not counted as query time
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.db_seconds.observe(time.perf_counter() - start, getattr(func, '__name__', 'call'))
+
+
+class AsyncDatabase:
+    """Awaitable mirror of database.py, e.g. ``await db.get_user(uid)``.
+
+    Every call runs the matching synchronous helper on a dedicated executor, so a
+    slow query only occupies a worker thread and never the bot's event loop.
+    PostgreSQL gets one worker per pooled connection; SQLite gets a single
+    dedicated thread because it serializes writers anyway.
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = database.DB_POOL_MAX if database.DATABASE_URL else 1
+        self.max_workers = max_workers
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='db')
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """Runs any blocking callable on the database executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), _timed, func, args, kwargs)
+
+    def __getattr__(self, name):
+        func = getattr(database, name, None)
+        if name.startswith('_') or name in _NOT_EXPORTED or not callable(func) or isinstance(func, type):
+            raise AttributeError(f"database has no async helper '{name}'")
+
+        async def call(*args, **kwargs):
+            return await self.run(func, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = func.__doc__
+        # Cache so later lookups skip __getattr__
+        setattr(self, name, call)
+        return call
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+db = AsyncDatabase()
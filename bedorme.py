@@ -2,35 +2,41 @@
 # --- Admin Seen User Callback ---
 
 import time
-import math
 import asyncio
-from keep_alive import keep_alive, start_pinger
+from keep_alive import keep_alive, start_pinger, start_server
 from locations import RESTAURANTS, BLOCKS, ALLOWED_RADIUS
-from menus import MENUS, CONTRACT_MENUS
-from database import (
-    init_db, add_user, create_order, get_user, update_order_location,
-    get_user_active_orders, set_user_language, get_user_language, get_order,
-    mark_order_complete, save_rating, is_contract_user, get_contract_details,
-    update_contract_payment, log_suspicious_access
-)
+from dispatch import rank, deliverer_positions, format_suggestions, DISPATCH_AUTO_OFFER
+from geo import haversine, nearest_block, deliveries_within, active_deliveries, load_active_deliveries, rebuild_places
+from menus import MENUS
+from catalog import catalog, MENU_REFRESH_INTERVAL
+from admins import admin_directory, ADMIN_DIRECTORY_REFRESH_INTERVAL
+from invalidation import listener as invalidation_listener
+import database
+import metrics
+from database import init_db, user_cache, is_banned, update_order_location, LOCATION_FLUSH_INTERVAL
+from async_database import db
+from persistence import DatabasePersistence
+from ephemeral import EphemeralStore, EPHEMERAL_SWEEP_INTERVAL
+from workflow import workflow
+from outbox import outbox, PRIORITY_PAYMENT, PRIORITY_TRACKING
+from update_processor import UserOrderedUpdateProcessor
+from callbacks import CallbackRouter, pack
 from translations import get_text
 from telegram.ext import (
     Application, CommandHandler, ContextTypes, ConversationHandler,
-    MessageHandler, filters, CallbackQueryHandler, PicklePersistence, TypeHandler,
-    ApplicationHandlerStop
+    MessageHandler, filters, CallbackQueryHandler, TypeHandler,
+    ChatMemberHandler, ApplicationHandlerStop
 )
 from telegram import (
     Update, ReplyKeyboardMarkup, ReplyKeyboardRemove,
     InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
 )
-from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 import string
 import re
 import random
 import os
 import logging
-import sqlite3
 import threading
 from creator_bot import create_creator_app
 
@@ -40,16 +46,32 @@ load_dotenv()
 # TOKEN (now loaded from .env)
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+# How often to check whether another process changed the banned set
+BAN_REFRESH_INTERVAL = int(os.getenv("BAN_REFRESH_INTERVAL", 30))
+# Orders listed one by one in the restart message
+RECOVERY_LIST_MAX = 20
+# Seconds between the completion receipt and the rating prompt, and between a rating and the thank-you prompt
+COMPLETION_RATING_DELAY = float(os.getenv("COMPLETION_RATING_DELAY", 5))
+RATING_PROMPT_DELAY = float(os.getenv("RATING_PROMPT_DELAY", 3))
+# Completion send sequences in flight at once, across all orders
+COMPLETION_CONCURRENCY = int(os.getenv("COMPLETION_CONCURRENCY", 4))
+_completion_slots = asyncio.Semaphore(COMPLETION_CONCURRENCY)
+# Telegram leaves chat_member updates out unless asked; the admin directory needs them
+ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+# Webhook mode: serve /metrics and /debug/state on this port (PORT is taken by the webhook)
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
 async def check_banned(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
         return
     
-    db_user = get_user(user.id)
-    if db_user and len(db_user) > 12 and db_user[12]: # Index 12 is is_banned
+    # Runs on every update: an in-memory set lookup, no database access for normal users
+    if is_banned(user.id):
         # Log to suspicious DB
-        phone = db_user[6] if len(db_user) > 6 else "N/A"
-        log_suspicious_access(user.id, user.username, user.full_name, phone, "Banned user tried to access bot")
+        db_user = await db.get_user(user.id)
+        phone = db_user.phone if db_user else "N/A"
+        await db.log_suspicious_access(user.id, user.username, user.full_name, phone, "Banned user tried to access bot")
         
         await update.effective_chat.send_message(
             "🚫 **ACCESS DENIED**\n\nYour account is restricted. Contact support if this is an error.",
@@ -57,63 +79,43 @@ async def check_banned(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         raise ApplicationHandlerStop
 
-async def admin_seen_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_seen_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, user_id):
     """Callback when admin confirms they have seen the user (within 50m)."""
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
         await query.answer("Unauthorized action.", show_alert=True)
         return
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 5:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    order_id = int(parts[3])
-    user_id = int(parts[4])
-
-    # Determine account number based on admin username
-    admin_username = query.from_user.username
-    
-    # Default account variables loaded from ENV
-    acc_default = os.getenv("ACC_DEFAULT", "1000397137833")
-    acc_h_kara = os.getenv("ACC_H_KARASEFERIAN", "1000688588972")
-    acc_kal = os.getenv("ACC_KALNLISA", "1000466307371")
-    
-    account_number = acc_default
-
-    if admin_username:
-        # Standardize check (case-insensitive, strip @)
-        clean_username = admin_username.lstrip('@').lower()
 
-        if clean_username == "h_karaseferian":
-            account_number = acc_h_kara
-        elif clean_username == "kalnlisa":
-            account_number = acc_kal
-        elif clean_username in ["callowned", "allowned"]:
-            account_number = acc_default
+    # The customer pays into the account of the admin who met them (ACC_DEFAULT if they have none on file)
+    account_number = admin_directory.payout_account(query.from_user.id)
 
     # Fetch order to show price
     is_contract = False
     try:
         # Already imported at top, usage is correct
-        p_order = get_order(order_id)
-        # Price is typically float or int, at index 5
-        price_val = p_order[5] if p_order else "???"
-        if p_order and len(p_order) > 7 and p_order[7] == 'contract':
+        p_order = await db.get_order(order_id)
+        price_val = p_order.total_price if p_order else "???"
+        if p_order and p_order.order_type == 'contract':
             is_contract = True
     except Exception:
         price_val = "???"
 
+    await db.transition_order(order_id, 'arrived')
+
     if is_contract:
         try:
             # Get deliverer location for the log
-            loc = context.bot_data.get(f'latest_location_{query.from_user.id}', {})
-            mark_order_complete(order_id, lat=loc.get('lat'), lon=loc.get('lon'))
+            loc = EphemeralStore(context.bot_data).get('latest_location', query.from_user.id, {})
+            await db.mark_order_complete(order_id, lat=loc.get('lat'), lon=loc.get('lon'))
+            EphemeralStore(context.bot_data).evict_order(order_id)
             
-            await context.bot.send_message(
+            outbox.post(
+                'send_message',
                 chat_id=user_id,
                 text="🎖️ **Contract Order Confirmed**\n\nThe deliverer has seen you. Since this is a contract order, your balance was automatically adjusted. No payment proof is needed. Enjoy your meal!",
-                parse_mode='Markdown'
+                parse_mode='Markdown',
+                priority=PRIORITY_PAYMENT
             )
             await query.edit_message_text("Confirmed: Seen receiver. (Contract Order - Completed ✅)")
             return
@@ -121,18 +123,17 @@ async def admin_seen_user_callback(update: Update, context: ContextTypes.DEFAULT
             logger.warning(f"Failed to send contract confirmation to user {user_id}: {e}")
 
     # Notify user to start payment process and upload proof
-    lang = get_user_language(user_id) or 'en'
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=get_text('pay_instruct', lang).format(order_id=order_id, account=account_number, price=price_val),
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        logger.warning(f"Failed to send payment instruct to user {user_id}: {e}")
+    lang = await db.get_user_language(user_id) or 'en'
+    outbox.post(
+        'send_message',
+        chat_id=user_id,
+        text=get_text('pay_instruct', lang).format(order_id=order_id, account=account_number, price=price_val),
+        parse_mode='Markdown',
+        priority=PRIORITY_PAYMENT
+    )
 
     # Set state for this user to expect payment proof
-    context.bot_data[f'waiting_payment_proof_{user_id}'] = order_id
+    await workflow.put('waiting_payment_proof', user_id, order_id)
 
     try:
         await query.edit_message_text("Confirmed: You have seen the receiver. User has been notified to upload payment proof.")
@@ -145,7 +146,7 @@ async def handle_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYP
     if not update.effective_user:
         return
     user_id = update.effective_user.id
-    order_id = context.bot_data.get(f'waiting_payment_proof_{user_id}')
+    order_id = await workflow.get('waiting_payment_proof', user_id)
 
     if not order_id:
         # Not waiting for proof from this user
@@ -155,58 +156,55 @@ async def handle_payment_proof(update: Update, context: ContextTypes.DEFAULT_TYP
     file_id = photo.file_id
 
     # Store user proof for later completion logging
-    context.bot_data[f'user_proof_{order_id}'] = file_id
+    EphemeralStore(context.bot_data).set('user_proof', order_id, file_id)
+    await db.transition_order(order_id, 'paid')
 
     # Forward proof to admin
-    await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"📸 Payment proof received from User {user_id} for Order #{order_id}:")
-    await context.bot.send_photo(chat_id=ADMIN_CHAT_ID, photo=file_id)
+    outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=f"📸 Payment proof received from User {user_id} for Order #{order_id}:", priority=PRIORITY_PAYMENT)
+    outbox.post('send_photo', chat_id=ADMIN_CHAT_ID, photo=file_id, priority=PRIORITY_PAYMENT)
 
     # Ask admin to verify and upload their own proof (receipt)
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Verify & Upload Receipt",
-                              callback_data=f"admin_req_receipt_{order_id}_{user_id}")],
+                              callback_data=pack('admin_req_receipt', order_id, user_id))],
         [InlineKeyboardButton("❌ Invalid Proof - Resend",
-                              callback_data=f"admin_reject_proof_{order_id}_{user_id}")]
+                              callback_data=pack('admin_reject_proof', order_id, user_id))]
     ])
-    await context.bot.send_message(
+    outbox.post(
+        'send_message',
         chat_id=ADMIN_CHAT_ID,
         text="Verify the payment. If received, click below to upload your confirmation receipt.",
-        reply_markup=kb
+        reply_markup=kb,
+        priority=PRIORITY_PAYMENT
     )
 
     # Clear user waiting state
-    del context.bot_data[f'waiting_payment_proof_{user_id}']
+    await workflow.pop('waiting_payment_proof', user_id)
     
-    from database import get_user_language
-    lang = get_user_language(user_id) or 'en'
+    lang = await db.get_user_language(user_id) or 'en'
     await update.message.reply_text(get_text('payment_proof_sent', lang))
 
 
-async def admin_reject_proof_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_reject_proof_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, user_id):
     """Admin clicked 'Invalid Proof - Resend'."""
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
         await query.answer("Unauthorized action.", show_alert=True)
         return
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 5:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    order_id = int(parts[3])
-    user_id = int(parts[4])
 
-    from database import get_user_language
-    lang = get_user_language(user_id) or 'en'
+    lang = await db.get_user_language(user_id) or 'en'
     
     # 1. Notify User
     try:
-        await context.bot.send_message(
+        outbox.post(
+            'send_message',
             chat_id=user_id,
-            text=get_text('payment_rejected', lang)
+            text=get_text('payment_rejected', lang),
+            priority=PRIORITY_PAYMENT
         )
         # Re-enable waiting state for this user
-        context.bot_data[f'waiting_payment_proof_{user_id}'] = order_id
+        await workflow.put('waiting_payment_proof', user_id, order_id)
     except Exception as e:
         logger.warning(f"Failed to notify user about rejection: {e}")
 
@@ -214,29 +212,25 @@ async def admin_reject_proof_callback(update: Update, context: ContextTypes.DEFA
     await query.edit_message_text(f"❌ Proof rejected by {query.from_user.first_name}. User has been asked to resend.")
 
 
-async def admin_req_receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_req_receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, user_id):
     """Admin clicked 'Verify & Upload Receipt'."""
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
         await query.answer("Unauthorized action.", show_alert=True)
         return
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 5:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    order_id = int(parts[3])
-    user_id = int(parts[4])
 
     # 1. Mark that verification is in progress
     await query.edit_message_text(f"Admin {query.from_user.first_name} is verifying payment.")
 
     # 2. Send a specific message for the admin to REPLY to.
     # This solves the Anonymous Admin issue AND the Concurrency issue.
-    await context.bot.send_message(
+    outbox.post(
+        'send_message',
         chat_id=ADMIN_CHAT_ID,
         text=f"🧾 **RECEIPT UPLOAD REQUEST**\n\nPlease **REPLY** to this message with the receipt photo for **Order #{order_id}**.\n(You MUST reply to this specific message so I know which order it is for!)",
-        parse_mode='Markdown'
+        parse_mode='Markdown',
+        priority=PRIORITY_PAYMENT
     )
 
 
@@ -268,60 +262,79 @@ async def handle_admin_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
     order_id = int(match.group(1))
 
     # Fetch order details from DB to get the user_id
-    # Already imported at top
-    order = get_order(order_id)
+    order = await db.get_order(order_id)
     if not order:
         return
 
-    user_id = order[1]  # customer_id is at index 1
+    user_id = order.customer_id
+    file_id = msg.photo[-1].file_id
 
-    photo = msg.photo[-1]
-    file_id = photo.file_id
-    
-    from database import get_user_language
-    lang = get_user_language(user_id) or 'en'
+    # Completing is the once-only step: a second reply to the same request finds the order already complete
+    ephemeral = EphemeralStore(context.bot_data)
+    loc = ephemeral.get('latest_location', msg.from_user.id, {})
+    if not await db.mark_order_complete(order_id, lat=loc.get('lat'), lon=loc.get('lon')):
+        await msg.reply_text(f"Order #{order_id} could not be completed (status: {order.status}); nothing was sent.")
+        return
 
-    # 1. Forward receipt to user
-    try:
-        await context.bot.send_message(chat_id=user_id, text=get_text('payment_verified', lang).format(order_id=order_id))
-        await context.bot.send_photo(chat_id=user_id, photo=file_id)
-    except Exception as e:
-        logger.warning(f"Failed to send receipt to user: {e}")
+    admin_name = "Unknown Admin"
+    if msg.from_user:
+        admin_name = f"{msg.from_user.first_name} {msg.from_user.last_name or ''}".strip()
 
-    # 2. Mark order complete
-    try:
-        # Already imported at top
-        # Get deliverer location from bot_data if available
-        loc = context.bot_data.get(f'latest_location_{msg.from_user.id}', {})
-        mark_order_complete(order_id, lat=loc.get('lat'), lon=loc.get('lon'))
+    # The admin gets their answer now; the customer and channel messages go out from the job queue
+    await msg.reply_text(
+        f"Receipt sent to user. Order #{order_id} marked as complete.\n\n"
+        "🛑 **ATTENTION ADMIN:** Please **STOP SHARING YOUR LIVE LOCATION** now if you are still sharing it."
+    )
+    context.job_queue.run_once(
+        completion_notify_job, 0, name=f"complete_{order_id}",
+        data={'order_id': order_id, 'user_id': user_id, 'receipt': file_id, 'admin_name': admin_name,
+              'user_proof': ephemeral.get('user_proof', order_id)})
 
-        # Retrieve User Proof
-        user_proof_id = context.bot_data.get(f'user_proof_{order_id}')
 
-        # Get Order Details
-        order = get_order(order_id)
-        user = get_user(user_id)
+async def _completion_steps(*sequences):
+    """Runs independent send sequences concurrently. Each is a list of (method, kwargs) outbox calls made in order.
 
+    All completions share COMPLETION_CONCURRENCY slots, so a burst of receipts cannot flood the outbox.
+    Returns one result per sequence: None, or the exception that stopped it.
+    """
+    async def run(sequence):
+        async with _completion_slots:
+            for method, kwargs in sequence:
+                await getattr(outbox, method)(priority=PRIORITY_PAYMENT, **kwargs)
+
+    results = await asyncio.gather(*(run(sequence) for sequence in sequences), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Completion step failed: {result}")
+    return results
+
+
+async def completion_notify_job(context: ContextTypes.DEFAULT_TYPE):
+    """First half of an order completion: receipt to the customer and the completed-orders channel posts."""
+    data = context.job.data
+    order_id, user_id = data['order_id'], data['user_id']
+    lang = await db.get_user_language(user_id) or 'en'
+
+    customer = [
+        ('send_message', dict(chat_id=user_id, text=get_text('payment_verified', lang).format(order_id=order_id))),
+        ('send_photo', dict(chat_id=user_id, photo=data['receipt'])),
+        ('send_message', dict(chat_id=user_id, text=get_text('stop_live_loc', lang), parse_mode='Markdown')),
+    ]
+
+    channel = []
+    try:
         from html import escape
+        order = await db.get_order(order_id)
+        user = await db.get_user(user_id)
         # Escape ALL fields to prevent HTML parse errors
-        user_name = escape(str(user[1])) if user[1] else "Unknown"
-        user_id_display = escape(str(user[2])) if user[2] else "Unknown"
-        user_phone = escape(str(user[5])) if user[5] else "Unknown"
-        user_block = escape(str(user[3])) if user[3] else "?"
-        user_dorm = escape(str(user[4])) if user[4] else "?"
-        rest_name = escape(str(order[3])) if order[3] else "?"
-        item_name = escape(str(order[4])) if order[4] else "?"
-        price_display = escape(str(order[5])) if order[5] else "0"
-
-        # Get Admin Name
-        admin_name = "Unknown Admin"
-        try:
-            admin_user = msg.from_user
-            if admin_user:
-                admin_name = escape(
-                    f"{admin_user.first_name} {admin_user.last_name or ''}".strip())
-        except:
-            pass
+        user_name = escape(str(user.name)) if user and user.name else "Unknown"
+        user_id_display = escape(str(user.student_id)) if user and user.student_id else "Unknown"
+        user_phone = escape(str(user.phone)) if user and user.phone else "Unknown"
+        user_block = escape(str(user.block)) if user and user.block else "?"
+        user_dorm = escape(str(user.dorm_number)) if user and user.dorm_number else "?"
+        rest_name = escape(str(order.restaurant)) if order.restaurant else "?"
+        item_name = escape(str(order.items)) if order.items else "?"
+        price_display = escape(str(order.total_price)) if order.total_price else "0"
 
         caption = (
             f"✅ <b>Order #{order_id} COMPLETED</b>\n"
@@ -331,164 +344,85 @@ async def handle_admin_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
             f"📍 <b>Restaurant:</b> {rest_name}\n"
             f"🍔 <b>Item:</b> {item_name}\n"
             f"💰 <b>Price:</b> {price_display} ETB\n"
-            f"👮 <b>Delivered By:</b> {admin_name}"
+            f"👮 <b>Delivered By:</b> {escape(data['admin_name'])}"
         )
 
-        # Log the caption for debugging
-        logger.info(f"Generated Caption: {caption}")
-
-        # Send to Completed Channel
-        # Send User Proof
-        if user_proof_id:
-            await context.bot.send_photo(
-                chat_id=COMPLETED_ORDERS_CHANNEL_ID,
-                photo=user_proof_id,
-                caption=f"{caption}\n\n📤 <b>Proof from User</b>",
-                parse_mode='HTML'
-            )
+        # User proof first, then the admin receipt
+        if data['user_proof']:
+            channel.append(('send_photo', dict(chat_id=COMPLETED_ORDERS_CHANNEL_ID, photo=data['user_proof'],
+                                               caption=f"{caption}\n\n📤 <b>Proof from User</b>", parse_mode='HTML')))
+        channel.append(('send_photo', dict(chat_id=COMPLETED_ORDERS_CHANNEL_ID, photo=data['receipt'],
+                                           caption=f"{caption}\n\n🧾 <b>Receipt from Admin</b>", parse_mode='HTML')))
+    except Exception as e:
+        logger.error(f"Failed to build completion post for order #{order_id}: {e}")
 
-        # Send Admin Receipt
-        await context.bot.send_photo(
-            chat_id=COMPLETED_ORDERS_CHANNEL_ID,
-            photo=file_id,
-            caption=f"{caption}\n\n🧾 <b>Receipt from Admin</b>",
-            parse_mode='HTML'
-        )
+    _, channel_error = await _completion_steps(customer, channel)
+    if channel_error or not channel:
+        # Try sending error to admin chat so they know
+        outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=f"⚠️ Error logging order #{order_id} to the completed channel.", priority=PRIORITY_PAYMENT)
 
-        # Cleanup
-        if user_proof_id:
-            del context.bot_data[f'user_proof_{order_id}']
+    # Give the customer time to stop sharing their location before the rating prompt
+    context.job_queue.run_once(completion_rating_job, COMPLETION_RATING_DELAY, name=f"complete_{order_id}", data=data)
 
-    except Exception as e:
-        logger.error(f"FAILED TO SEND TO COMPLETED CHANNEL: {e}")
-        # Try sending error to admin chat so they know
-        try:
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"⚠️ Error logging completion to channel: {e}")
-        except:
-            pass
 
-    # 2.5. Ask User to Stop Live Location
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=get_text('stop_live_loc', lang),
-            parse_mode='Markdown'
-        )
-        # Wait 5 seconds
-        await asyncio.sleep(5)
-    except Exception:
-        pass
+def _rating_keyboard(order_id):
+    # 1-10 buttons, five per row
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(str(i), callback_data=pack('rate', order_id, i)) for i in range(row, row + 5)]
+        for row in (1, 6)
+    ])
 
-    # 3. Ask User for Rating
-    try:
-        # Create 1-10 buttons
-        buttons = []
-        row = []
-        for i in range(1, 11):
-            row.append(InlineKeyboardButton(
-                str(i), callback_data=f"rate_{order_id}_{i}"))
-            if len(row) == 5:
-                buttons.append(row)
-                row = []
-        if row:
-            buttons.append(row)
 
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=get_text('rate_us', lang),
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
-    except Exception:
-        pass
+async def completion_rating_job(context: ContextTypes.DEFAULT_TYPE):
+    """Second half of an order completion: rating keyboard, final prompt, then the order's state is dropped."""
+    data = context.job.data
+    order_id, user_id = data['order_id'], data['user_id']
+    lang = await db.get_user_language(user_id) or 'en'
 
-    # 4. Cleanup
-    # del context.bot_data[f'admin_uploading_receipt_{admin_id}'] # No longer needed with reply logic
-    await msg.reply_text(
-        f"Receipt sent to user. Order #{order_id} marked as complete.\n\n"
-        "🛑 **ATTENTION ADMIN:** Please **STOP SHARING YOUR LIVE LOCATION** now if you are still sharing it."
-    )
+    # Same chat, so these stay in order; Telegram bots cannot clear the chat history, so the prompt is the last word
+    await _completion_steps([
+        ('send_message', dict(chat_id=user_id, text=get_text('rate_us', lang), reply_markup=_rating_keyboard(order_id))),
+        ('send_message', dict(chat_id=user_id, text=get_text('order_complete_prompt', lang))),
+    ])
 
-    # --- NEW: Delete all messages in user's chat, then send /start prompt ---
+    # Only now, after all notifications, remove the relay so the user can see the admin's location until the very end.
+    # Every step here is a no-op when repeated.
     try:
-        # Telegram Bots cannot "Clear History" or read past messages to delete them.
-        # We will simply send the final prompt to the user.
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=get_text('order_complete_prompt', lang)
-        )
-    except Exception as e:
-        logger.warning(
-            f"Failed to send final prompt to user: {e}")
-    # Only now, after all notifications, remove the relay so the user can see the admin's location until the very end
-    try:
-        logger.info(f"Cleaning up data for completed order #{order_id}")
-        # 1. Remove from admin_orders (Stops Admin->User relay)
-        admin_orders = context.bot_data.get('admin_orders', {})
-        if order_id in admin_orders:
-            del admin_orders[order_id]
-            logger.info(f"Removed order {order_id} from admin_orders")
-
-        # 2. Remove from admin_live (Stops User->Admin relay)
-        admin_live = context.bot_data.get('admin_live', {})
-        # admin_live is keyed by user_id
-        if user_id in admin_live:
-            del admin_live[user_id]
+        EphemeralStore(context.bot_data).evict_order(order_id)
+        if await workflow.pop('admin_live', user_id) is not None:
             logger.info(f"Removed user {user_id} from admin_live")
-        # Fallback: search by order_id if user_id key missing or different
-        for k in list(admin_live.keys()):
-            if admin_live[k].get('order_id') == order_id:
-                del admin_live[k]
-
-        # 3. Remove from tracking_relays (Stops Admin->User relay mapping)
-        # (This is the key part: only remove after all notifications are sent)
-        relays = context.bot_data.get('tracking_relays', {})
-        # relays is keyed by admin_id
-        for k in list(relays.keys()):
-            if relays[k].get('order_id') == order_id:
-                del relays[k]
-                logger.info(f"Removed relay for admin {k}")
-
-        # 4. Remove locks
-        order_locked = context.bot_data.get('order_locked', {})
-        if order_id in order_locked:
-            del order_locked[order_id]
-
+        # admin_orders, cancel buttons, and any relay or admin_live entry still pointing at this order
+        removed = await workflow.forget_order(order_id)
+        logger.info(f"Removed {removed} workflow entries for completed order {order_id}")
     except Exception as e:
         logger.error(f"Error during cleanup for order {order_id}: {e}")
 
 
-async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, rating):
     query = update.callback_query
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 3:
-        return
-    order_id = int(parts[1])
-    rating = int(parts[2])
 
     # Already imported at top
-    save_rating(order_id, rating)
+    await db.save_rating(order_id, rating)
 
     await query.edit_message_text(f"Thank you! You rated this order {rating}/10.")
 
     # --- NEW: Post Rating to Completed Orders Channel ---
+    # The channel post and the thank-you prompt go out from the job queue instead of holding the handler
+    context.job_queue.run_once(rating_post_job, 0, data={'order_id': order_id, 'rating': rating})
+    context.job_queue.run_once(rating_prompt_job, RATING_PROMPT_DELAY, chat_id=query.from_user.id)
+
+
+async def rating_post_job(context: ContextTypes.DEFAULT_TYPE):
+    """Posts a rating to the completed orders channel."""
+    order_id, rating = context.job.data['order_id'], context.job.data['rating']
     try:
         # Fetch order details to get admin info
-        order = get_order(order_id)
-        # deliverer_id is at index 2
-        deliverer_id = order[2] if order else None
-
-        admin_name = "Unknown Admin"
-        if deliverer_id:
-            try:
-                # Try to get admin name from chat member info
-                member = await context.bot.get_chat_member(ADMIN_CHAT_ID, deliverer_id)
-                admin_name = member.user.full_name
-            except Exception:
-                pass
+        order = await db.get_order(order_id)
+        deliverer_id = order.deliverer_id if order else None
 
         from html import escape
-        admin_name = escape(admin_name)
+        admin_name = escape(admin_directory.name(deliverer_id, "Unknown Admin"))
 
         msg = (
             f"⭐ <b>RATING RECEIVED</b>\n\n"
@@ -497,7 +431,8 @@ async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"<b>Delivered By:</b> {admin_name}"
         )
 
-        await context.bot.send_message(
+        outbox.post(
+            'send_message',
             chat_id=COMPLETED_ORDERS_CHANNEL_ID,
             text=msg,
             parse_mode='HTML'
@@ -505,16 +440,12 @@ async def rating_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.warning(f"Failed to post rating to channel: {e}")
 
-    # Wait 3 seconds, then Prompt
+
+async def rating_prompt_job(context: ContextTypes.DEFAULT_TYPE):
+    user_id = context.job.chat_id
     try:
-        await asyncio.sleep(3)
-        user_id = query.from_user.id
-        from database import get_user_language
-        lang = get_user_language(user_id) or 'en'
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=get_text('rating_submitted', lang)
-        )
+        lang = await db.get_user_language(user_id) or 'en'
+        outbox.post('send_message', chat_id=user_id, text=get_text('rating_submitted', lang))
     except Exception as e:
         logger.warning(f"Failed to send final prompt after rating: {e}")
 
@@ -540,22 +471,6 @@ REG_LANGUAGE, REG_NAME, REG_ID, REG_BLOCK, REG_GENDER, REG_DORM, REG_PHONE = ran
 ORDER_REST, ORDER_TYPE, ORDER_ITEM, ORDER_CONFIRM, ORDER_LOCATION = range(7, 12)
 DEV_WAIT_LOC = 99
 
-# Helper: Haversine Distance
-
-
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371000  # Earth radius in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-
-    a = math.sin(dphi/2)**2 + math.cos(phi1) * \
-        math.cos(phi2) * math.sin(dlambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
-
-
 # Load environment variables from .env file
 load_dotenv()
 
@@ -593,16 +508,14 @@ if not COMPLETED_ORDERS_CHANNEL_ID:
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    # Check language and ban status
-    user = get_user(user_id)
-    
-    if user and len(user) > 12 and user[12]: # is_banned column
+    if is_banned(user_id):
         await update.message.reply_text("❌ Access Denied: Your account has been suspended for security reasons.")
         return
 
-    language = None
-    if user and len(user) > 11:
-        language = user[11]
+    # Check language
+    user = await db.get_user(user_id)
+
+    language = user.language if user else None
     
     if not language:
         language = context.user_data.get('language')
@@ -618,7 +531,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Check if user is already registered
     if user:
-        name = user[2] if len(user) > 2 and user[2] else "User"
+        name = user.name or "User"
 
         await update.message.reply_text(
             get_text('welcome_back', language).format(name=name),
@@ -658,21 +571,9 @@ async def reset_registration(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def resume_rest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Resends restaurant selection."""
     language = context.user_data.get('language', 'en')
-    keyboard = []
-    menu_names = list(MENUS.keys())
-    row = []
-    for name in menu_names:
-        row.append(name)
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-
     await update.message.reply_text(
         get_text('resume_rest', language),
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard, one_time_keyboard=True, resize_keyboard=True)
+        reply_markup=catalog.restaurant_keyboard
     )
     return ORDER_REST
 
@@ -685,14 +586,9 @@ async def resume_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Fallback if data missing
         return await resume_rest(update, context)
 
-    menu = MENUS[restaurant]
-    keyboard = []
-    for item, price in menu.items():
-        keyboard.append([f"{item} - {price} ETB"])
-
     await update.message.reply_text(
         get_text('resume_menu', language).format(restaurant=restaurant),
-        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+        reply_markup=catalog.item_keyboard(restaurant, context.user_data.get('is_contract', False))
     )
     return ORDER_ITEM
 
@@ -791,11 +687,11 @@ async def reg_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['language'] = lang
     
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await db.get_user(user_id)
     if user:
-         set_user_language(user_id, lang)
+         await db.set_user_language(user_id, lang)
          
-         name = user[1]
+         name = user.name
          await update.message.reply_text(
             get_text('welcome_back', lang).format(name=name),
             reply_markup=ReplyKeyboardMarkup(
@@ -1169,7 +1065,7 @@ async def reg_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_gender = context.user_data.get('gender')
 
     # Update database with username
-    changes = add_user(user_id, username, user_data['name'], user_data['student_id'],
+    changes = await db.add_user(user_id, username, user_data['name'], user_data['student_id'],
              user_data['block'], user_data['dorm'], user_data['phone'], user_gender)
     
     if changes:
@@ -1177,12 +1073,12 @@ async def reg_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
             msg = f"⚠️ **User Details Changed**\nUser ID: {user_id}\n"
             for field, (old, new) in changes.items():
                 msg += f"- {field.capitalize()}: {old} -> {new}\n"
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=msg, parse_mode='Markdown')
+            outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=msg, parse_mode='Markdown')
         except Exception as e:
             logger.error(f"Failed to notify admin about user change: {e}")
 
     # Also update language preference in DB
-    set_user_language(user_id, user_language)
+    await db.set_user_language(user_id, user_language)
 
     # Cleanup attempts counter
     if 'phone_attempts' in context.user_data:
@@ -1222,21 +1118,6 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Order Flow ---
 
 
-def is_user_registered(user_id):
-    # Connect to your database (ensure the name 'bedorme.db' matches your file)
-    conn = sqlite3.connect('bedorme.db')
-    cursor = conn.cursor()
-
-    # Check if the user_id exists in the users table
-    cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-    user = cursor.fetchone()
-
-    conn.close()
-
-    # Returns True if user exists, False otherwise
-    return user is not None
-
-
 async def order_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -1244,9 +1125,9 @@ async def order_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     language = context.user_data.get('language')
     if not language:
         # Check DB
-        user = get_user(user_id)
-        if user and len(user) > 10: 
-             language = user[10]
+        user = await db.get_user(user_id)
+        if user and user.language:
+             language = user.language
              context.user_data['language'] = language
         else:
              language = 'en'
@@ -1269,7 +1150,7 @@ async def order_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- 1. THE REGISTRATION GUARD (MUST BE FIRST) ---
     # We check the database BEFORE showing any restaurant buttons
-    if not is_user_registered(user_id):
+    if not await db.is_user_registered(user_id):
         await update.message.reply_text(
             "❌ **Access Denied**\n\n"
             "Please follow the registration step to order! You must be registered first.\n"
@@ -1280,31 +1161,52 @@ async def order_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # --- 2. YOUR ORIGINAL STRUCTURE (ONLY RUNS IF REGISTERED) ---
-    keyboard = []
-    # Build keyboard from MENUS keys to ensure it matches
-    menu_names = list(MENUS.keys())
-    row = []
-    for name in menu_names:
-        row.append(name)
-        if len(row) == 2:
-           keyboard.append(row)
-           row = []
-    if row:
-        keyboard.append(row)
-
     await update.message.reply_text(
         "ℹ️ **Delivery Fee Notice**\n"
         "A delivery fee of **15 ETB per item** will be added to your total order price.\n"
         "(e.g. 1 item = +15 ETB, 2 items = +30 ETB)\n\n" +
         get_text('choose_rest', language),
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard, one_time_keyboard=True, resize_keyboard=True),
+        reply_markup=catalog.restaurant_keyboard,
         parse_mode='Markdown'
     )
     return ORDER_REST
 
 
-async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def suggest_deliverers(context: ContextTypes.DEFAULT_TYPE, pickups):
+    """Ranked deliverer suggestions for each (lat, lon) pickup, plus {deliverer_id: display name}."""
+    deliverers = await db.get_all_admins()
+    loads = await db.get_deliverer_loads()
+    ids = [d.user_id for d in deliverers]
+    positions = deliverer_positions(ids, EphemeralStore(context.bot_data))
+    names = {d.user_id: f"{d.name} (@{d.username})" if d.username else (d.name or str(d.user_id)) for d in deliverers}
+    return rank(pickups, ids, positions, loads), names
+
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/dispatch in the admin group: best deliverer for every pending order, ranked in one pass."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        return
+    orders = sorted(await db.get_pending_orders(), key=lambda o: o.created_at or 0)
+    if not orders:
+        await update.message.reply_text("No pending orders.")
+        return
+    ranked, names = await suggest_deliverers(context, [(o.pickup_lat, o.pickup_lon) for o in orders])
+    lines = []
+    for order, suggestions in zip(orders, ranked):
+        best = format_suggestions(suggestions[:1], names).removeprefix("1. ")
+        lines.append(f"#{order.order_id} {order.restaurant} → {best}")
+
+    # Telegram caps messages at 4096 characters
+    chunk = "🧭 Suggested deliverers (oldest order first):"
+    for line in lines:
+        if len(chunk) + len(line) + 1 > 4000:
+            outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=chunk)
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=chunk)
+
+
+async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, customer_id=None):
     """Callback when admin taps 'Order Received' button in the admin group."""
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
@@ -1312,35 +1214,23 @@ async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     await query.answer()
 
-    # callback format: admin_accept_{order_id}_{customer_id}
-    parts = query.data.split("_")
-    if len(parts) < 3:
-        await query.edit_message_text("Invalid callback data.")
-        return
-
-    order_id = int(parts[2])
-    customer_id = int(parts[3]) if len(parts) > 3 else None
+    # Whoever takes the order is shown by name later; remember it while we have it
+    admin_directory.note(query.from_user)
 
     # --- FIX #4 & #5: ATOMIC DB CHECK ---
     # Try to assign the order in the DB. If it returns False, someone else took it.
     try:
-        from database import assign_deliverer
-        success = assign_deliverer(order_id, query.from_user.id)
+        success = await db.assign_deliverer(order_id, query.from_user.id)
 
         if not success:
             # Check who actually took it
-            from database import get_order
-            order = get_order(order_id)
-            deliverer_id = order[2] if order else None
+            order = await db.get_order(order_id)
+            deliverer_id = order.deliverer_id if order else None
 
             # If I am the one who took it (maybe I clicked twice), that's fine.
             if deliverer_id != query.from_user.id:
                 # Get the name of the admin who took it for clarity
-                try:
-                    member = await context.bot.get_chat_member(ADMIN_CHAT_ID, deliverer_id)
-                    taken_by = member.user.full_name
-                except:
-                    taken_by = f"Admin {deliverer_id}"
+                taken_by = admin_directory.name(deliverer_id, f"Admin {deliverer_id}")
 
                 await query.answer(f"⚠️ Order already taken by {taken_by}!", show_alert=True)
 
@@ -1360,27 +1250,18 @@ async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # Mark order as accepted and update admin message to show it's been accepted
-    # We still use bot_data for temporary UI state (like message_id), but the "Truth" is now in the DB.
-    admin_orders = context.bot_data.setdefault('admin_orders', {})
-    admin_entry = admin_orders.get(order_id)
-
-    # If this is a fresh start (bot restarted), admin_entry might be None, but DB says we accepted it.
-    if admin_entry is None:
-        admin_orders[order_id] = {
-            'accepted': True, 'admin_id': query.from_user.id}
-        admin_entry = admin_orders[order_id]
-
-    # ALWAYS Ensure it is marked as accepted in memory
-    admin_entry['accepted'] = True
-    admin_entry['admin_id'] = query.from_user.id
+    # The workflow store holds UI state (like message_id), but the "Truth" is in the orders table.
+    # The entry may be missing (e.g. after a reset), but the DB says we accepted it.
+    await workflow.update('admin_orders', order_id, lambda entry: {
+        **(entry or {}), 'accepted': True, 'admin_id': query.from_user.id})
 
     request_location_kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Request Updated Location",
-                              callback_data=f"admin_request_location_{order_id}_{customer_id}")],
+                              callback_data=pack('admin_request_location', order_id, customer_id))],
         [InlineKeyboardButton(
-            "I'm about to pay", callback_data=f"about_to_pay_{order_id}_{customer_id}")],
+            "I'm about to pay", callback_data=pack('about_to_pay', order_id, customer_id))],
         [InlineKeyboardButton("⚠️ Force Arrival Notify",
-                              callback_data=f"force_arrival_{order_id}_{customer_id}")]
+                              callback_data=pack('force_arrival', order_id, customer_id))]
     ])
 
     # Update the message UI
@@ -1397,12 +1278,8 @@ async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE)
         pass
 
     # Notify the customer that their order is on the way
-    try:
-        if customer_id:
-            await context.bot.send_message(chat_id=customer_id, text=f"🚚 Your order #{order_id} is on the way!")
-    except Exception as e:
-        logger.warning(
-            f"Could not notify customer about order on the way: {e}")
+    if customer_id:
+        outbox.post('send_message', chat_id=customer_id, text=f"🚚 Your order #{order_id} is on the way!")
 
     # Ask admin group to share their live location in the admin chat
     try:
@@ -1410,83 +1287,73 @@ async def admin_accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE)
         order = None
         customer = None
         try:
-            order = get_order(order_id)
-            customer = get_user(customer_id) if customer_id else None
+            order = await db.get_order(order_id)
+            customer = await db.get_user(customer_id) if customer_id else None
         except Exception:
             pass
 
         admin_name = query.from_user.full_name if query.from_user else "(unknown admin)"
         order_info = f"Order #{order_id}"
         if customer:
-            order_info += (f"\nCustomer: {customer[2]} (@{customer[1]})"
-                           f"\nStudent ID: {customer[3]}"
-                           f"\nBlock/Dorm: {customer[4]} / {customer[5]}"
-                           f"\nPhone: {customer[6]}")
+            order_info += (f"\nCustomer: {customer.name} (@{customer.username})"
+                           f"\nStudent ID: {customer.student_id}"
+                           f"\nBlock/Dorm: {customer.block} / {customer.dorm_number}"
+                           f"\nPhone: {customer.phone}")
         if order:
-            order_info += (f"\nRestaurant: {order[3]}"
-                           f"\nItem: {order[4]}"
-                           f"\nPrice: {order[5]} ETB"
-                           f"\nType: {order[7]}"
-                           f"\nVerification Code: {order[8]}")
+            order_info += (f"\nRestaurant: {order.restaurant}"
+                           f"\nItem: {order.items}"
+                           f"\nPrice: {order.total_price} ETB"
+                           f"\nType: {order.order_type}"
+                           f"\nVerification Code: {order.verification_code}")
 
         prompt = (f"Admin {admin_name} has accepted this order. "
                   f"Only {admin_name} should share their live location for this order.\n\n"
                   f"{order_info}\n\n"
                   "Please share your Live Location here so the customer can track you.\n\nUse 📎 > Location > Share Live Location.")
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=prompt)
+        outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=prompt)
         # create a placeholder relay mapping: admin -> customer
         admin_id = query.from_user.id
         if admin_id and customer_id:
-            if 'tracking_relays' not in context.bot_data:
-                context.bot_data['tracking_relays'] = {}
-            context.bot_data['tracking_relays'][admin_id] = {
-                'chat_id': customer_id, 'message_id': None, 'order_id': order_id}
+            await workflow.put('tracking_relays', admin_id, {
+                'chat_id': customer_id, 'message_id': None, 'order_id': order_id})
     except Exception as e:
         logger.warning(f"Failed prompting admin group for live location: {e}")
 
 
-async def force_arrival_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def force_arrival_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, user_id):
     """Admin manually clicked 'Force Arrival Notify'."""
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
         await query.answer("Unauthorized action.", show_alert=True)
         return
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 4:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    order_id = int(parts[2])
-    user_id = int(parts[3])
 
     # --- CHECK IF CANCELLED ---
-    from database import get_order
-    order = get_order(order_id)
-    # Status is at index 6
-    if order and order[6] == 'cancelled':
+    order = await db.get_order(order_id)
+    if order and order.status == 'cancelled':
         await query.edit_message_text("❌ This order was CANCELLED by the user. You cannot force arrival.")
         return
+    await db.transition_order(order_id, 'arrived')
 
     # Notify User
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="Your food has arrived! You will shortly receive a call from our agents."
-        )
-    except Exception as e:
-        logger.warning(f"Failed to send manual arrival msg to user: {e}")
+    outbox.post(
+        'send_message',
+        chat_id=user_id,
+        text="Your food has arrived! You will shortly receive a call from our agents."
+    )
 
     # Notify Admin (Ask if they see user)
     try:
-        user = get_user(user_id)
-        phone = user[5] if user and len(user) > 5 else "(unknown)"
+        user = await db.get_user(user_id)
+        phone = user.phone if user and user.phone else "(unknown)"
 
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton(
-                "Yes", callback_data=f"admin_seen_user_{order_id}_{user_id}")]
+                "Yes", callback_data=pack('admin_seen_user', order_id, user_id))]
         ])
 
-        await context.bot.send_message(
+        outbox.post(
+            'send_message',
             chat_id=ADMIN_CHAT_ID,
             text=f"✅ Manual Arrival Triggered.\nPlease call {phone}.\nDo you see the user? Click 'Yes' when you have seen the receiver.",
             reply_markup=kb
@@ -1510,38 +1377,17 @@ async def order_rest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Debug print
     # print(f"DEBUG: User chose {choice}, keys are {list(MENUS.keys())}")
 
-    if choice not in MENUS:
-        # Check if it was a valid choice but maybe case sensitive?
-        # Let's try case-insensitive match
-        found = None
-        for k in MENUS:
-            if k.lower() == choice.lower():
-                found = k
-                break
-        
-        if found:
-            choice = found
-        else:
-             # Check if 'Resume Order' or 'Back' type commands were sent
-            language = context.user_data.get('language', 'en')
-            knames = ", ".join(list(MENUS.keys()))
-            
-            # Dynamic keyboard from MENUS keys
-            keyboard = []
-            row = []
-            for name in MENUS.keys():
-                row.append(name)
-                if len(row) == 2:
-                    keyboard.append(row)
-                    row = []
-            if row:
-                keyboard.append(row)
-            
-            await update.message.reply_text(
-                f"Please select a valid restaurant.\nOptions: {knames}",
-                 reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-            )
-            return ORDER_REST
+    # Case-insensitive match against the restaurant names
+    found = catalog.find_restaurant(choice)
+    if found:
+        choice = found
+    else:
+        knames = ", ".join(list(MENUS.keys()))
+        await update.message.reply_text(
+            f"Please select a valid restaurant.\nOptions: {knames}",
+             reply_markup=catalog.restaurant_keyboard
+        )
+        return ORDER_REST
     
     # Store clean choice
     context.user_data['restaurant'] = choice
@@ -1562,7 +1408,7 @@ async def order_type_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if choice_type == "Contract":
         # Check registration
-        contract = get_contract_details(user_id, restaurant)
+        contract = await db.get_contract_details(user_id, restaurant)
         if not contract:
             # Fallback if not registered
             await update.message.reply_text(
@@ -1574,10 +1420,10 @@ async def order_type_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['is_contract'] = False
         else:
             # Check balance and credit
-            paid = contract['total_paid']
-            used = contract['balance_used']
-            remains = contract['current_balance']
-            credit = contract['credit_meals']
+            paid = contract.total_paid
+            used = contract.balance_used
+            remains = contract.current_balance
+            credit = contract.credit_meals
             
             # Requirement: if no assigned value then create credit value for 2 meals at most
             if remains <= 0 and credit >= 2:
@@ -1609,25 +1455,12 @@ async def order_type_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Proceed to show items
     is_contract = context.user_data.get('is_contract', False)
-    if is_contract and restaurant in CONTRACT_MENUS:
-        menu = CONTRACT_MENUS[restaurant]
-        contract_msg = "\n\n🎖️ **Contract Price Applied**"
-    else:
-        menu = MENUS.get(restaurant, {})
-        contract_msg = ""
-    
-    # Create menu buttons
-    keyboard = []
-    from database import get_unavailable_items
-    unavailable = get_unavailable_items(restaurant)
-    
-    for item, price in menu.items():
-        if item not in unavailable:
-            keyboard.append([f"{item} - {price} ETB"])
+    contract_msg = "\n\n🎖️ **Contract Price Applied**" if is_contract and catalog.has_contract_menu(restaurant) else ""
 
+    # Prebuilt keyboard of the items currently in stock
     await update.message.reply_text(
         get_text('choose_item', language).format(restaurant=restaurant) + contract_msg,
-        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True),
+        reply_markup=catalog.item_keyboard(restaurant, is_contract),
         parse_mode='Markdown'
     )
     return ORDER_ITEM
@@ -1640,53 +1473,30 @@ async def order_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- PARAMETER CHECK: PREVENT CRASH & UNAUTHORIZED COMMANDS ---
     restaurant = context.user_data.get('restaurant')
     is_contract = context.user_data.get('is_contract', False)
-    
-    if is_contract and restaurant in CONTRACT_MENUS:
-        current_menu = CONTRACT_MENUS[restaurant]
-    else:
-        current_menu = MENUS.get(restaurant, {})
-
-    from database import get_unavailable_items
-    unavailable = get_unavailable_items(restaurant)
-    available_keyboard = [[f"{item} - {price} ETB"] for item, price in current_menu.items() if item not in unavailable]
+    available_keyboard = catalog.item_keyboard(restaurant, is_contract)
 
     if text.startswith('/'):
         await update.message.reply_text(
             "⚠️ Please use the buttons provided. Commands are not allowed during ordering.",
-            reply_markup=ReplyKeyboardMarkup(available_keyboard, one_time_keyboard=True, resize_keyboard=True)
+            reply_markup=available_keyboard
         )
         return ORDER_ITEM
-    if " - " not in text:
+
+    # Buttons map straight to (item, price); the price always comes from the menu, never from the text
+    selected = catalog.lookup_item(restaurant, is_contract, text)
+    if selected is None:
         await update.message.reply_text(
             "⚠️ **Unauthorized Access**\n\nFinish the process you started! Please select a food item from the buttons provided.",
-            reply_markup=ReplyKeyboardMarkup(available_keyboard, one_time_keyboard=True, resize_keyboard=True),
+            reply_markup=available_keyboard,
             parse_mode='Markdown'
         )
         return ORDER_ITEM
 
-    # --- YOUR ORIGINAL STRUCTURE (INTACT) ---
-    try:
-        parts = text.split(" - ")
-        if len(parts) < 2:
-            raise ValueError("Invalid format")
-            
-        item_name = parts[0]
-        
-        if item_name in unavailable:
-             await update.message.reply_text(
-                "😔 Sorry, this item just ran out! Please choose something else:",
-                reply_markup=ReplyKeyboardMarkup(available_keyboard, one_time_keyboard=True, resize_keyboard=True)
-            )
-             return ORDER_ITEM
-
-        # Robustly handle price string like "70.0 ETB" or just "70"
-        price_str = parts[1].replace(" ETB", "").strip()
-        price = float(price_str)
-    except Exception:
-        # Invalid input fallback
+    item_name, price = selected
+    if not catalog.is_available(restaurant, item_name):
         await update.message.reply_text(
-            "⚠️ Invalid selection. Please use the buttons provided.",
-            reply_markup=ReplyKeyboardMarkup(available_keyboard, one_time_keyboard=True, resize_keyboard=True)
+            "😔 Sorry, this item just ran out! Please choose something else:",
+            reply_markup=available_keyboard
         )
         return ORDER_ITEM
 
@@ -1746,21 +1556,10 @@ async def order_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if action == 'add_more':
         # Order is already added in order_item handler. Just proceed.
         context.user_data['multi_ordering'] = True
-        
-        # Dynamic keyboard from MENUS keys
-        keyboard = []
-        row = []
-        for name in MENUS.keys():
-            row.append(name)
-            if len(row) == 2:
-                keyboard.append(row)
-                row = []
-        if row:
-            keyboard.append(row)
-            
+
         await update.message.reply_text(
             get_text('resume_rest', language),
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+            reply_markup=catalog.restaurant_keyboard
         )
         return ORDER_REST
 
@@ -1884,6 +1683,53 @@ async def order_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ORDER_CONFIRM
 
 
+async def announce_order(order_id, text, reply_markup, offer_text=None):
+    """Posts a new order to the admin group and records its message id. Returns the sent message, or None.
+
+    Started with application.create_task() so the customer's reply does not wait on the
+    admin group's rate limit.
+    """
+    try:
+        sent_admin = await outbox.send_message(chat_id=ADMIN_CHAT_ID, text=text, reply_markup=reply_markup)
+        # store admin order state so callbacks can edit it later
+        await workflow.put('admin_orders', order_id, {
+            'message_id': sent_admin.message_id, 'accepted': False})
+        await db.set_order_admin_message(order_id, sent_admin.message_id)
+    except Exception as e:
+        logger.error(f"Failed to post order #{order_id} to the admin group: {e}")
+        return None
+    if offer_text:
+        outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=offer_text, reply_to_message_id=sent_admin.message_id)
+    return sent_admin
+
+
+async def announce_verified_order(order_id, text, reply_markup, customer, lat, lon):
+    """announce_order() for an order placed after an admin accepted the location, followed by the customer's live location."""
+    if await announce_order(order_id, text, reply_markup) is None or lat is None or lon is None:
+        return
+    # A live-location message in the admin chat lets the deliverer see the drop-off there
+    try:
+        sent = await outbox.send_location(
+            chat_id=ADMIN_CHAT_ID,
+            latitude=lat,
+            longitude=lon,
+            live_period=3600
+        )
+        # store admin live mapping so subsequent customer edits can update this message
+        await workflow.put('admin_live', customer.user_id, {
+            'message_id': sent.message_id,
+            'order_id': order_id,
+            'customer_name': customer.name,
+            'student_id': customer.student_id,
+            'block': customer.block,
+            'dorm': customer.dorm_number,
+            'phone': customer.phone
+        })
+    except Exception as e:
+        logger.warning(
+            f"Failed to send initial live location to admin chat: {e}")
+
+
 async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     if not message:
@@ -1894,6 +1740,10 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lat, lon = None, None
 
     # Helper to get combined order details
+    def order_line(restaurant, item, price):
+        # One order_items row: (restaurant, item, price, delivery_fee, pickup_lat, pickup_lon)
+        return (restaurant, item, price, 15, *RESTAURANTS.get(restaurant, (None, None)))
+
     def get_combined_order_details(ctx):
         orders = ctx.user_data.get('orders', [])
         if not orders:
@@ -1903,7 +1753,8 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return {
                 'restaurant': ctx.user_data.get('restaurant'),
                 'item': ctx.user_data.get('item'),
-                'price': p + 15 
+                'price': p + 15,
+                'lines': [order_line(ctx.user_data.get('restaurant'), ctx.user_data.get('item'), p)]
             }
 
         restaurants = set(o['restaurant'] for o in orders)
@@ -1919,7 +1770,8 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return {
             'restaurant': restaurant_str,
             'item': items_str,
-            'price': total_price
+            'price': total_price,
+            'lines': [order_line(o['restaurant'], o['item'], o['price']) for o in orders]
         }
 
     # Map text back to internal action
@@ -1962,7 +1814,7 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif action == 'Place Order':
         # Finalize order
         user_id = update.effective_user.id
-        user = get_user(user_id)
+        user = await db.get_user(user_id)
         
         lat = context.user_data.get('delivery_lat')
         lon = context.user_data.get('delivery_lon')
@@ -1971,16 +1823,15 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         details = get_combined_order_details(context)
         code = ''.join(random.choices(string.digits, k=4))
 
-        # Get Pickup Coords
-        pickup_coords = RESTAURANTS.get(details['restaurant'], (None, None))
-        pickup_lat, pickup_lon = pickup_coords
+        # Pickup coords of the first stop; each line carries its own restaurant's coords
+        pickup_lat, pickup_lon = next(((line[4], line[5]) for line in details['lines'] if line[4] is not None), (None, None))
 
         is_contract = context.user_data.get('is_contract', False)
         order_type = 'contract' if is_contract else 'regular'
 
         # Pre-check for contract balance/credit
         if is_contract:
-            res = update_contract_payment(user_id, details['restaurant'], details['price'])
+            res = await db.update_contract_payment(user_id, details['restaurant'], details['price'])
             if res == "credit_limit_reached":
                 await message.reply_text(
                     "❌ **ORDER FAILED**\n\nYour contract balance is empty and you have reached the maximum credit limit (2 meals). Please pay your dues at the cafe to continue ordering.",
@@ -1992,7 +1843,7 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
                  is_contract = False
                  order_type = 'regular'
 
-        order_id = create_order(
+        order_id = await db.create_order(
             user_id,
             details['restaurant'],
             details['item'],
@@ -2002,38 +1853,50 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
             lon,
             pickup_lat,
             pickup_lon,
-            order_type=order_type
+            order_type=order_type,
+            lines=details['lines']
         )
+        active_deliveries.add(order_id, lat, lon)
 
         # Notify admin/channel about new order (if configured)
         try:
-            customer = get_user(user_id)
+            customer = await db.get_user(user_id)
+            near = nearest_block(lat, lon)
+            near_text = f"{near[0]} ({near[1]:.0f} m)" if near else f"⚠️ none within {ALLOWED_RADIUS} m"
+            suggestions, names = [], {}
+            try:
+                ranked, names = await suggest_deliverers(context, [(pickup_lat, pickup_lon)])
+                suggestions = ranked[0]
+            except Exception as e:
+                logger.warning(f"Deliverer ranking failed for order #{order_id}: {e}")
             # Send admin message with inline buttons: accept and about-to-pay
             kb = InlineKeyboardMarkup([
                 [
                     InlineKeyboardButton(
-                        "Order Received", callback_data=f"admin_accept_{order_id}_{user_id}"),
+                        "Order Received", callback_data=pack('admin_accept', order_id, user_id)),
                     InlineKeyboardButton(
-                        "I'm about to pay", callback_data=f"about_to_pay_{order_id}_{user_id}")
+                        "I'm about to pay", callback_data=pack('about_to_pay', order_id, user_id))
                 ]
             ])
             
+            offer_text = None
+            if DISPATCH_AUTO_OFFER and suggestions:
+                best = suggestions[0]
+                offer_text = f"👉 {names.get(best.deliverer_id, best.deliverer_id)}, you are the best match for order #{order_id}. Tap 'Order Received' above to take it."
             # Construct localized admin message (Admin likely speaks English or Amharic, stick to English/Mixed for Admin)
-            sent_admin = await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=(f"🆕 New Order #{order_id}\n"
-                      f"Customer: {customer[1]} (tg id: {customer[0]})\n"
-                      f"Student ID: {customer[2]}\n"
-                      f"Block/Dorm: {customer[3]} / {customer[4]}\n"
-                      f"Phone: {customer[5]}\n"
-                      f"Restaurant: {details['restaurant']}\n"
-                      f"Item: {details['item']} | Price: {details['price']} ETB\n"
-                      f"Verification Code: {code}"),
-                reply_markup=kb)
-            # store admin order state so callbacks can edit it later
-            admin_orders = context.bot_data.setdefault('admin_orders', {})
-            admin_orders[order_id] = {
-                'message_id': sent_admin.message_id, 'accepted': False, 'about_to_pay': False}
+            context.application.create_task(announce_order(
+                order_id,
+                (f"🆕 New Order #{order_id}\n"
+                 f"Customer: {customer.name} (tg id: {customer.user_id})\n"
+                 f"Student ID: {customer.student_id}\n"
+                 f"Block/Dorm: {customer.block} / {customer.dorm_number}\n"
+                 f"Nearest block to drop-off: {near_text}\n"
+                 f"Phone: {customer.phone}\n"
+                 f"Restaurant: {details['restaurant']}\n"
+                 f"Item: {details['item']} | Price: {details['price']} ETB\n"
+                 f"Verification Code: {code}\n\n"
+                 f"🧭 Closest deliverers:\n{format_suggestions(suggestions, names)}"),
+                kb, offer_text))
         except Exception as e:
             logger.error(f"Failed to notify admin: {e}")
 
@@ -2045,17 +1908,15 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Send an inline Cancel Order button
         try:
             kb = InlineKeyboardMarkup([[InlineKeyboardButton(
-                get_text('cancel_order_button', language), callback_data=f"cancel_order_{order_id}")]])
-            sent_cancel = await context.bot.send_message(
+                get_text('cancel_order_button', language), callback_data=pack('cancel_order', order_id))]])
+            sent_cancel = await outbox.send_message(
                 chat_id=user_id, 
                 text=get_text('cancel_order_prompt', language), 
                 reply_markup=kb
             )
             # store user's cancel-button message id so we can remove it if admin proceeds to purchase
-            user_cancel_msgs = context.bot_data.setdefault(
-                'user_cancel_msgs', {})
-            user_cancel_msgs[order_id] = {
-                'chat_id': user_id, 'message_id': sent_cancel.message_id}
+            await workflow.put('user_cancel_msgs', order_id, {
+                'chat_id': user_id, 'message_id': sent_cancel.message_id})
         except Exception:
             pass
             
@@ -2084,28 +1945,23 @@ async def order_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Admin verifies user-uploaded location ---
 
 
-async def admin_verify_location_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_verify_location_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, approve, user_id, lat, lon):
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
         await query.answer("Unauthorized action.", show_alert=True)
         return
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 7:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    action = parts[3]
-    user_id = int(parts[4])
-    lat = float(parts[5])
-    lon = float(parts[6])
+    # Packed buttons carry microdegrees; old ones carried the floats
+    if isinstance(lat, int) and isinstance(lon, int):
+        lat, lon = lat / 1e6, lon / 1e6
 
-    if action == "yes":
+    if approve:
         try:
             # Set a flag in bot_data to allow order to proceed
-            context.bot_data[f'location_verified_{user_id}'] = (lat, lon)
+            EphemeralStore(context.bot_data).set('location_verified', user_id, (lat, lon))
             await query.edit_message_text(f"Location for user {user_id} accepted. Proceeding with order.")
             # Notify user
-            await context.bot.send_message(chat_id=user_id, text="✅ Your location was accepted by the admin. Proceeding with your order.")
+            outbox.post('send_message', chat_id=user_id, text="✅ Your location was accepted by the admin. Proceeding with your order.")
 
             # Generate Verification Code
             code = ''.join(random.choices(string.digits, k=4))
@@ -2123,21 +1979,20 @@ async def admin_verify_location_callback(update: Update, context: ContextTypes.D
             # BUT, looking at order_location, it stores 'pending_location'.
             # We need to store the pending order details in bot_data keyed by user_id in order_location.
 
-            pending_order = context.bot_data.get(f'pending_order_{user_id}')
+            pending_order = await workflow.get('pending_order', user_id)
             if not pending_order:
-                await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"Error: Could not find pending order data for user {user_id}.")
+                outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=f"Error: Could not find pending order data for user {user_id}.")
                 return
 
             # Get Pickup Coords
             pickup_coords = RESTAURANTS.get(pending_order['restaurant'], (None, None))
             pickup_lat, pickup_lon = pickup_coords
 
-            from database import is_test_mode_active
-            is_test = 1 if is_test_mode_active() else 0
+            is_test = 1 if await db.is_test_mode_active() else 0
 
             # Override create_order to support is_test
             # Since create_order doesn't take is_test yet, we update it immediately after
-            order_id = create_order(
+            order_id = await db.create_order(
                 user_id,
                 pending_order['restaurant'],
                 pending_order['item'],
@@ -2148,83 +2003,51 @@ async def admin_verify_location_callback(update: Update, context: ContextTypes.D
                 pickup_lat,
                 pickup_lon
             )
+            active_deliveries.add(order_id, lat, lon)
             
             # Patch for Test Mode
             if is_test:
-                 from database import execute_query, get_db_connection
-                 temp_conn = get_db_connection()
-                 try:
-                     execute_query(temp_conn, "UPDATE orders SET is_test = 1 WHERE order_id = ?", (order_id,))
-                     temp_conn.commit()
-                     # Optional: Notify admin this is a TEST order
-                     await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"🧪 Note: Order #{order_id} marked as TEST data.")
-                 finally:
-                     temp_conn.close()
+                 await db.mark_order_as_test(order_id)
+                 # Optional: Notify admin this is a TEST order
+                 outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=f"🧪 Note: Order #{order_id} marked as TEST data.")
 
             # Notify admin/channel about new order (if configured)
             try:
-                customer = get_user(user_id)
+                customer = await db.get_user(user_id)
                 # Send admin message with inline buttons: accept and about-to-pay
                 kb = InlineKeyboardMarkup([
                     [
                         InlineKeyboardButton(
-                            "Order Received", callback_data=f"admin_accept_{order_id}_{user_id}"),
+                            "Order Received", callback_data=pack('admin_accept', order_id, user_id)),
                         InlineKeyboardButton(
-                            "I'm about to pay", callback_data=f"about_to_pay_{order_id}_{user_id}")
+                            "I'm about to pay", callback_data=pack('about_to_pay', order_id, user_id))
                     ]
                 ])
-                sent_admin = await context.bot.send_message(
-                    chat_id=ADMIN_CHAT_ID,
-                    text=(f"🆕 New Order #{order_id}\n"
-                          f"Customer: {customer[1]} (tg id: {customer[0]})\n"
-                          f"Student ID: {customer[2]}\n"
-                          f"Block/Dorm: {customer[3]} / {customer[4]}\n"
-                          f"Phone: {customer[5]}\n"
-                          f"Restaurant: {pending_order['restaurant']}\n"
-                          f"Item: {pending_order['item']} | Price: {pending_order['price']} ETB\n"
-                          f"Verification Code: {code}"),
-                    reply_markup=kb)
-                # store admin order state so callbacks can edit it later
-                admin_orders = context.bot_data.setdefault('admin_orders', {})
-                admin_orders[order_id] = {
-                    'message_id': sent_admin.message_id, 'accepted': False, 'about_to_pay': False}
-                # If we have a location, send a live-location message to the admin chat so deliverer can view it there
-                try:
-                    if lat is not None and lon is not None:
-                        sent = await context.bot.send_location(
-                            chat_id=ADMIN_CHAT_ID,
-                            latitude=lat,
-                            longitude=lon,
-                            live_period=3600
-                        )
-                        # store admin live mapping so subsequent customer edits can update this message
-                        admin_live = context.bot_data.setdefault(
-                            'admin_live', {})
-                        admin_live[user_id] = {
-                            'message_id': sent.message_id,
-                            'order_id': order_id,
-                            'customer_name': customer[1],
-                            'student_id': customer[2],
-                            'block': customer[3],
-                            'dorm': customer[4],
-                            'phone': customer[5]
-                        }
-                except Exception as e:
-                    logger.warning(
-                        f"Failed to send initial live location to admin chat: {e}")
+                context.application.create_task(announce_verified_order(
+                    order_id,
+                    (f"🆕 New Order #{order_id}\n"
+                     f"Customer: {customer.name} (tg id: {customer.user_id})\n"
+                     f"Student ID: {customer.student_id}\n"
+                     f"Block/Dorm: {customer.block} / {customer.dorm_number}\n"
+                     f"Phone: {customer.phone}\n"
+                     f"Restaurant: {pending_order['restaurant']}\n"
+                     f"Item: {pending_order['item']} | Price: {pending_order['price']} ETB\n"
+                     f"Verification Code: {code}"),
+                    kb, customer, lat, lon))
             except Exception as e:
                 logger.warning(f"Failed to send new order to admin chat: {e}")
 
             # Get user language for "Order Food" button
             cust_lang = 'en'
             try:
-                cust_info = get_user(user_id)
-                if cust_info and len(cust_info) > 10:
-                    cust_lang = cust_info[10]
+                cust_info = await db.get_user(user_id)
+                if cust_info and cust_info.language:
+                    cust_lang = cust_info.language
             except Exception:
                 pass
 
-            await context.bot.send_message(
+            outbox.post(
+                'send_message',
                 chat_id=user_id,
                 text=f"Order Placed! Admin will review your order.\n\nIMPORTANT: Your verification code is *{code}*. Keep it safe.",
                 parse_mode='Markdown',
@@ -2238,25 +2061,23 @@ async def admin_verify_location_callback(update: Update, context: ContextTypes.D
             # Send an inline Cancel Order button that prompts the user to re-enter their name if clicked
             try:
                 kb = InlineKeyboardMarkup([[InlineKeyboardButton(
-                    "Cancel Order", callback_data=f"cancel_order_{order_id}")]])
-                sent_cancel = await context.bot.send_message(chat_id=user_id, text="If you wish to cancel your order, press below:", reply_markup=kb)
+                    "Cancel Order", callback_data=pack('cancel_order', order_id))]])
+                sent_cancel = await outbox.send_message(chat_id=user_id, text="If you wish to cancel your order, press below:", reply_markup=kb)
                 # store user's cancel-button message id so we can remove it if admin proceeds to purchase
-                user_cancel_msgs = context.bot_data.setdefault(
-                    'user_cancel_msgs', {})
-                user_cancel_msgs[order_id] = {
-                    'chat_id': user_id, 'message_id': sent_cancel.message_id}
+                await workflow.put('user_cancel_msgs', order_id, {
+                    'chat_id': user_id, 'message_id': sent_cancel.message_id})
             except Exception:
                 pass
 
             # Clean up pending order
-            del context.bot_data[f'pending_order_{user_id}']
+            await workflow.pop('pending_order', user_id)
 
         except Exception as e:
             logger.warning(f"Failed to notify user after location accept: {e}")
     else:
         try:
             await query.edit_message_text(f"Location for user {user_id} rejected. No sync will occur.")
-            await context.bot.send_message(chat_id=user_id, text="❌ Your location was rejected by the admin. Please upload a different location or cancel your order.")
+            outbox.post('send_message', chat_id=user_id, text="❌ Your location was rejected by the admin. Please upload a different location or cancel your order.")
         except Exception as e:
             logger.warning(f"Failed to notify user after location reject: {e}")
     return ConversationHandler.END
@@ -2291,6 +2112,7 @@ async def dev_set_loc(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Update all blocks
         for k in BLOCKS:
             BLOCKS[k] = (lat, lon)
+        rebuild_places()
 
         await update.message.reply_text(
             f"✅ **Test Environment Updated!**\n\n"
@@ -2312,6 +2134,12 @@ LOCATION_UPDATE_INTERVAL = 5  # seconds
 last_location_update = {}
 
 
+async def _set_relay_message(deliverer_id, order_id, message_id):
+    """Records the customer-side live-location message, unless the relay was removed or moved to another order meanwhile."""
+    await workflow.update('tracking_relays', deliverer_id, lambda relay: (
+        {**relay, 'message_id': message_id} if relay and relay.get('order_id') == order_id else relay))
+
+
 async def relay_location_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Catches edited messages (Live Location updates) and relays them to the other party, with rate limiting.
@@ -2320,77 +2148,78 @@ async def relay_location_updates(update: Update, context: ContextTypes.DEFAULT_T
     msg = update.effective_message
 
     if not msg or not msg.location:
-        print(
-            f"DEBUG: relay_location_updates called but no location found. Update: {update.to_dict()}")
+        logger.debug(f"relay_location_updates called without a location: {update.update_id}")
         return
 
     chat_id = msg.chat_id
     sender_id = msg.from_user.id
     lat = msg.location.latitude
     lon = msg.location.longitude
-    print(
-        f"DEBUG: Location update from {sender_id} in chat {chat_id}: {lat}, {lon}")
+    logger.debug(f"Location update from {sender_id} in chat {chat_id}: {lat}, {lon}")
     # Store latest user location in bot_data for on-demand admin requests
-    context.bot_data[f'latest_location_{sender_id}'] = {
-        'lat': lat, 'lon': lon, 'timestamp': time.time()}
+    ephemeral = EphemeralStore(context.bot_data)
+    ephemeral.set('latest_location', sender_id, {
+        'lat': lat, 'lon': lon, 'timestamp': time.time()})
 
     # --- IMPROVEMENT: Update active orders with better location ---
+    # order_id -> (order, customer, deliverer) from the one joined query, reused by the arrival check below
+    contexts = {}
     if sender_id != ADMIN_CHAT_ID:  # If it's a user
         try:
-            active_orders = get_user_active_orders(sender_id)
+            # One joined query gives order, customer and deliverer for every active order
+            active_orders = await db.get_active_order_context(sender_id)
             if active_orders:
-                for oid in active_orders:
+                for order, user, deliverer in active_orders:
+                    oid = order.order_id
+                    contexts[oid] = (order, user, deliverer)
+                    # Buffered in memory; flush_locations_job writes it out in batches
                     update_order_location(oid, lat, lon)
-                    print(f"DEBUG: Updated location for Order #{oid} in DB")
+                    active_deliveries.add(oid, lat, lon)
+                    logger.debug(f"Buffered location for order #{oid}")
                     
                     # Notify admin group with details to avoid confusion
-                    last_info_time = context.bot_data.get(f'last_info_update_{oid}', 0)
+                    last_info_time = ephemeral.get('last_info_update', oid, 0)
                     if time.time() - last_info_time > 20: # throttled to 20s
-                        user = get_user(sender_id)
-                        order = get_order(oid)
                         deliverer_name = "Not Assigned"
-                        if order and order[2]:
-                            deliverer = get_user(order[2])
+                        if order.deliverer_id:
                             if deliverer:
-                                deliverer_name = f"{deliverer[2]} (@{deliverer[1]})"
+                                deliverer_name = f"{deliverer.name} (@{deliverer.username})"
                             else:
-                                deliverer_name = f"Admin {order[2]}"
+                                deliverer_name = f"Admin {order.deliverer_id}"
                         
                         info_msg = (
                             f"📍 **Live Tracking Update**\n"
-                            f"👤 **Customer:** {user[2] if user else 'Unknown'} (@{user[1] if user else '?'})\n"
-                            f"📞 **Phone:** {user[6] if user else 'N/A'}\n"
+                            f"👤 **Customer:** {user.name if user else 'Unknown'} (@{user.username if user else '?'})\n"
+                            f"📞 **Phone:** {user.phone if user else 'N/A'}\n"
                             f"📦 **Order:** #{oid}\n"
                             f"🚚 **Deliverer:** {deliverer_name}\n"
                             f"🌐 [View Position](https://www.google.com/maps/search/?api=1&query={lat},{lon})"
                         )
                         # Try to edit the existing status message instead of spamming new ones
-                        info_id_key = f'last_info_msg_id_{oid}'
-                        last_msg_id = context.bot_data.get(info_id_key)
+                        last_msg_id = ephemeral.get('last_info_msg_id', oid)
 
                         if last_msg_id:
                             try:
-                                await context.bot.edit_message_text(chat_id=ADMIN_CHAT_ID, message_id=last_msg_id, text=info_msg, parse_mode='Markdown')
+                                await outbox.edit_message_text(chat_id=ADMIN_CHAT_ID, message_id=last_msg_id, text=info_msg, parse_mode='Markdown', priority=PRIORITY_TRACKING)
                             except Exception:
                                 # If edit fails (e.g. deleted), send new
-                                sent = await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=info_msg, parse_mode='Markdown')
-                                context.bot_data[info_id_key] = sent.message_id
+                                sent = await outbox.send_message(chat_id=ADMIN_CHAT_ID, text=info_msg, parse_mode='Markdown', priority=PRIORITY_TRACKING)
+                                ephemeral.set('last_info_msg_id', oid, sent.message_id)
                         else:
-                            sent = await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=info_msg, parse_mode='Markdown')
-                            context.bot_data[info_id_key] = sent.message_id
+                            sent = await outbox.send_message(chat_id=ADMIN_CHAT_ID, text=info_msg, parse_mode='Markdown', priority=PRIORITY_TRACKING)
+                            ephemeral.set('last_info_msg_id', oid, sent.message_id)
                         
-                        context.bot_data[f'last_info_update_{oid}'] = time.time()
+                        ephemeral.set('last_info_update', oid, time.time())
             else:
                  # Check if recently completed order exists (linger detection)
                  # We warn if user is sharing location but has no active orders.
                  # This check should be throttled to avoid spamming admin.
-                 linger_key = f"linger_warn_{sender_id}"
-                 last_warn = context.bot_data.get(linger_key, 0)
+                 last_warn = ephemeral.get('linger_warn', sender_id, 0)
                  if time.time() - last_warn > 300: # Warn every 5 minutes max
-                     user = get_user(sender_id)
+                     user = await db.get_user(sender_id)
                      if user:
-                        name = user[2]
-                        phone = user[6] or "N/A"
+                        name = user.name
+                        phone = user.phone or "N/A"
                         warn_msg = (
                             f"⚠️ **Lingering Live Location Detected**\n"
                             f"User: {name} (ID: {sender_id})\n"
@@ -2398,137 +2227,134 @@ async def relay_location_updates(update: Update, context: ContextTypes.DEFAULT_T
                             f"Is sharing live location but has NO active orders.\n"
                             f"Please contact them to stop sharing."
                         )
-                        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=warn_msg, parse_mode='Markdown')
-                        context.bot_data[linger_key] = time.time()
+                        outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=warn_msg, parse_mode='Markdown')
+                        ephemeral.set('linger_warn', sender_id, time.time())
 
         except Exception as e:
-            print(f"DEBUG: Failed to update order location in DB: {e}")
+            logger.warning(f"Failed to update order location: {e}")
 
     # --- Rate limiting logic ---
     now = time.time()
     key = f"{chat_id}:{sender_id}"
     last = last_location_update.get(key, 0)
     if now - last < LOCATION_UPDATE_INTERVAL:
-        print(f"DEBUG: Rate limit hit for {key}, skipping update.")
+        logger.debug(f"Rate limit hit for {key}, skipping update.")
         return
     last_location_update[key] = now
 
     # --- New: If location is sent in the admin group, relay to user ---
     # Check if we have a relay set up for this user (explicit mapping from admin_accept_order)
-    relays = context.bot_data.get('tracking_relays', {})
-    print(f"DEBUG: Current relays keys: {list(relays.keys())}")
+    target = await workflow.get('tracking_relays', sender_id)
 
-    if sender_id in relays:
-        target = relays[sender_id]
+    if target:
         user_id = target.get('chat_id')
         order_id = target.get('order_id')
 
         # 1. Relay Location
         try:
-            print(f"DEBUG: Relaying to {user_id}")
+            logger.debug(f"Relaying location to {user_id}")
             # If target has a message_id we can edit the live location, otherwise send a new location
             if target.get('message_id'):
-                await context.bot.edit_message_live_location(
+                await outbox.edit_live_location(
                     chat_id=user_id,
                     message_id=target['message_id'],
                     latitude=lat,
                     longitude=lon
                 )
             else:
-                sent = await context.bot.send_location(
+                sent = await outbox.send_location(
                     chat_id=user_id,
                     latitude=lat,
                     longitude=lon,
-                    live_period=3600
+                    live_period=3600,
+                    priority=PRIORITY_TRACKING
                 )
                 # store the message_id so subsequent updates can edit instead of sending new messages
-                target['message_id'] = sent.message_id
+                await _set_relay_message(sender_id, order_id, sent.message_id)
         except Exception as e:
             # If edit fails (e.g. message deleted), reset ID to send new one next time
-            print(f"DEBUG: Failed to relay location: {e}")
-            target['message_id'] = None
+            logger.warning(f"Failed to relay location: {e}")
+            await _set_relay_message(sender_id, order_id, None)
 
         # 2. Check for Arrival (Distance < 150m)
+        # Order and customer come from the joined query above when the deliverer holds the order.
+        # Otherwise, orders in the delivery index are only loaded once the deliverer is inside the radius.
+        order_ctx = contexts.get(order_id)
         try:
-            from database import get_order, get_user
-            order = get_order(order_id)
-            if order:
+            if order_ctx is None and (order_id not in active_deliveries or order_id in dict(deliveries_within(lat, lon, 150))):
+                order_ctx = await db.get_order_context(order_id)
+            if order_ctx:
+                order, customer, _ = order_ctx
                 # user location from order
-                user_lat = order[11]
-                user_lon = order[12]
+                user_lat = order.delivery_lat
+                user_lon = order.delivery_lon
 
                 if user_lat is not None and user_lon is not None:
                     distance = haversine(lat, lon, user_lat, user_lon)
                     if distance < 150:
-                        notified_key = f"arrived_{order_id}"
-                        if not context.bot_data.get(notified_key):
-                            await context.bot.send_message(
+                        # Only the first transition to 'arrived' notifies, on whichever worker gets there first
+                        if await db.transition_order(order_id, 'arrived'):
+                            outbox.post(
+                                'send_message',
                                 chat_id=user_id,
                                 text="Your food has arrived! You will shortly receive a call from our agents."
                             )
 
-                            user = get_user(user_id)
-                            phone = user[5] if user and len(
-                                user) > 5 else "(unknown)"
+                            phone = customer.phone if customer and customer.phone else "(unknown)"
 
                             kb = InlineKeyboardMarkup([
                                 [InlineKeyboardButton(
-                                    "Yes", callback_data=f"admin_seen_user_{order_id}_{user_id}")]
+                                    "Yes", callback_data=pack('admin_seen_user', order_id, user_id))]
                             ])
-                            await context.bot.send_message(
+                            outbox.post(
+                                'send_message',
                                 chat_id=ADMIN_CHAT_ID,
                                 text=f"You are < 50m from the user for order #{order_id}. Please call {phone}.\nDo you see the user? Click 'Yes' when you have seen the receiver.",
                                 reply_markup=kb
                             )
-                            context.bot_data[notified_key] = True
         except Exception as e:
-            print(f"DEBUG: Error in arrival check: {e}")
+            logger.warning(f"Error in arrival check: {e}")
 
             # --- New: Check if admin is within 50m of user ---
             # Get order info
             order_id = target.get('order_id')
-            if order_id:
-                from database import get_order, get_user
-                order = get_order(order_id)
+            if order_id and order_ctx:
+                order, user, _ = order_ctx
                 if order:
-                    user_id = order[1]  # customer_id
-                    user = get_user(user_id)
-                    user_lat = order[11]  # delivery_lat
-                    user_lon = order[12]  # delivery_lon
+                    user_id = order.customer_id
+                    user_lat = order.delivery_lat
+                    user_lon = order.delivery_lon
                     if user_lat is not None and user_lon is not None:
                         # Calculate distance
                         distance = haversine(lat, lon, user_lat, user_lon)
                         if distance < 50:
                             # Notify user if not already notified
-                            notified_key = f"arrived_{order_id}"
-                            if not context.bot_data.get(notified_key):
+                            if await db.transition_order(order_id, 'arrived'):
                                 # Notify user
-                                await context.bot.send_message(
+                                outbox.post(
+                                    'send_message',
                                     chat_id=user_id,
                                     text="Your food has arrived! You will shortly receive a call from our agents."
                                 )
                                 # Alert admin in group with phone number
-                                phone = user[5] if user and len(
-                                    user) > 5 else "(unknown)"
-                                await context.bot.send_message(
+                                phone = user.phone if user and user.phone else "(unknown)"
+                                outbox.post(
+                                    'send_message',
                                     chat_id=ADMIN_CHAT_ID,
                                     text=f"You are < 50m from the user for order #{order_id}. Please call {phone}."
                                 )
-                                context.bot_data[notified_key] = True
         except Exception as e:
             logger.warning(f"Failed to relay location: {e}")
-            print(f"DEBUG: Failed to relay: {e}")
     else:
-        print("DEBUG: No relay found for this sender")
+        logger.debug(f"No relay found for {sender_id}")
 
     # Also send/update the customer's live location to the admin/channel
     try:
         if ADMIN_CHAT_ID:
-            admin_live = context.bot_data.setdefault('admin_live', {})
-            admin_entry = admin_live.get(sender_id)
+            admin_entry = await workflow.get('admin_live', sender_id)
             if admin_entry and admin_entry.get('message_id'):
                 try:
-                    await context.bot.edit_message_live_location(
+                    await outbox.edit_live_location(
                         chat_id=ADMIN_CHAT_ID,
                         message_id=admin_entry['message_id'],
                         latitude=lat,
@@ -2536,60 +2362,45 @@ async def relay_location_updates(update: Update, context: ContextTypes.DEFAULT_T
                     )
                 except Exception:
                     # If edit fails (message might be gone), send a new live location
-                    sent = await context.bot.send_location(chat_id=ADMIN_CHAT_ID, latitude=lat, longitude=lon, live_period=3600)
-                    admin_live[sender_id] = {'message_id': sent.message_id}
+                    sent = await outbox.send_location(chat_id=ADMIN_CHAT_ID, latitude=lat, longitude=lon, live_period=3600, priority=PRIORITY_TRACKING)
+                    await workflow.put('admin_live', sender_id, {'message_id': sent.message_id})
             else:
-                sent = await context.bot.send_location(chat_id=ADMIN_CHAT_ID, latitude=lat, longitude=lon, live_period=3600)
-                admin_live[sender_id] = {'message_id': sent.message_id}
+                sent = await outbox.send_location(chat_id=ADMIN_CHAT_ID, latitude=lat, longitude=lon, live_period=3600, priority=PRIORITY_TRACKING)
+                await workflow.put('admin_live', sender_id, {'message_id': sent.message_id})
     except Exception as e:
         logger.warning(f"Failed to send/update admin live location: {e}")
 
 
-async def cancel_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cancel_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id=None):
     """Callback when user presses Cancel Order — prompt them to re-enter their full name."""
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id if query.from_user else (
         query.message.chat_id if query.message else None)
     # Prevent cancellation if order already locked (user already confirmed purchase)
-    parts = query.data.split("_")
-    order_id = None
-    # Data format: cancel_order_{order_id} -> ["cancel", "order", "123"]
-    if len(parts) >= 3:
-        try:
-            order_id = int(parts[2])
-        except Exception:
-            order_id = None
-
-    order_locked = context.bot_data.get('order_locked', {})
-    if order_id and order_locked.get(order_id):
-        await context.bot.send_message(chat_id=user_id, text="This order is already confirmed and cannot be cancelled.")
+    order = await db.get_order(order_id) if order_id else None
+    if order and order.status not in ('pending', 'accepted', 'about_to_pay'):
+        outbox.post('send_message', chat_id=user_id, text="This order is already confirmed and cannot be cancelled.")
         return
 
     # If admin has already indicated they're about to pay / purchase, refuse cancellation
-    admin_orders = context.bot_data.get('admin_orders', {})
-    admin_entry = admin_orders.get(order_id)
-    if admin_entry and admin_entry.get('about_to_pay'):
+    if order and order.status == 'about_to_pay':
         # Inform user that the package has already been purchased or is in process
-        try:
-            await context.bot.send_message(chat_id=user_id, text=(
-                "We're sorry — the package has already been (or is being) purchased. Backing out now is not allowed and may lead to a ban.\n"
-                "For support contact: @callowned or call +251936250347"))
-        except Exception:
-            pass
+        outbox.post('send_message', chat_id=user_id, text=(
+            "We're sorry — the package has already been (or is being) purchased. Backing out now is not allowed and may lead to a ban.\n"
+            "For support contact: @callowned or call +251936250347"))
         return
 
     # Remove admin live-location message (if any) so the user loses the admin live display
     try:
-        admin_live = context.bot_data.get('admin_live', {})
-        admin_entry = admin_live.get(user_id)
+        admin_entry = await workflow.get('admin_live', user_id)
         if admin_entry and admin_entry.get('message_id'):
             try:
                 await context.bot.delete_message(chat_id=ADMIN_CHAT_ID, message_id=admin_entry['message_id'])
             except Exception:
                 pass
             # remove mapping
-            del admin_live[user_id]
+            await workflow.pop('admin_live', user_id)
     except Exception:
         pass
 
@@ -2597,38 +2408,29 @@ async def cancel_order_callback(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton(
-                "Yes, Cancel Order", callback_data=f"confirm_cancel_order_{order_id}")],
+                "Yes, Cancel Order", callback_data=pack('confirm_cancel_order', order_id))],
             [InlineKeyboardButton(
-                "No, Keep Order", callback_data=f"keep_order_{order_id}")]
+                "No, Keep Order", callback_data=pack('keep_order', order_id))]
         ])
-        await context.bot.send_message(chat_id=user_id, text=(
+        outbox.post('send_message', chat_id=user_id, text=(
             "Order cancellation selected. Note: cancellation is only possible if the item has NOT yet been purchased.\n"
             "Are you sure you want to cancel this order?"), reply_markup=kb)
     except Exception:
         pass
 
 
-async def confirm_cancel_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def confirm_cancel_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id):
     """User confirmed cancellation."""
     query = update.callback_query
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 4:
-        # Just ignore or log
-        return
-    order_id = int(parts[3])
     user_id = query.from_user.id
 
-    # Double check lock
-    order_locked = context.bot_data.get('order_locked', {})
-    if order_locked.get(order_id):
-        await query.edit_message_text("Too late! The order is already confirmed/purchased.")
-        return
-
-    # Mark as cancelled in DB
+    # Cancelling and confirming are both status transitions, so only one of them can win
     try:
-        from database import update_order_status
-        update_order_status(order_id, 'cancelled')
+        if not await db.transition_order(order_id, 'cancelled'):
+            await query.edit_message_text("Too late! The order is already confirmed/purchased.")
+            return
+        EphemeralStore(context.bot_data).evict_order(order_id)
     except Exception as e:
         logger.error(f"Failed to cancel order in DB: {e}")
 
@@ -2637,20 +2439,21 @@ async def confirm_cancel_order_callback(update: Update, context: ContextTypes.DE
 
     # Notify Admin Group & Update Admin Message
     try:
-        admin_orders = context.bot_data.get('admin_orders', {})
-        admin_entry = admin_orders.get(order_id)
+        admin_entry = await workflow.get('admin_orders', order_id)
         if admin_entry and admin_entry.get('message_id'):
             # Update the original admin message to show CANCELLED
             try:
                 # We need to fetch the original text or reconstruct it.
                 # Since we can't easily fetch the text without an API call, let's try to edit it.
                 # We'll just append "❌ CANCELLED BY USER" and remove buttons.
-                await context.bot.edit_message_reply_markup(
+                outbox.post(
+                    'edit_message_reply_markup',
                     chat_id=ADMIN_CHAT_ID,
                     message_id=admin_entry['message_id'],
                     reply_markup=None  # Remove buttons
                 )
-                await context.bot.send_message(
+                outbox.post(
+                    'send_message',
                     chat_id=ADMIN_CHAT_ID,
                     text=f"❌ **ORDER #{order_id} CANCELLED**\nThe user has cancelled this order.",
                     reply_markup=None,
@@ -2661,7 +2464,8 @@ async def confirm_cancel_order_callback(update: Update, context: ContextTypes.DE
                     f"Failed to update admin message on cancel: {e}")
         else:
             # Fallback if we don't have the message ID
-            await context.bot.send_message(
+            outbox.post(
+                'send_message',
                 chat_id=ADMIN_CHAT_ID,
                 text=f"❌ **ORDER #{order_id} CANCELLED**\nThe user has cancelled this order."
             )
@@ -2669,88 +2473,74 @@ async def confirm_cancel_order_callback(update: Update, context: ContextTypes.DE
         logger.error(f"Failed to notify admin of cancellation: {e}")
 
 
-async def keep_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def keep_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id=None):
     query = update.callback_query
     await query.answer()
     await query.edit_message_text("Order kept. Thank you!")
 
 
-async def about_to_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def about_to_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, customer_id=None):
     """Admin clicked 'I'm about to pay' — ask customer to confirm purchase."""
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
         await query.answer("Unauthorized action.", show_alert=True)
         return
     await query.answer()
-    parts = query.data.split("_")
-    # Expected format: about_to_pay_{order_id}_{user_id}
-    # parts: ['about', 'to', 'pay', order_id, user_id]
-    if len(parts) < 5:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    order_id = int(parts[3])
-    customer_id = int(parts[4]) if len(parts) > 4 else None
-
-    # find admin order entry for later edits and check accepted state
-    admin_orders = context.bot_data.setdefault('admin_orders', {})
-    admin_entry = admin_orders.get(order_id)
 
-    # --- RECOVERY: Check DB if memory is lost (e.g. restart) ---
-    if not admin_entry:
-        from database import get_order
-        order = get_order(order_id)  # (id, cust, deliverer, ...)
-        # If order has a deliverer_id (index 2), it is accepted
-        if order and order[2]:
-            # Re-populate memory from DB + current message context
-            admin_orders[order_id] = {
-                'accepted': True,
-                'admin_id': order[2],
-                'message_id': query.message.message_id
-            }
-            admin_entry = admin_orders[order_id]
-
-    admin_msg_id = admin_entry.get('message_id') if admin_entry else None
-
-    # Ensure admin already accepted the order before initiating about-to-pay
-    if not admin_entry or not admin_entry.get('accepted'):
+    # Ensure admin already accepted the order before initiating about-to-pay.
+    # Pressing it again while waiting for the customer re-sends the request.
+    order = await db.get_order(order_id)
+    if not order or order.status not in ('accepted', 'about_to_pay'):
         try:
-            await query.answer(text="Please mark the order as received first.", show_alert=True)
+            if order and order.status != 'pending':
+                await query.answer(text=f"Order #{order_id} is already {order.status}.", show_alert=True)
+            else:
+                await query.answer(text="Please mark the order as received first.", show_alert=True)
         except Exception:
             pass
         return
     # mark that admin is about to pay
-    admin_entry['about_to_pay'] = True
+    await db.transition_order(order_id, 'about_to_pay', expected=('accepted',))
+
+    # find admin order entry for later edits; re-populate it from the order if it is lost (e.g. after a reset)
+    admin_entry = await workflow.get('admin_orders', order_id)
+    if not admin_entry:
+        admin_entry = {
+            'accepted': True,
+            'admin_id': order.deliverer_id,
+            'message_id': order.admin_message_id or query.message.message_id
+        }
+        await workflow.add('admin_orders', order_id, admin_entry)
+    admin_msg_id = admin_entry.get('message_id')
 
     # Send confirmation request to customer
     if customer_id:
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton(
-                "Confirm Purchase", callback_data=f"user_confirm_{order_id}_{admin_msg_id}")],
+                "Confirm Purchase", callback_data=pack('user_confirm', order_id, admin_msg_id))],
             [InlineKeyboardButton(
-                "Cancel Purchase", callback_data=f"user_cancel_purchase_{order_id}_{admin_msg_id}")]
+                "Cancel Purchase", callback_data=pack('user_cancel_purchase', order_id, admin_msg_id))]
         ])
         try:
             # First, notify the user that the deliverer is about to purchase and cancel button will be removed
             try:
                 # Remove user's cancel-button message if present
-                user_cancel_msgs = context.bot_data.get('user_cancel_msgs', {})
-                uentry = user_cancel_msgs.get(order_id)
+                # pop() so only one worker deletes it
+                uentry = await workflow.pop('user_cancel_msgs', order_id)
                 if uentry:
                     try:
                         await context.bot.delete_message(chat_id=uentry['chat_id'], message_id=uentry['message_id'])
                     except Exception:
                         pass
-                    # remove stored mapping
-                    del user_cancel_msgs[order_id]
             except Exception:
                 pass
 
-            await context.bot.send_message(chat_id=customer_id, text=(
-                "The deliverer/admin has indicated they're about to purchase your order. The package will be purchased and sent — cancellation will not be available after purchase."))
+            outbox.post('send_message', chat_id=customer_id, text=(
+                "The deliverer/admin has indicated they're about to purchase your order. The package will be purchased and sent — cancellation will not be available after purchase."), priority=PRIORITY_PAYMENT)
 
             # Then send the confirm/cancel inline keyboard
-            await context.bot.send_message(chat_id=customer_id, text=(
-                "Do you confirm the purchase?\nIf you confirm, cancellation will no longer be possible."), reply_markup=kb)
+            outbox.post('send_message', chat_id=customer_id, text=(
+                "Do you confirm the purchase?\nIf you confirm, cancellation will no longer be possible."), reply_markup=kb, priority=PRIORITY_PAYMENT)
         except Exception as e:
             logger.warning(f"Failed to send confirm request to customer: {e}")
 
@@ -2769,20 +2559,19 @@ async def about_to_pay_callback(update: Update, context: ContextTypes.DEFAULT_TY
         pass
 
 
-async def user_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def user_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, admin_msg_id=None):
     query = update.callback_query
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 3:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    order_id = int(parts[2])
-    admin_msg_id = int(parts[3]) if len(
-        parts) > 3 and parts[3].isdigit() else None
 
-    # Lock the order to prevent cancellation
-    order_locked = context.bot_data.setdefault('order_locked', {})
-    order_locked[order_id] = True
+    # Lock the order to prevent cancellation. Loses to a cancel that got in first.
+    if not await db.transition_order(order_id, 'confirmed', expected=('about_to_pay',)):
+        order = await db.get_order(order_id)
+        if not order or order.status not in ('confirmed', 'arrived', 'paid', 'complete'):
+            try:
+                await query.edit_message_text("This order can no longer be confirmed.")
+            except Exception:
+                pass
+            return
 
     # Notify customer
     try:
@@ -2794,44 +2583,34 @@ async def user_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         if admin_msg_id:
             # 1. Fetch Data to reconstruct message
-            order = get_order(order_id)
+            order = await db.get_order(order_id)
             if not order:
                 await query.edit_message_text("❌ Error: Order data not found (Session Expired). The server may have restarted. Please check with the deliverer directly or re-order.")
                 return
 
-            customer_id = order[1]
-            customer = get_user(customer_id)
+            customer_id = order.customer_id
+            customer = await db.get_user(customer_id)
 
-            restaurant = order[3]
-            items = order[4]
-            price = order[5]
-            type_val = order[7]
-            code = order[8]
+            restaurant = order.restaurant
+            items = order.items
+            price = order.total_price
+            type_val = order.order_type
+            code = order.verification_code
 
             msg_text = (f"🆕 New Order #{order_id}\n"
                         f"Type: {type_val}\n"
-                        f"Customer: {customer[2]} (@{customer[1]})\n"
-                        f"Student ID: {customer[3]}\n"
-                        f"Block/Dorm: {customer[4]} / {customer[5]}\n"
-                        f"Phone: {customer[6]}\n"
+                        f"Customer: {customer.name} (@{customer.username})\n"
+                        f"Student ID: {customer.student_id}\n"
+                        f"Block/Dorm: {customer.block} / {customer.dorm_number}\n"
+                        f"Phone: {customer.phone}\n"
                         f"Restaurant: {restaurant}\n"
                         f"Item: {items} | Price: {price} ETB\n"
                         f"Verification Code: {code}")
 
             # 2. Append Admin Accept Status
-            admin_orders = context.bot_data.get('admin_orders', {})
-            admin_entry = admin_orders.get(order_id)
+            admin_entry = await workflow.get('admin_orders', order_id)
             if admin_entry and admin_entry.get('accepted'):
-                admin_name = "Admin"
-                if 'admin_id' in admin_entry:
-                    try:
-                        # Try to fetch member to get name, or use cached if we had it (we don't)
-                        # We'll just use "an Admin" if we can't get the name easily without an extra call
-                        # But let's try the call, it's async
-                        member = await context.bot.get_chat_member(ADMIN_CHAT_ID, admin_entry['admin_id'])
-                        admin_name = member.user.first_name
-                    except:
-                        pass
+                admin_name = admin_directory.name(admin_entry.get('admin_id'), "Admin")
                 msg_text += f"\n\n✅ Marked as received by {admin_name}."
 
             # 3. Append User Confirm Status
@@ -2840,14 +2619,15 @@ async def user_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TY
             # 4. Rebuild Keyboard (Keep all functionalities)
             request_location_kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("Request Updated Location",
-                                      callback_data=f"admin_request_location_{order_id}_{customer_id}")],
+                                      callback_data=pack('admin_request_location', order_id, customer_id))],
                 [InlineKeyboardButton(
-                    "I'm about to pay", callback_data=f"about_to_pay_{order_id}_{customer_id}")],
+                    "I'm about to pay", callback_data=pack('about_to_pay', order_id, customer_id))],
                 [InlineKeyboardButton("⚠️ Force Arrival Notify",
-                                      callback_data=f"force_arrival_{order_id}_{customer_id}")]
+                                      callback_data=pack('force_arrival', order_id, customer_id))]
             ])
 
-            await context.bot.edit_message_text(
+            outbox.post(
+                'edit_message_text',
                 chat_id=ADMIN_CHAT_ID,
                 message_id=admin_msg_id,
                 text=msg_text,
@@ -2857,53 +2637,42 @@ async def user_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TY
         logger.warning(f"Failed to update admin message on confirm: {e}")
 
 
-async def user_cancel_purchase_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def user_cancel_purchase_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, admin_msg_id=None):
     query = update.callback_query
     await query.answer()
-    parts = query.data.split("_")
-    if len(parts) < 3:
-        await query.edit_message_text("Invalid callback data.")
-        return
-    order_id = int(parts[2])
-    admin_msg_id = int(parts[3]) if len(
-        parts) > 3 and parts[3].isdigit() else None
+
+    # Back to accepted: the deliverer can press "I'm about to pay" again
+    await db.transition_order(order_id, 'accepted', expected=('about_to_pay',))
 
     # Update admin message to show red light, BUT preserve details and buttons
     try:
         if admin_msg_id:
             # 1. Fetch Data
-            order = get_order(order_id)
+            order = await db.get_order(order_id)
             if order:
-                customer_id = order[1]
-                customer = get_user(customer_id)
+                customer_id = order.customer_id
+                customer = await db.get_user(customer_id)
 
-                restaurant = order[3]
-                items = order[4]
-                price = order[5]
-                type_val = order[7]
-                code = order[8]
+                restaurant = order.restaurant
+                items = order.items
+                price = order.total_price
+                type_val = order.order_type
+                code = order.verification_code
 
                 msg_text = (f"🆕 New Order #{order_id}\n"
                             f"Type: {type_val}\n"
-                            f"Customer: {customer[1]} (tg id: {customer[0]})\n"
-                            f"Student ID: {customer[2]}\n"
-                            f"Block/Dorm: {customer[3]} / {customer[4]}\n"
-                            f"Phone: {customer[5]}\n"
+                            f"Customer: {customer.name} (tg id: {customer.user_id})\n"
+                            f"Student ID: {customer.student_id}\n"
+                            f"Block/Dorm: {customer.block} / {customer.dorm_number}\n"
+                            f"Phone: {customer.phone}\n"
                             f"Restaurant: {restaurant}\n"
                             f"Item: {items} | Price: {price} ETB\n"
                             f"Verification Code: {code}")
 
                 # 2. Append Admin Accept Status
-                admin_orders = context.bot_data.get('admin_orders', {})
-                admin_entry = admin_orders.get(order_id)
+                admin_entry = await workflow.get('admin_orders', order_id)
                 if admin_entry and admin_entry.get('accepted'):
-                    admin_name = "Admin"
-                    if 'admin_id' in admin_entry:
-                        try:
-                            member = await context.bot.get_chat_member(ADMIN_CHAT_ID, admin_entry['admin_id'])
-                            admin_name = member.user.first_name
-                        except:
-                            pass
+                    admin_name = admin_directory.name(admin_entry.get('admin_id'), "Admin")
                     msg_text += f"\n\n✅ Marked as received by {admin_name}."
 
                 # 3. Append User Cancel Status
@@ -2912,14 +2681,15 @@ async def user_cancel_purchase_callback(update: Update, context: ContextTypes.DE
                 # 4. Rebuild Keyboard
                 request_location_kb = InlineKeyboardMarkup([
                     [InlineKeyboardButton("Request Updated Location",
-                                          callback_data=f"admin_request_location_{order_id}_{customer_id}")],
+                                          callback_data=pack('admin_request_location', order_id, customer_id))],
                     [InlineKeyboardButton(
-                        "I'm about to pay", callback_data=f"about_to_pay_{order_id}_{customer_id}")],
+                        "I'm about to pay", callback_data=pack('about_to_pay', order_id, customer_id))],
                     [InlineKeyboardButton("⚠️ Force Arrival Notify",
-                                          callback_data=f"force_arrival_{order_id}_{customer_id}")]
+                                          callback_data=pack('force_arrival', order_id, customer_id))]
                 ])
 
-                await context.bot.edit_message_text(
+                outbox.post(
+                    'edit_message_text',
                     chat_id=ADMIN_CHAT_ID,
                     message_id=admin_msg_id,
                     text=msg_text,
@@ -2932,48 +2702,39 @@ async def user_cancel_purchase_callback(update: Update, context: ContextTypes.DE
     # Send warning + acknowledge button to user
     try:
         kb = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("Acknowledge", callback_data=f"ack_cancel_{order_id}")]])
+            [[InlineKeyboardButton("Acknowledge", callback_data=pack('ack_cancel', order_id))]])
         await query.edit_message_text("You have chosen to cancel the purchase.\nPlease do not order if your intent is to cancel. Press Acknowledge to continue.", reply_markup=kb)
     except Exception:
         pass
 
 
-async def ack_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def ack_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id=None):
     query = update.callback_query
     await query.answer()
-    parts = query.data.split("_")
-    order_id = int(parts[2]) if len(parts) > 2 else None
     user_id = query.from_user.id if query.from_user else None
 
     # Send the standard done prompt
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="Acknowledged.\n\nTo place a new order, click: /order\nTo restart main menu, click: /start"
-        )
-    except Exception:
-        pass
+    outbox.post(
+        'send_message',
+        chat_id=user_id,
+        text="Acknowledged.\n\nTo place a new order, click: /order\nTo restart main menu, click: /start"
+    )
 
 
 async def clear_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Only allow admin group to use this command
     if update.effective_chat and update.effective_chat.id == ADMIN_CHAT_ID:
-        # Clear all order-related bot_data
-        context.bot_data['admin_orders'] = {}
-        context.bot_data['order_locked'] = {}
-        context.bot_data['tracking_relays'] = {}
-        context.bot_data['admin_live'] = {}
+        # Relays are read before the store is cleared so their messages can be deleted below
+        relays = await workflow.items('tracking_relays')
+        # Clear all order workflow state (shared by every worker)
+        await workflow.clear()
         # Interrupt all ongoing orders by ending all user conversations
         application = context.application
         for conv in application.conversation_conversations.values():
             for user_id, state in conv.items():
-                try:
-                    await application.bot.send_message(user_id, "Your order has been interrupted and cancelled by the admin.")
-                except Exception:
-                    pass
+                outbox.post('send_message', chat_id=user_id, text="Your order has been interrupted and cancelled by the admin.")
         application.conversation_conversations.clear()
         # Remove any active location sharing by deleting relay messages
-        relays = context.bot_data.get('tracking_relays', {})
         for admin_id, relay in relays.items():
             chat_id = relay.get('chat_id')
             message_id = relay.get('message_id')
@@ -2982,21 +2743,19 @@ async def clear_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await application.bot.delete_message(chat_id=chat_id, message_id=message_id)
                 except Exception:
                     pass
-        context.bot_data['tracking_relays'] = {}
         await update.message.reply_text("All previous and ongoing orders, including active location sharing, have been cleared and interrupted. Admins can start fresh.")
     else:
         await update.message.reply_text("You are not authorized to use this command.")
 
 
-async def restart_decision_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def restart_decision_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, reset):
     query = update.callback_query
     if update.effective_chat.id != ADMIN_CHAT_ID:
         await query.answer("Unauthorized action.", show_alert=True)
         return
     await query.answer()
-    data = query.data
 
-    if data == "restart_reset":
+    if reset:
         # Clear all data
         # Note: application.user_data might be read-only (mappingproxy) in some versions/contexts
         try:
@@ -3015,18 +2774,20 @@ async def restart_decision_callback(update: Update, context: ContextTypes.DEFAUL
         # bot_data is the most important one for order state
         context.application.bot_data.clear()
 
-        # Re-initialize default bot_data structures
-        context.bot_data.setdefault('tracking_relays', {})
-        context.bot_data.setdefault('admin_live', {})
-        context.bot_data.setdefault('admin_orders', {})
-        context.bot_data.setdefault('order_locked', {})
+        # Order workflow state lives outside bot_data; rebuild what the orders table still has in progress
+        await workflow.clear()
+        try:
+            load_active_deliveries(await recover_orders())
+        except Exception as e:
+            logger.warning(f"Could not recover active orders after reset: {e}")
 
-        # Force flush to persistence
-        await context.application.persistence.flush()
+        # Drop stored state (including users not loaded since the restart), then write the fresh bot_data
+        await context.application.persistence.reset()
+        await context.application.update_persistence()
 
-        await query.edit_message_text("✅ System reset. All data cleared. Ready for new orders.")
+        await query.edit_message_text("✅ System reset. Conversations and user states cleared; orders in progress were kept. Ready for new orders.")
 
-    elif data == "restart_resume":
+    else:
         await query.edit_message_text("▶️ System resumed. Previous state restored.")
 
 
@@ -3034,7 +2795,160 @@ async def my_id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     await update.message.reply_text(f"Your Telegram ID: <code>{user_id}</code>", parse_mode='HTML')
 
+async def refresh_banned_job(context: ContextTypes.DEFAULT_TYPE):
+    """Picks up bans made by other processes (e.g. a separately deployed creator bot)."""
+    try:
+        if await db.refresh_banned_ids():
+            logging.info("Banned user set reloaded.")
+    except Exception as e:
+        logging.warning(f"Banned user refresh failed: {e}")
+
+
+async def refresh_admins_job(context: ContextTypes.DEFAULT_TYPE):
+    """Re-reads the admin directory, in case an invalidation was missed."""
+    try:
+        await db.run(admin_directory.reload)
+    except Exception as e:
+        logging.warning(f"Admin directory refresh failed: {e}")
+
+
+async def admin_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keeps admin display names current from member changes in the admin group."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        return
+    admin_directory.note(update.chat_member.new_chat_member.user)
+
+
+async def refresh_menu_job(context: ContextTypes.DEFAULT_TYPE):
+    """Rebuilds menu keyboards when item availability was toggled from the creator bot."""
+    try:
+        if await db.run(catalog.refresh):
+            logging.info("Menu availability reloaded.")
+    except Exception as e:
+        logging.warning(f"Menu availability refresh failed: {e}")
+
+
+async def flush_locations_job(context: ContextTypes.DEFAULT_TYPE):
+    """Writes buffered live-location positions to the orders table in one transaction."""
+    try:
+        await db.flush_order_locations()
+    except Exception as e:
+        logging.warning(f"Location flush failed, will retry: {e}")
+
+
+async def sweep_ephemeral_job(context: ContextTypes.DEFAULT_TYPE):
+    """Expires short-lived bot_data and workflow state and drops state belonging to finished orders."""
+    ephemeral = EphemeralStore(context.bot_data)
+    removed = ephemeral.sweep()
+
+    # Backstop for orders that finished without going through the normal cleanup path
+    try:
+        removed += await workflow.sweep()
+        workflow_ids = await workflow.order_ids()
+        order_ids = ephemeral.order_ids() | workflow_ids
+        if order_ids:
+            statuses = await db.get_order_statuses(order_ids)
+            for oid in order_ids:
+                # Deleted orders are gone from the table, so a missing status counts as finished too
+                if statuses.get(oid) in (None, 'complete', 'cancelled'):
+                    removed += ephemeral.evict_order(oid)
+                    if oid in workflow_ids:
+                        removed += await workflow.forget_order(oid)
+    except Exception as e:
+        logging.warning(f"Ephemeral order check failed: {e}")
+
+    # Rebuild the delivery index so finished orders drop out and orders from other paths show up
+    try:
+        load_active_deliveries(await db.get_active_orders())
+    except Exception as e:
+        logging.warning(f"Active delivery index refresh failed: {e}")
+
+    # The relay rate limiter only needs the last few seconds per sender
+    cutoff = time.time() - 10 * LOCATION_UPDATE_INTERVAL
+    for key in [k for k, t in last_location_update.items() if t < cutoff]:
+        del last_location_update[key]
+    outbox.prune_live()
+
+    if removed:
+        logging.info(f"Ephemeral sweep removed {removed} entries, {ephemeral.size()} left.")
+
+
+async def recover_orders():
+    """Rebuilds admin-message and relay entries for in-progress orders from the orders table.
+
+    All active orders come from one query. Entries still in the workflow store are left alone, since
+    they may carry newer message ids. Returns the active orders.
+    """
+    orders = await db.get_active_orders()
+    admin_orders = await workflow.items('admin_orders')
+    relays = await workflow.items('tracking_relays')
+    latest = {}
+    for order in sorted(orders, key=lambda o: o.created_at or 0):
+        if order.admin_message_id and order.order_id not in admin_orders:
+            await workflow.add('admin_orders', order.order_id, {
+                'message_id': order.admin_message_id, 'accepted': order.status != 'pending', 'admin_id': order.deliverer_id})
+        if order.deliverer_id and order.customer_id and order.status != 'pending':
+            # A deliverer relays to one customer at a time; the newest order wins, as when accepting
+            latest[order.deliverer_id] = order
+    for deliverer_id, order in latest.items():
+        if deliverer_id not in relays:
+            await workflow.add('tracking_relays', deliverer_id, {
+                'chat_id': order.customer_id, 'message_id': None, 'order_id': order.order_id})
+    return orders
+
+
+def register_metrics(application):
+    """Gauges and /debug/state sections read at scrape time from the Flask thread."""
+    bot_data = application.bot_data
+
+    def bot_data_counts():
+        counts = EphemeralStore(bot_data).counts()
+        counts['other'] = sum(1 for key in list(bot_data) if not (isinstance(key, str) and key.startswith('ephemeral:')))
+        return counts
+
+    def persisted():
+        return {kind: {'rows': rows, 'bytes': size} for kind, (rows, size) in database.get_persisted_sizes().items()}
+
+    def outbox_state():
+        return {**outbox.stats, 'queued': outbox.pending}
+
+    metrics.gauge('bedorme_bot_data_entries', 'bot_data entries per ephemeral namespace (other = remaining top-level keys).',
+                  ['namespace'], bot_data_counts)
+    metrics.gauge('bedorme_workflow_entries', 'Live workflow store entries per namespace.', ['namespace'], workflow.counts)
+    metrics.gauge('bedorme_persistence_rows', 'Persisted PTB state rows per kind.', ['kind'],
+                  lambda: {kind: v['rows'] for kind, v in persisted().items()})
+    metrics.gauge('bedorme_persistence_bytes', 'Pickled size of persisted PTB state per kind.', ['kind'],
+                  lambda: {kind: v['bytes'] for kind, v in persisted().items()})
+    metrics.gauge('bedorme_outbox_queued', 'Outgoing requests waiting in the outbox.', [], lambda: outbox.pending)
+    metrics.gauge('bedorme_outbox_events_total', 'Outbox sends, failures, 429 retries and coalesced live edits.', ['event'],
+                  lambda: dict(outbox.stats), kind='counter')
+    metrics.gauge('bedorme_invalidations_total', 'Cache invalidation listener polls, notifies and applied keys.', ['event'],
+                  lambda: dict(invalidation_listener.stats), kind='counter')
+    metrics.gauge('bedorme_user_cache_lookups_total', 'User cache hits and misses.', ['result'],
+                  lambda: {'hit': user_cache.hits, 'miss': user_cache.misses}, kind='counter')
+    processor = application.update_processor
+    metrics.gauge('bedorme_update_locks', 'Users with an update running or waiting for their previous one.', [],
+                  lambda: len(processor.locks))
+    metrics.gauge('bedorme_updates_total', 'Updates processed, and how many had to wait for the same user.', ['event'],
+                  lambda: dict(processor.stats), kind='counter')
+    metrics.gauge('bedorme_active_deliveries', 'Orders indexed for arrival checks.', [], lambda: len(active_deliveries))
+
+    metrics.state('bot_data', bot_data_counts)
+    metrics.state('workflow', workflow.counts)
+    metrics.state('persistence', persisted)
+    metrics.state('outbox', outbox_state)
+    metrics.state('invalidation', lambda: dict(invalidation_listener.stats))
+    metrics.state('user_cache', user_cache.stats)
+    metrics.state('active_deliveries', lambda: len(active_deliveries))
+    metrics.state('admin_directory', lambda: len(admin_directory))
+    metrics.state('updates', lambda: {**processor.stats, 'limit': processor.limit, 'locked_users': len(processor.locks)})
+
+
 async def post_init(application: Application):
+    # All outgoing sends/edits go through the rate-limited outbox
+    outbox.start(application.bot)
+    register_metrics(application)
+
     # Ensure we are not conflicting with any previously set webhook
     try:
         await application.bot.delete_webhook(drop_pending_updates=True)
@@ -3043,27 +2957,95 @@ async def post_init(application: Application):
 
     # Check database connectivity
     try:
-        from database import get_db_connection
-        conn = get_db_connection()
-        conn.close()
+        from database import db_connection
+        with db_connection() as conn:
+            conn.cursor().execute("SELECT 1")
         logging.info("Database connection verified.")
     except Exception as e:
         logging.error(f"Failed to connect to database on startup: {e}")
 
-    # Check if we have resumed state (bot_data is not empty)
-    # We check specific keys that indicate active state
-    if application.bot_data.get('admin_orders') or application.bot_data.get('admin_live'):
+    # Load banned users so check_banned never has to query for them
+    try:
+        banned_count = await db.load_banned_ids()
+        logging.info(f"Loaded {banned_count} banned user(s).")
+    except Exception as e:
+        logging.error(f"Failed to load banned users: {e}")
+    application.job_queue.run_repeating(refresh_banned_job, interval=BAN_REFRESH_INTERVAL, first=BAN_REFRESH_INTERVAL)
+
+    # Deliverer names and payout accounts, so callbacks never ask Telegram who an admin is
+    try:
+        admin_count = await db.run(admin_directory.reload)
+        logging.info(f"Loaded {admin_count} admin(s) into the directory.")
+    except Exception as e:
+        logging.error(f"Failed to load the admin directory: {e}")
+    application.job_queue.run_repeating(refresh_admins_job, interval=ADMIN_DIRECTORY_REFRESH_INTERVAL, first=ADMIN_DIRECTORY_REFRESH_INTERVAL)
+
+    # Item availability snapshot behind the prebuilt menu keyboards
+    try:
+        await db.run(catalog.reload)
+    except Exception as e:
+        logging.error(f"Failed to load item availability: {e}")
+    application.job_queue.run_repeating(refresh_menu_job, interval=MENU_REFRESH_INTERVAL, first=MENU_REFRESH_INTERVAL)
+
+    # Changes made by the creator bot (bans, admins, stock, user edits) arrive here within about a second.
+    # The version-counter jobs above stay as a slower backstop.
+    invalidation_listener.on('menu', catalog.reload)
+    invalidation_listener.on('admins', lambda user_ids: admin_directory.reload())
+    invalidation_listener.on('user', admin_directory.invalidate_users)
+    invalidation_listener.start()
+    application.job_queue.run_repeating(flush_locations_job, interval=LOCATION_FLUSH_INTERVAL, first=LOCATION_FLUSH_INTERVAL)
+
+    # Old flat f'{name}_{id}' keys from before the ephemeral store; move them so they expire too
+    moved = EphemeralStore(application.bot_data).migrate_flat_keys()
+    if moved:
+        logging.info(f"Moved {moved} legacy bot_data keys into the ephemeral store.")
+    # With the cached workflow backend, reads are answered from a copy of workflow_state made here
+    try:
+        loaded = await workflow.load()
+        if loaded is not None:
+            logging.info(f"Loaded {loaded} workflow row(s) into memory.")
+    except Exception as e:
+        logging.error(f"Failed to load workflow state: {e}")
+    # Order workflow state kept in bot_data by single-worker releases moves to the shared store
+    try:
+        moved = await workflow.import_bot_data(application.bot_data)
+        if moved:
+            logging.info(f"Moved {moved} bot_data workflow entries into the shared workflow store.")
+    except Exception as e:
+        logging.error(f"Failed to import workflow state from bot_data: {e}")
+    application.job_queue.run_repeating(sweep_ephemeral_job, interval=EPHEMERAL_SWEEP_INTERVAL, first=EPHEMERAL_SWEEP_INTERVAL)
+
+    # In-progress orders, read once: delivery points for arrival checks, and the admin-message and
+    # relay entries a reset or an emptied workflow store lost
+    active_orders = []
+    try:
+        active_orders = await recover_orders()
+        load_active_deliveries(active_orders)
+        logging.info(f"Recovered {len(active_orders)} order(s) in progress.")
+    except Exception as e:
+        logging.error(f"Failed to recover active orders: {e}")
+
+    # Check if we have resumed state (orders still in progress)
+    if active_orders:
+        summary = "\n".join(f"• #{o.order_id} {o.status.replace('_', ' ')}" for o in active_orders[:RECOVERY_LIST_MAX])
+        if len(active_orders) > RECOVERY_LIST_MAX:
+            summary += f"\n…and {len(active_orders) - RECOVERY_LIST_MAX} more"
         # Send message to admin
         keyboard = [
             [InlineKeyboardButton("Intentional (Reset Data)",
-                                  callback_data="restart_reset")],
+                                  callback_data=pack('restart', 1))],
             [InlineKeyboardButton("Unintentional (Resume)",
-                                  callback_data="restart_resume")]
+                                  callback_data=pack('restart', 0))]
         ]
         try:
-            await application.bot.send_message(
+            outbox.post(
+                'send_message',
                 chat_id=ADMIN_CHAT_ID,
-                text="⚠️ **Server Restart Detected** ⚠️\n\nWas this restart intentional?\n\n• **Intentional:** Clears all active orders and user states.\n• **Unintentional:** Resumes all active orders where they left off.",
+                text=("⚠️ **Server Restart Detected** ⚠️\n\n"
+                      f"{len(active_orders)} order(s) in progress:\n{summary}\n\n"
+                      "Was this restart intentional?\n\n"
+                      "• **Intentional:** Clears conversations and user states. Orders in progress are kept and rebuilt from the database.\n"
+                      "• **Unintentional:** Resumes all active orders where they left off."),
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
@@ -3089,6 +3071,13 @@ async def post_init(application: Application):
     # -----------------------------------------------------------------------
 
 
+async def post_stop(application: Application):
+    # The bot is still usable here (it is closed before post_shutdown), so queued messages can go out
+    await outbox.stop()
+    invalidation_listener.stop()
+    logging.info(f"Outbox stats: {outbox.stats}")
+
+
 async def post_shutdown(application: Application):
     """Cleanup secondary bot if running."""
     creator_app = application.bot_data.get('creator_app')
@@ -3102,47 +3091,52 @@ async def post_shutdown(application: Application):
         except Exception as e:
             logging.error(f"Error during Creator Bot shutdown: {e}")
 
+    logging.info(f"User cache stats: {user_cache.stats()}")
+    # Let in-flight queries finish before the pool goes away
+    db.shutdown()
+    try:
+        from database import flush_order_locations
+        flush_order_locations()
+    except Exception as e:
+        logging.error(f"Final location flush failed: {e}")
+    from database import close_pool
+    close_pool()
+
 
 def main():
     # Handler for admin requesting updated user location
-    async def admin_request_location_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def admin_request_location_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id, user_id):
         query = update.callback_query
         if update.effective_chat.id != ADMIN_CHAT_ID:
             await query.answer("Unauthorized action.", show_alert=True)
             return
         await query.answer()
-        parts = query.data.split("_")
-        if len(parts) < 5:
-            await query.edit_message_text("Invalid callback data.")
-            return
-        order_id = int(parts[3])
-        user_id = int(parts[4])
         # Retrieve latest location for this user
-        loc = context.bot_data.get(f'latest_location_{user_id}')
+        loc = EphemeralStore(context.bot_data).get('latest_location', user_id)
         if loc:
             lat, lon = loc['lat'], loc['lon']
             # Fetch user registration info
-            user = get_user(user_id)
+            user = await db.get_user(user_id)
             if user:
-                name = user[1]
-                student_id = user[2]
-                block = user[3]
-                dorm = user[4]
-                phone = user[5]
+                name = user.name
+                student_id = user.student_id
+                block = user.block
+                dorm = user.dorm_number
+                phone = user.phone
                 info = (f"Location update for: {name}\n"
                         f"Student ID: {student_id}\n"
                         f"Block/Dorm: {block} / {dorm}\n"
                         f"Phone: {phone}")
-                await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=info)
-            await context.bot.send_location(chat_id=ADMIN_CHAT_ID, latitude=lat, longitude=lon)
+                outbox.post('send_message', chat_id=ADMIN_CHAT_ID, text=info, priority=PRIORITY_TRACKING)
+            outbox.post('send_location', chat_id=ADMIN_CHAT_ID, latitude=lat, longitude=lon, priority=PRIORITY_TRACKING)
             # Rebuild the original keyboard so options don't disappear
             request_location_kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("Request Updated Location",
-                                      callback_data=f"admin_request_location_{order_id}_{user_id}")],
+                                      callback_data=pack('admin_request_location', order_id, user_id))],
                 [InlineKeyboardButton(
-                    "I'm about to pay", callback_data=f"about_to_pay_{order_id}_{user_id}")],
+                    "I'm about to pay", callback_data=pack('about_to_pay', order_id, user_id))],
                 [InlineKeyboardButton("⚠️ Force Arrival Notify",
-                                      callback_data=f"force_arrival_{order_id}_{user_id}")]
+                                      callback_data=pack('force_arrival', order_id, user_id))]
             ])
 
             # Edit the text but keep the buttons!
@@ -3157,34 +3151,50 @@ def main():
 
     # Separate general API request client from the long-poll request config
     # Long-poll needs a larger read timeout than Telegram's poll timeout
-    request = HTTPXRequest(connect_timeout=10, read_timeout=60)
-    persistence = PicklePersistence(filepath='bot_data.pickle')
+    # Counts and times every Bot API call for /metrics
+    request = metrics.InstrumentedRequest(connect_timeout=10, read_timeout=60)
+    # Per-key rows in the database; imports the old PicklePersistence file on first start
+    persistence = DatabasePersistence(legacy_pickle='bot_data.pickle')
     application = (
         Application
         .builder()
         .token(TOKEN)
         .request(request)
         .persistence(persistence)
+        # Different users are served concurrently; each user's updates still run one at a time, in order
+        .concurrent_updates(UserOrderedUpdateProcessor())
         .post_init(post_init)
+        .post_stop(post_stop)
         .post_shutdown(post_shutdown)
         .build()
     )
 
     # 1. SECURITY LAYER (GROUP -1 runs first)
     application.add_handler(TypeHandler(Update, check_banned), group=-1)
+    # Admin group joins and name changes feed the admin directory. Own group, so the catch-all
+    # TypeHandler in group 0 cannot swallow them.
+    application.add_handler(ChatMemberHandler(admin_chat_member, ChatMemberHandler.CHAT_MEMBER), group=1)
+
+    # Every inline button goes through one router: a dict lookup on the action code in callback_data
+    router = CallbackRouter()
+    router.on('restart', restart_decision_callback)
+    router.on('admin_request_location', admin_request_location_callback)
+    router.on('admin_verify_location', admin_verify_location_callback)
+    router.on('admin_seen_user', admin_seen_user_callback)
+    router.on('admin_req_receipt', admin_req_receipt_callback)
+    router.on('admin_reject_proof', admin_reject_proof_callback)
+    router.on('rate', rating_callback)
+    router.on('admin_accept', admin_accept_order)
+    router.on('cancel_order', cancel_order_callback)
+    router.on('confirm_cancel_order', confirm_cancel_order_callback)
+    router.on('keep_order', keep_order_callback)
+    router.on('about_to_pay', about_to_pay_callback)
+    router.on('force_arrival', force_arrival_callback)
+    router.on('user_confirm', user_confirm_callback)
+    router.on('user_cancel_purchase', user_cancel_purchase_callback)
+    router.on('ack_cancel', ack_cancel_callback)
+    application.add_handler(CallbackQueryHandler(router.dispatch))
 
-    # Handler for restart decision
-    application.add_handler(CallbackQueryHandler(
-        restart_decision_callback, pattern='^restart_'))
-    # Handler for admin requesting updated user location
-    application.add_handler(CallbackQueryHandler(
-        admin_request_location_callback, pattern='^admin_request_location_'))
-    # Handler for admin verifying user-uploaded location
-    application.add_handler(CallbackQueryHandler(
-        admin_verify_location_callback, pattern='^admin_verify_location_'))
-    # Handler for admin confirming they see the user
-    application.add_handler(CallbackQueryHandler(
-        admin_seen_user_callback, pattern='^admin_seen_user_'))
     init_db()
 
     # --- New Handlers for Payment Proof & Rating ---
@@ -3199,26 +3209,8 @@ def main():
     application.add_handler(MessageHandler(
         filters.PHOTO, handle_admin_receipt), group=2)
 
-    # Handler for admin requesting to upload receipt
-    application.add_handler(CallbackQueryHandler(
-        admin_req_receipt_callback, pattern='^admin_req_receipt_'))
-    # Handler for admin rejecting proof
-    application.add_handler(CallbackQueryHandler(
-        admin_reject_proof_callback, pattern='^admin_reject_proof_'))
-    # Handler for rating callback
-    application.add_handler(CallbackQueryHandler(
-        rating_callback, pattern='^rate_'))
     # -----------------------------------------------
 
-    # Ensure shared relay store exists on the application-level bot_data
-    application.bot_data.setdefault('tracking_relays', {})
-    # Admin live-location mapping (customer_id -> message_id)
-    application.bot_data.setdefault('admin_live', {})
-    # Admin order message mapping (order_id -> message_id)
-    application.bot_data.setdefault('admin_orders', {})
-    # Order locked state (no cancellation allowed once user confirms)
-    application.bot_data.setdefault('order_locked', {})
-
     # Registration Handler
     reg_conv = ConversationHandler(
         entry_points=[
@@ -3284,33 +3276,9 @@ def main():
     application.add_handler(dev_conv)
     # Add clearorders command for admin group only
     application.add_handler(CommandHandler('clearorders', clear_orders))
+    # Ranked deliverer suggestions for every pending order
+    application.add_handler(CommandHandler('dispatch', dispatch_command))
 
-    # Handler for admin accepting an order
-    application.add_handler(CallbackQueryHandler(
-        admin_accept_order, pattern='^admin_accept_'))
-    # Handler for user cancel-order callback
-    application.add_handler(CallbackQueryHandler(
-        cancel_order_callback, pattern='^cancel_order_'))
-    # Handler for confirming cancellation
-    application.add_handler(CallbackQueryHandler(
-        confirm_cancel_order_callback, pattern='^confirm_cancel_order_'))
-    # Handler for keeping order
-    application.add_handler(CallbackQueryHandler(
-        keep_order_callback, pattern='^keep_order_'))
-    # Handler for admin about-to-pay action
-    application.add_handler(CallbackQueryHandler(
-        about_to_pay_callback, pattern='^about_to_pay_'))
-    # Handler for admin force-arrival action
-    application.add_handler(CallbackQueryHandler(
-        force_arrival_callback, pattern='^force_arrival_'))
-    # Handlers for customer confirm/cancel purchase actions
-    application.add_handler(CallbackQueryHandler(
-        user_confirm_callback, pattern='^user_confirm_'))
-    application.add_handler(CallbackQueryHandler(
-        user_cancel_purchase_callback, pattern='^user_cancel_purchase_'))
-    # Handler for ack after cancellation warning
-    application.add_handler(CallbackQueryHandler(
-        ack_cancel_callback, pattern='^ack_cancel_'))
 
     # Global handler for Live Location updates (Relay)
     application.add_handler(MessageHandler(
@@ -3338,8 +3306,7 @@ def main():
             return
         
         user_id = update.effective_user.id
-        from database import get_user_language
-        lang = get_user_language(user_id) or 'en'
+        lang = await db.get_user_language(user_id) or 'en'
 
         # Check for specific "Lost Button" patterns to give better feedback
         if text and ("Cancel Order" in text or "Confirm" in text or "ትዕዛዝ" in text or "አረጋግጥ" in text):
@@ -3357,6 +3324,9 @@ def main():
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, global_fallback))
 
+    # Per-handler latency for /metrics; must run after every add_handler above
+    metrics.instrument_handlers(application)
+
     # Check for Render environment or explicit PORT setting to determine mode
     webhook_url = os.environ.get("RENDER_EXTERNAL_URL")
 
@@ -3370,18 +3340,21 @@ def main():
         
         # Start pinger thread even in webhook mode to prevent sleeping
         start_pinger()
+        if METRICS_PORT:
+            start_server(METRICS_PORT)
 
         application.run_webhook(
             listen="0.0.0.0",
             port=port,
             url_path=TOKEN,
-            webhook_url=f"{webhook_url}/{TOKEN}"
+            webhook_url=f"{webhook_url}/{TOKEN}",
+            allowed_updates=ALLOWED_UPDATES
         )
     else:
         logging.info("Starting in Polling mode.")
         keep_alive()  # Start the web server to keep the bot alive
         
-        application.run_polling()
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get() on a miss, so that None can be cached as "no such row"
+MISSING = object()
+
+
+class TTLCache:
+    """Small thread-safe key/value cache with per-entry expiry and hit/miss counters.
+
+    Entries expire after `ttl` seconds. Once the cache holds `max_size` entries, the
+    oldest insert is evicted. Every entry has the same ttl and set() moves a key to the
+    end, so the entries are kept in expiry order and eviction only looks at the front. Writers call invalidate() after changing the source row.
+    """
+
+    def __init__(self, name, ttl=300, max_size=10000):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a slow reader can't re-insert a row it read before the write
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key, value, generation=None):
+        """Stores a value. If `generation` is given and an invalidation happened since, the value is dropped."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._data:
+                self._data.move_to_end(key)
+            elif len(self._data) >= self.max_size:
+                self._evict()
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def _evict(self):
+        # Drop whatever has expired at the front, then the oldest entry if that freed nothing
+        now = time.monotonic()
+        while self._data and next(iter(self._data.values()))[1] <= now:
+            self._data.popitem(last=False)
+        if len(self._data) >= self.max_size:
+            self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,143 @@
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects callback_data longer than this many bytes
+CALLBACK_DATA_MAX = 64
+# First character of every payload built by pack(). Payloads from before the router
+# (e.g. "admin_accept_12_345") start with a letter, so they can never be mistaken for it.
+PAYLOAD_VERSION = '1'
+# A 64-bit int is at most 14 base36 characters with its sign, so 4 of them always fit: 2 + 4 * 14 + 3 = 61 bytes
+MAX_ARGS = 4
+
+# action -> (code, number of int arguments). Codes end up in buttons already sent to users,
+# so never reuse or reassign one; add new actions with new codes.
+ACTIONS = {
+    'admin_accept': ('a', 2),               # order_id, customer_id
+    'about_to_pay': ('p', 2),               # order_id, customer_id
+    'admin_request_location': ('l', 2),     # order_id, customer_id
+    'force_arrival': ('f', 2),              # order_id, customer_id
+    'admin_seen_user': ('s', 2),            # order_id, customer_id
+    'admin_req_receipt': ('r', 2),          # order_id, customer_id
+    'admin_reject_proof': ('x', 2),         # order_id, customer_id
+    'admin_verify_location': ('v', 4),      # approve (1/0), user_id, lat and lon in microdegrees
+    'rate': ('R', 2),                       # order_id, rating
+    'cancel_order': ('c', 1),               # order_id
+    'confirm_cancel_order': ('C', 1),       # order_id
+    'keep_order': ('k', 1),                 # order_id
+    'ack_cancel': ('A', 1),                 # order_id
+    'user_confirm': ('u', 2),               # order_id, admin message id
+    'user_cancel_purchase': ('U', 2),       # order_id, admin message id
+    'restart': ('S', 1),                    # 1 = reset, 0 = resume
+}
+
+# Pre-router payloads whose name carried an argument: legacy name -> (action, leading args)
+LEGACY_ALIASES = {
+    'restart_reset': ('restart', (1,)),
+    'restart_resume': ('restart', (0,)),
+    'admin_verify_location_yes': ('admin_verify_location', (1,)),
+    'admin_verify_location_no': ('admin_verify_location', (0,)),
+}
+
+if len({code for code, _ in ACTIONS.values()}) != len(ACTIONS):
+    raise ValueError("Two callback actions share a code")
+if max(nargs for _, nargs in ACTIONS.values()) > MAX_ARGS:
+    raise ValueError(f"Callback actions take at most {MAX_ARGS} arguments")
+
+
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _base36(value):
+    if value < 0:
+        return '-' + _base36(-value)
+    digits = ''
+    while True:
+        value, digit = divmod(value, 36)
+        digits = _DIGITS[digit] + digits
+        if not value:
+            return digits
+
+
+def pack(action, *args):
+    """callback_data for a button: version, action code, then the int arguments in base36, dot-separated.
+
+    e.g. pack('admin_accept', 1234, 7234567890) == '1aya.3bn9wb6' (12 bytes, against 28 for
+    'admin_accept_1234_7234567890'). None is sent as 0, which handlers treat as missing.
+    """
+    code, nargs = ACTIONS[action]
+    if len(args) != nargs:
+        raise ValueError(f"{action} takes {nargs} arguments, got {len(args)}")
+    data = PAYLOAD_VERSION + code + '.'.join(_base36(int(arg or 0)) for arg in args)
+    if len(data.encode()) > CALLBACK_DATA_MAX:
+        raise ValueError(f"callback_data for {action} is {len(data)} bytes")
+    return data
+
+
+def unpack_args(text):
+    # int() parses base36 in C, which keeps decoding cheaper than any byte-level packing
+    return [int(arg, 36) for arg in text.split('.')] if text else []
+
+
+def _legacy_arg(segment):
+    # Old buttons carried ints, floats (coordinates) and the odd "None" (no admin message id)
+    try:
+        return int(segment)
+    except ValueError:
+        pass
+    try:
+        return float(segment)
+    except ValueError:
+        return None
+
+
+class CallbackRouter:
+    """One CallbackQueryHandler for every button: the action is found with a dict lookup on its code.
+
+    Handlers are registered with on(action, fn) and called as fn(update, context, *args) with the
+    decoded int arguments, so they no longer split query.data themselves. Buttons sent before
+    the router ("rate_12_7") are still understood.
+    """
+
+    def __init__(self):
+        # code -> (action, min args, max args); `routes` is action -> fn, also used by metrics.instrument_handlers
+        self._by_code = {}
+        self.routes = {}
+        # pre-router name -> (code, leading args)
+        self._legacy = {action: (code, ()) for action, (code, _) in ACTIONS.items()}
+        self._legacy.update({name: (ACTIONS[action][0], leading) for name, (action, leading) in LEGACY_ALIASES.items()})
+
+    def on(self, action, fn):
+        code, _ = ACTIONS[action]
+        params = list(inspect.signature(fn).parameters.values())[2:]
+        required = sum(1 for p in params if p.default is inspect.Parameter.empty)
+        self._by_code[code] = (action, required, len(params))
+        self.routes[action] = fn
+
+    def decode(self, data):
+        """(code, args) for a callback_data string, or None if it is not one of ours."""
+        if data[:1] == PAYLOAD_VERSION:
+            try:
+                return data[1:2], unpack_args(data[2:])
+            except ValueError:
+                return None
+        # Pre-router format: the longest known name, then numeric segments
+        segments = data.split('_')
+        for end in range(len(segments), 0, -1):
+            legacy = self._legacy.get('_'.join(segments[:end]))
+            if legacy is not None:
+                code, leading = legacy
+                return code, list(leading) + [_legacy_arg(s) for s in segments[end:] if s]
+        return None
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        decoded = self.decode(query.data or '')
+        if decoded is not None:
+            code, args = decoded
+            entry = self._by_code.get(code)
+            if entry is not None and entry[1] <= len(args) <= entry[2]:
+                return await self.routes[entry[0]](update, context, *args)
+        logger.warning(f"Unroutable callback data: {query.data!r}")
+        await query.answer("This button is no longer valid.")
@@ -0,0 +1,123 @@
+import os
+import threading
+
+from telegram import ReplyKeyboardMarkup
+
+import database
+from menus import MENUS, CONTRACT_MENUS
+
+# How often (seconds) the bot checks whether another process changed item availability
+MENU_REFRESH_INTERVAL = int(os.getenv("MENU_REFRESH_INTERVAL", 30))
+
+
+def item_button(item, price):
+    return f"{item} - {price} ETB"
+
+
+def _two_per_row(labels):
+    return [labels[i:i + 2] for i in range(0, len(labels), 2)]
+
+
+class MenuCatalog:
+    """Menus, button lookups and reply keyboards, built once instead of on every message.
+
+    Keyboards are keyed by (restaurant, contract). Button labels are restaurant and item names
+    plus prices, which are the same in every language, so there is no per-language copy.
+    Availability lives here as one frozenset per restaurant; a toggle rebuilds only that
+    restaurant's keyboards.
+    """
+
+    def __init__(self, menus=MENUS, contract_menus=CONTRACT_MENUS):
+        self._menus = menus
+        self._contract_menus = contract_menus
+        self._lock = threading.Lock()
+        self.version = None
+        self.restaurant_keyboard = ReplyKeyboardMarkup(
+            _two_per_row(list(menus)), one_time_keyboard=True, resize_keyboard=True)
+        self._restaurants = {name.lower(): name for name in menus}
+        # (restaurant, contract) -> {button text: (item, price)}, including unavailable items
+        self._buttons = {}
+        for restaurant in menus:
+            for contract in (False, True):
+                menu = self.menu(restaurant, contract)
+                self._buttons[(restaurant, contract)] = {item_button(item, price): (item, price) for item, price in menu.items()}
+        self._unavailable = {}
+        self._keyboards = {}
+        for restaurant in menus:
+            self._build(restaurant)
+
+    def menu(self, restaurant, contract=False):
+        if contract and restaurant in self._contract_menus:
+            return self._contract_menus[restaurant]
+        return self._menus.get(restaurant, {})
+
+    def has_contract_menu(self, restaurant):
+        return restaurant in self._contract_menus
+
+    def find_restaurant(self, text):
+        """Canonical restaurant name for a button press (case-insensitive), or None."""
+        return self._restaurants.get(text.strip().lower())
+
+    def lookup_item(self, restaurant, contract, text):
+        """(item, price) for a menu button, or None if the text is not one of this menu's buttons."""
+        return self._buttons.get((restaurant, bool(contract and restaurant in self._contract_menus)), {}).get(text)
+
+    def is_available(self, restaurant, item):
+        return item not in self._unavailable.get(restaurant, frozenset())
+
+    def item_keyboard(self, restaurant, contract=False):
+        return self._keyboards.get((restaurant, bool(contract and restaurant in self._contract_menus)))
+
+    def _build(self, restaurant):
+        unavailable = self._unavailable.get(restaurant, frozenset())
+        for contract in (False, True):
+            labels = [[label] for label, (item, _) in self._buttons[(restaurant, contract)].items() if item not in unavailable]
+            self._keyboards[(restaurant, contract)] = ReplyKeyboardMarkup(labels, one_time_keyboard=True, resize_keyboard=True)
+
+    def load(self, version, rows, restaurants=None):
+        """Replaces the availability snapshot with [(restaurant, item)] unavailable rows.
+
+        With restaurants, rows cover only those restaurants and the rest of the snapshot is kept.
+        """
+        grouped = {}
+        for restaurant, item in rows:
+            grouped.setdefault(restaurant, set()).add(item)
+        with self._lock:
+            scope = set(grouped) | set(self._unavailable) if restaurants is None else set(restaurants)
+            changed = {r for r in scope if frozenset(grouped.get(r, ())) != self._unavailable.get(r, frozenset())}
+            kept = {} if restaurants is None else {r: items for r, items in self._unavailable.items() if r not in scope}
+            self._unavailable = {**kept, **{r: frozenset(items) for r, items in grouped.items()}}
+            for restaurant in changed & set(self._menus):
+                self._build(restaurant)
+            self.version = version
+        return changed
+
+    def reload(self, restaurants=None):
+        """Reads availability from the database, for every restaurant or only the given ones.
+
+        Returns the restaurants whose keyboards changed.
+        """
+        return self.load(*database.load_unavailable_items(restaurants), restaurants=restaurants)
+
+    def refresh(self):
+        """Reloads only if the stored menu version moved (a toggle in another process). Returns True if it reloaded."""
+        if database.get_menu_version() == self.version:
+            return False
+        self.reload()
+        return True
+
+    def apply_toggle(self, restaurant, item, available):
+        """database.on_availability_change listener: patches one restaurant without re-reading the table."""
+        with self._lock:
+            items = set(self._unavailable.get(restaurant, ()))
+            if available:
+                items.discard(item)
+            else:
+                items.add(item)
+            self._unavailable[restaurant] = frozenset(items)
+            if restaurant in self._menus:
+                self._build(restaurant)
+
+
+catalog = MenuCatalog()
+database.on_availability_change(catalog.apply_toggle)
@@ -5,6 +5,7 @@ import sqlite3
 import datetime
 import io
 import csv
+import html
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, 
@@ -21,13 +22,14 @@ from reportlab.lib.units import inch
 
 # Import database functions
 from database import (
-    get_db_connection, get_user, ban_user, get_full_user_info, 
-    add_cafe_contract, get_user_by_username, get_all_admins,
+    db_connection, get_user, ban_user, get_full_user_info, 
+    add_cafe_contract, get_user_by_username, get_all_admins, get_admin_directory,
     set_user_as_admin, get_contract_details, update_contract_payment,
     get_active_users, get_contract_users, get_regular_users, search_users,
     delete_user_completely, toggle_item_availability, get_unavailable_items,
-    init_db
+    get_active_orders, get_order_stats, init_db
 )
+from models import as_tuple
 from menus import MENUS
 
 load_dotenv()
@@ -141,13 +143,13 @@ async def run_investigation(update: Update, context: ContextTypes.DEFAULT_TYPE,
             return
         
         if len(users) == 1:
-            target_id = users[0][0]
+            target_id = users[0].user_id
         else:
             msg = f"🔍 Multiple users found for '<b>{query_str}</b>':\n\n"
             keyboard = []
             for u in users[:8]:
-                msg += f"• {u[2]} (@{u[1]}) - <code>{u[0]}</code>\n"
-                keyboard.append([InlineKeyboardButton(f"Audit {u[2]}", callback_data=f"investigate_{u[0]}")])
+                msg += f"• {u.name} (@{u.username}) - <code>{u.user_id}</code>\n"
+                keyboard.append([InlineKeyboardButton(f"Audit {u.name}", callback_data=f"investigate_{u.user_id}")])
             await update.effective_message.reply_text(msg, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
             return
 
@@ -167,21 +169,19 @@ async def run_investigation(update: Update, context: ContextTypes.DEFAULT_TYPE,
     history = data['history']
     orders = data['orders']
     
-    # Map user fields: 0:id, 1:username, 2:name, 3:student_id, 4:block, 5:dorm, 6:phone...
-    # Indices might vary by DB, but standard is: 0:id, 1:un, 2:name, 3:sid, 4:block, 5:room, 6:phone, 7:gender, 8:deliv, 9:bal, 10:tok, 11:lang, 12:ban
     report = (
-        f"🕵️ <b>AUDIT REPORT: {u[2]}</b>\n"
+        f"🕵️ <b>AUDIT REPORT: {u.name}</b>\n"
         f"━━━━━━━━━━━━━━━\n"
-        f"🆔 <b>ID:</b> <code>{u[0]}</code>\n"
-        f"👤 <b>Username:</b> @{u[1]}\n"
-        f"📞 <b>Phone:</b> {u[6]}\n"
-        f"🎓 <b>Student ID:</b> {u[3]}\n"
-        f"🏠 <b>Dorm:</b> Block {u[4]}, Room {u[5]}\n"
-        f"🚻 <b>Gender:</b> {u[7]}\n"
-        f"💰 <b>Balance:</b> {u[9]} ETB\n"
-        f"💎 <b>Tokens:</b> {u[10]}\n"
-        f"🚲 <b>Deliverer:</b> {'✅ Yes' if u[8] else '❌ No'}\n"
-        f"🔴 <b>Banned:</b> {'🚨 YES' if (len(u) > 12 and u[12]) else '🟢 No'}\n"
+        f"🆔 <b>ID:</b> <code>{u.user_id}</code>\n"
+        f"👤 <b>Username:</b> @{u.username}\n"
+        f"📞 <b>Phone:</b> {u.phone}\n"
+        f"🎓 <b>Student ID:</b> {u.student_id}\n"
+        f"🏠 <b>Dorm:</b> Block {u.block}, Room {u.dorm_number}\n"
+        f"🚻 <b>Gender:</b> {u.gender}\n"
+        f"💰 <b>Balance:</b> {u.balance} ETB\n"
+        f"💎 <b>Tokens:</b> {u.tokens}\n"
+        f"🚲 <b>Deliverer:</b> {'✅ Yes' if u.is_deliverer else '❌ No'}\n"
+        f"🔴 <b>Banned:</b> {'🚨 YES' if u.is_banned else '🟢 No'}\n"
     )
     
     if history:
@@ -193,20 +193,13 @@ async def run_investigation(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if orders:
         report += f"\n🛍️ <b>Order History ({len(orders)}):</b>\n"
         for o in orders[:8]:
-            created_ts = datetime.datetime.fromtimestamp(o[16]).strftime('%H:%M') if (len(o) > 16 and o[16]) else "??"
-            report += f"- #{o[0]} | {o[3]} | {o[5]} ETB | {o[6]} | 🕒 {created_ts}\n"
+            created_ts = datetime.datetime.fromtimestamp(o.created_at).strftime('%H:%M') if o.created_at else "??"
+            report += f"- #{o.order_id} | {o.restaurant} | {o.total_price} ETB | {o.status} | 🕒 {created_ts}\n"
             
     await update.effective_message.reply_text(report, parse_mode='HTML')
 
 async def list_active_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    query = """SELECT order_id, customer_id, deliverer_id, restaurant, items, total_price, status, order_type, verification_code, 
-               mid_delivery_proof, proof_timestamp, delivery_proof, delivery_lat, delivery_lon, pickup_lat, pickup_lon, created_at, delivered_at 
-               FROM orders WHERE status IN ('pending', 'accepted', 'picked_up')"""
-    cur.execute(query)
-    orders = cur.fetchall()
-    conn.close()
+    orders = get_active_orders()
 
     if not orders:
         await update.effective_message.reply_text("No active orders.")
@@ -215,8 +208,8 @@ async def list_active_orders_command(update: Update, context: ContextTypes.DEFAU
     msg = "🚀 <b>Live Deliveries (Active):</b>\n\n"
     keyboard = []
     for order in orders:
-        msg += f"📦 #{order[0]} | {order[6].upper()} | {order[3]} | User: {order[1]}\n"
-        keyboard.append([InlineKeyboardButton(f"View Order #{order[0]}", callback_data=f"view_{order[0]}")])
+        msg += f"📦 #{order.order_id} | {order.status.upper()} | {order.restaurant} | User: {order.customer_id}\n"
+        keyboard.append([InlineKeyboardButton(f"View Order #{order.order_id}", callback_data=f"view_{order.order_id}")])
     
     await update.effective_message.reply_text(msg, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -231,18 +224,17 @@ async def view_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.edit_message_text("Order not found.")
         return
 
-    # order: 0:order_id, 1:customer_id, 2:deliverer_id, 3:restaurant, 4:items, 5:total_price, 6:status, 7:order_type...
     msg = (
-        f"📦 <b>Order Details: #{order[0]}</b>\n"
+        f"📦 <b>Order Details: #{order.order_id}</b>\n"
         f"━━━━━━━━━━━━━━━\n"
-        f"👤 <b>Customer:</b> <code>{order[1]}</code>\n"
-        f"🚲 <b>Deliverer:</b> <code>{order[2] or 'NONE'}</code>\n"
-        f"🏠 <b>Restaurant:</b> {order[3]}\n"
-        f"🛒 <b>Items:</b> {order[4]}\n"
-        f"💰 <b>Total:</b> {order[5]} ETB\n"
-        f"📊 <b>Status:</b> {order[6].upper()}\n"
-        f"🏷️ <b>Type:</b> {order[7]}\n"
-        f"🕒 <b>Created:</b> {datetime.datetime.fromtimestamp(order[16]).strftime('%Y-%m-%d %H:%M') if order[16] else 'N/A'}\n"
+        f"👤 <b>Customer:</b> <code>{order.customer_id}</code>\n"
+        f"🚲 <b>Deliverer:</b> <code>{order.deliverer_id or 'NONE'}</code>\n"
+        f"🏠 <b>Restaurant:</b> {order.restaurant}\n"
+        f"🛒 <b>Items:</b> {order.items}\n"
+        f"💰 <b>Total:</b> {order.total_price} ETB\n"
+        f"📊 <b>Status:</b> {order.status.upper()}\n"
+        f"🏷️ <b>Type:</b> {order.order_type}\n"
+        f"🕒 <b>Created:</b> {datetime.datetime.fromtimestamp(order.created_at).strftime('%Y-%m-%d %H:%M') if order.created_at else 'N/A'}\n"
     )
     
     keyboard = [[InlineKeyboardButton("🔙 Back to Active", callback_data="back_to_active")]]
@@ -250,29 +242,32 @@ async def view_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.edit_message_text(msg, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    user_count = cur.fetchone()[0]
+    # Only non-test orders count
+    user_count, order_count, total_rev = get_order_stats()
     
-    # Only count non-test orders
-    cur.execute("SELECT COUNT(*) FROM orders WHERE is_test = 0")
-    order_count = cur.fetchone()[0]
-    
-    cur.execute("SELECT SUM(total_price) FROM orders WHERE status = 'complete' AND is_test = 0")
-    total_rev = cur.fetchone()[0] or 0
-    conn.close()
-    
-    from database import is_test_mode_active
+    from database import is_test_mode_active, user_cache, get_restaurant_revenue, get_top_items
     test_mode_status = "🔴 ACTIVE" if is_test_mode_active() else "⚪ Inactive"
-    
+    cache_stats = user_cache.stats()
+
+    # Per-line figures from order_items (orders placed before it existed are not itemised)
+    by_restaurant = "\n".join(
+        f"• {html.escape(str(restaurant))}: {count} items, {revenue or 0:,.2f} ETB"
+        for restaurant, count, revenue in get_restaurant_revenue()) or "• No itemised orders yet"
+    top_items = "\n".join(
+        f"• {html.escape(str(item))} ({html.escape(str(restaurant))}): {count}"
+        for restaurant, item, count in get_top_items(5)) or "• None yet"
+
     await update.effective_message.reply_text(
         f"📊 <b>System Stats</b>\n"
         f"<i>(Test data excluded)</i>\n\n"
         f"👥 Users: {user_count}\n"
         f"📦 Real Orders: {order_count}\n"
         f"💰 Real Revenue: {total_rev:,.2f} ETB\n\n"
+        f"🏪 <b>Food revenue by restaurant</b>\n{by_restaurant}\n\n"
+        f"🍽 <b>Top items</b>\n{top_items}\n\n"
         f"🧪 <b>Test Mode:</b> {test_mode_status}\n"
+        f"🗂 <b>User Cache:</b> {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+        f"({cache_stats['hit_rate']:.0%}), {cache_stats['size']} cached\n"
         f"<i>Use /test to toggle, /clear to reset stats.</i>",
         parse_mode='HTML'
     )
@@ -361,7 +356,7 @@ async def user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Show first 15 and option to export
     msg = f"📊 <b>{title} ({len(users)})</b>\n\n"
     for u in users[:15]:
-        msg += f"• {u[2]} (@{u[1]}) | <code>{u[0]}</code>\n"
+        msg += f"• {u.name} (@{u.username}) | <code>{u.user_id}</code>\n"
     
     if len(users) > 15:
         msg += f"\n...and {len(users)-15} more."
@@ -391,7 +386,7 @@ async def export_csv_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     writer = csv.writer(buffer)
     writer.writerow(['User ID', 'Username', 'Name', 'Student ID', 'Block', 'Dorm', 'Phone', 'Gender', 'Deliverer', 'Balance', 'Tokens', 'Language', 'Banned'])
     for u in users:
-        writer.writerow(list(u))
+        writer.writerow(as_tuple(u))
     
     buffer.seek(0)
     byte_buffer = io.BytesIO(buffer.getvalue().encode())
@@ -414,9 +409,9 @@ async def handle_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE)
     msg = f"🔍 <b>Search Results for '{search_q}'</b>\n\n"
     keyboard = []
     for u in users[:10]:
-        msg += f"👤 <b>{u[2]}</b> (@{u[1]})\nID: <code>{u[0]}</code> | Phone: {u[6]}\n\n"
-        keyboard.append([InlineKeyboardButton(f"Audit {u[2]}", callback_data=f"investigate_{u[0]}")])
-        keyboard.append([InlineKeyboardButton(f"🗑️ Delete/Ban {u[2]}", callback_data=f"delete_user_{u[0]}")])
+        msg += f"👤 <b>{u.name}</b> (@{u.username})\nID: <code>{u.user_id}</code> | Phone: {u.phone}\n\n"
+        keyboard.append([InlineKeyboardButton(f"Audit {u.name}", callback_data=f"investigate_{u.user_id}")])
+        keyboard.append([InlineKeyboardButton(f"🗑️ Delete/Ban {u.name}", callback_data=f"delete_user_{u.user_id}")])
     
     if len(users) > 10:
         msg += f"Found {len(users)} results. Showing top 10."
@@ -499,11 +494,11 @@ async def export_pdf_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             y = height - 1*inch
             c.setFont("Helvetica", 9)
             
-        c.drawString(0.5*inch, y, str(u[0]))
-        c.drawString(1.5*inch, y, str(u[2])[:25])
-        c.drawString(3.5*inch, y, f"@{u[1]}" if u[1] else "N/A")
-        c.drawString(5.0*inch, y, str(u[6]))
-        c.drawString(6.5*inch, y, str(u[3]))
+        c.drawString(0.5*inch, y, str(u.user_id))
+        c.drawString(1.5*inch, y, str(u.name)[:25])
+        c.drawString(3.5*inch, y, f"@{u.username}" if u.username else "N/A")
+        c.drawString(5.0*inch, y, str(u.phone))
+        c.drawString(6.5*inch, y, str(u.student_id))
         y -= 0.2*inch
     
     c.save()
@@ -522,12 +517,13 @@ WAITING_ADMIN_ID, WAITING_ADMIN_ACC, WAITING_ADMIN_NAME = range(6, 9)
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all admins and show option to add new one."""
     admins = get_all_admins()
+    accounts = {row[0]: row[3] for row in get_admin_directory()}
     msg = "👮 <b>System Admins / Deliverers:</b>\n\n"
     if not admins:
         msg += "No admins assigned yet."
     else:
         for a in admins:
-            msg += f"• {a[2]} (@{a[1]}) - ID: <code>{a[0]}</code> - Phone: {a[3]}\n"
+            msg += f"• {a.name} (@{a.username}) - ID: <code>{a.user_id}</code> - Phone: {a.phone} - Acc: {accounts.get(a.user_id) or 'default'}\n"
     
     keyboard = [
         [InlineKeyboardButton("➕ Add Admin", callback_data="add_admin")],
@@ -562,13 +558,8 @@ async def process_admin_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
     admin_id = context.user_data['new_admin_id']
     acc = context.user_data['new_admin_acc']
     
-    # Update as deliverer in DB
-    set_user_as_admin(admin_id, 1)
-    # Store account number in context or ENV (since it's persistent, maybe ENV? No, let's just mark them as admin)
-    # The requirement said "acc" is one of the reqs.
-    # In bedorme.py, it uses usernames to map accounts.
-    # I should probably store these mappings somewhere, maybe a new table?
-    # But for now, I'll just confirm they are added.
+    # Mark as deliverer and store the account customers pay into; the main bot's admin directory picks it up
+    set_user_as_admin(admin_id, 1, payout_account=acc)
     
     await update.effective_message.reply_text(f"✅ User {name} (ID: {admin_id}) is now an Admin/Deliverer.\nAccount: {acc}", parse_mode='HTML')
     return ConversationHandler.END
@@ -875,6 +866,13 @@ def main():
     except Exception as e:
         logging.error(f"DB Init failed: {e}")
 
+    # Drop cached users/bans when the main bot changes them
+    try:
+        from invalidation import listener
+        listener.start()
+    except Exception as e:
+        logging.error(f"Invalidation listener failed to start: {e}")
+
     app = create_creator_app()
     if not app:
         print("Error: No Token found for Creator Bot.")
@@ -0,0 +1,91 @@
+import heapq
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from geo import distance_matrix
+
+# Each job a deliverer already has counts like this many extra meters of distance
+DISPATCH_LOAD_PENALTY = float(os.getenv("DISPATCH_LOAD_PENALTY", 1500))
+# Deliverers with this many jobs in hand are not suggested
+DISPATCH_MAX_LOAD = int(os.getenv("DISPATCH_MAX_LOAD", 3))
+# Positions older than this (seconds) are ignored; the deliverer is ranked on load alone
+DISPATCH_LOCATION_MAX_AGE = int(os.getenv("DISPATCH_LOCATION_MAX_AGE", 900))
+DISPATCH_SUGGESTIONS = int(os.getenv("DISPATCH_SUGGESTIONS", 3))
+# Also reply to the new-order message tagging the best deliverer
+DISPATCH_AUTO_OFFER = os.getenv("DISPATCH_AUTO_OFFER", "false").lower() in ("1", "true", "yes")
+
+_INF = float('inf')
+
+# distance is None when either the pickup or the deliverer position is unknown
+Suggestion = namedtuple('Suggestion', ['deliverer_id', 'distance', 'load', 'score'])
+
+
+def deliverer_positions(deliverer_ids, ephemeral, now=None):
+    """{deliverer_id: (lat, lon)} from the latest shared locations that are still fresh."""
+    now = time.time() if now is None else now
+    positions = {}
+    for deliverer_id in deliverer_ids:
+        loc = ephemeral.get('latest_location', deliverer_id)
+        if loc and now - loc.get('timestamp', 0) <= DISPATCH_LOCATION_MAX_AGE:
+            positions[deliverer_id] = (loc['lat'], loc['lon'])
+    return positions
+
+
+def rank(pickups, deliverer_ids, positions, loads, top=DISPATCH_SUGGESTIONS):
+    """Ranks deliverers for a batch of orders in one pass.
+
+    pickups is a list of (lat, lon) or (None, None), oldest order first. Returns one list of
+    up to `top` Suggestions per pickup, best first. Score is distance plus DISPATCH_LOAD_PENALTY
+    per job in hand; each order's best pick counts as a job for the orders after it, so a
+    burst is spread across deliverers instead of all landing on the closest one.
+    """
+    if not pickups:
+        return []
+    if not deliverer_ids:
+        return [[] for _ in pickups]
+
+    n = len(deliverer_ids)
+    known = np.array([d in positions for d in deliverer_ids])
+    d_lat = np.array([positions[d][0] if d in positions else 0.0 for d in deliverer_ids])
+    d_lon = np.array([positions[d][1] if d in positions else 0.0 for d in deliverer_ids])
+    has_pickup = np.array([lat is not None and lon is not None for lat, lon in pickups])
+    p_lat = np.array([lat if ok else 0.0 for (lat, _), ok in zip(pickups, has_pickup)])
+    p_lon = np.array([lon if ok else 0.0 for (_, lon), ok in zip(pickups, has_pickup)])
+
+    # All order x deliverer distances at once; unknown on either side ranks on load only
+    distances = distance_matrix(p_lat, p_lon, d_lat, d_lon)
+    usable = has_pickup[:, None] & known[None, :]
+    # Deliverers without a position go behind every located one
+    base = np.where(usable, distances, np.where(has_pickup[:, None], 1e9, 0.0))
+
+    # The trig is done above in one vectorized call; the greedy pass below is cheaper on plain lists
+    # than on small numpy rows (per-call overhead dominates at a few dozen deliverers)
+    load = [loads.get(d, 0) for d in deliverer_ids]
+    penalty = [_INF if l >= DISPATCH_MAX_LOAD else l * DISPATCH_LOAD_PENALTY for l in load]
+    base, distances, usable = base.tolist(), distances.tolist(), usable.tolist()
+
+    results = []
+    for i in range(len(pickups)):
+        row_base, row_dist, row_usable = base[i], distances[i], usable[i]
+        scores = [b + p for b, p in zip(row_base, penalty)]
+        best = [j for j in heapq.nsmallest(top, range(n), key=scores.__getitem__) if scores[j] != _INF]
+        results.append([Suggestion(deliverer_ids[j], row_dist[j] if row_usable[j] else None, load[j], scores[j]) for j in best])
+        if best:
+            j = best[0]
+            load[j] += 1
+            penalty[j] = _INF if load[j] >= DISPATCH_MAX_LOAD else load[j] * DISPATCH_LOAD_PENALTY
+    return results
+
+
+def format_suggestions(suggestions, names):
+    """One line per suggestion for the admin group, e.g. '1. Abebe (@abebe) – 850 m, 1 active'."""
+    if not suggestions:
+        return "No available deliverers."
+    lines = []
+    for i, s in enumerate(suggestions, 1):
+        where = f"{s.distance:.0f} m" if s.distance is not None else "location unknown"
+        lines.append(f"{i}. {names.get(s.deliverer_id, s.deliverer_id)} – {where}, {s.load} active")
+    return "\n".join(lines)
@@ -0,0 +1,100 @@
+import os
+import time
+from collections import namedtuple
+
+# scope says which id the key is: 'order' entries are evicted when the order finishes, 'user' entries only expire
+Namespace = namedtuple('Namespace', ['ttl', 'scope'])
+
+# Short-lived per-user / per-order state that used to live as flat f'{name}_{id}' bot_data keys.
+# TTLs are a backstop so nothing outlives its usefulness even if the normal cleanup path never runs.
+NAMESPACES = {
+    'latest_location': Namespace(ttl=2 * 3600, scope='user'),
+    'linger_warn': Namespace(ttl=3600, scope='user'),
+    'location_verified': Namespace(ttl=6 * 3600, scope='user'),
+    'last_info_update': Namespace(ttl=24 * 3600, scope='order'),
+    'last_info_msg_id': Namespace(ttl=24 * 3600, scope='order'),
+    'user_proof': Namespace(ttl=48 * 3600, scope='order'),
+}
+
+# How often the JobQueue sweeper runs (seconds)
+EPHEMERAL_SWEEP_INTERVAL = int(os.getenv("EPHEMERAL_SWEEP_INTERVAL", 300))
+
+_PREFIX = 'ephemeral:'
+
+
+class EphemeralStore:
+    """Namespaced, expiring key/value state kept inside bot_data.
+
+    Each namespace is its own bot_data key ('ephemeral:<name>' -> {id: (stored_at, value)}),
+    so it is persisted like the rest of bot_data and a change only rewrites that namespace.
+    Expired entries read as missing straight away; sweep() removes them for good.
+    """
+
+    def __init__(self, bot_data):
+        self._bot_data = bot_data
+
+    def _bucket(self, namespace):
+        if namespace not in NAMESPACES:
+            raise KeyError(f"Unknown ephemeral namespace '{namespace}'")
+        return self._bot_data.setdefault(_PREFIX + namespace, {})
+
+    def get(self, namespace, key, default=None):
+        entry = self._bucket(namespace).get(key)
+        if entry is None or time.time() - entry[0] > NAMESPACES[namespace].ttl:
+            return default
+        return entry[1]
+
+    def set(self, namespace, key, value):
+        self._bucket(namespace)[key] = (time.time(), value)
+
+    def pop(self, namespace, key, default=None):
+        entry = self._bucket(namespace).pop(key, None)
+        return entry[1] if entry is not None else default
+
+    def order_ids(self):
+        """Every order id that still has order-scoped state."""
+        ids = set()
+        for namespace, spec in NAMESPACES.items():
+            if spec.scope == 'order':
+                ids.update(self._bucket(namespace))
+        return ids
+
+    def evict_order(self, order_id):
+        """Drops all order-scoped state for a completed or cancelled order."""
+        removed = 0
+        for namespace, spec in NAMESPACES.items():
+            if spec.scope == 'order' and self._bucket(namespace).pop(order_id, None) is not None:
+                removed += 1
+        return removed
+
+    def sweep(self, now=None):
+        """Removes expired entries from every namespace. Returns how many were removed."""
+        now = time.time() if now is None else now
+        removed = 0
+        for namespace, spec in NAMESPACES.items():
+            bucket = self._bucket(namespace)
+            expired = [key for key, (stored_at, _) in bucket.items() if now - stored_at > spec.ttl]
+            for key in expired:
+                del bucket[key]
+            removed += len(expired)
+        return removed
+
+    def counts(self):
+        """{namespace: stored entries}, expired ones included until the next sweep."""
+        return {namespace: len(self._bot_data.get(_PREFIX + namespace, ())) for namespace in NAMESPACES}
+
+    def size(self):
+        return sum(len(self._bucket(namespace)) for namespace in NAMESPACES)
+
+    def migrate_flat_keys(self):
+        """Moves legacy f'{namespace}_{id}' bot_data keys (from before this store existed) into their namespace."""
+        moved = 0
+        now = time.time()
+        for flat_key in [k for k in self._bot_data if isinstance(k, str)]:
+            for namespace in NAMESPACES:
+                prefix = namespace + '_'
+                if flat_key.startswith(prefix) and flat_key[len(prefix):].lstrip('-').isdigit():
+                    self._bucket(namespace)[int(flat_key[len(prefix):])] = (now, self._bot_data.pop(flat_key))
+                    moved += 1
+                    break
+        return moved
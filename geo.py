@@ -0,0 +1,182 @@
+import math
+import os
+
+import numpy as np
+
+from locations import RESTAURANTS, BLOCKS, ALLOWED_RADIUS
+
+EARTH_RADIUS = 6371000  # meters
+_METRES_PER_DEG = math.pi * EARTH_RADIUS / 180
+
+# Grid cell size in meters. Radius queries only look at the cells the circle touches,
+# so this should be around the radius usually asked for (arrival checks use 50-150m).
+GEO_CELL_METRES = float(os.getenv("GEO_CELL_METRES", 250))
+
+# Below this many candidates the per-call numpy overhead (~18us) costs more than scalar haversine (~1.4us each)
+_VECTOR_MIN = 16
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance in meters between two points."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+
+    a = math.sin(dphi/2)**2 + math.cos(phi1) * \
+        math.cos(phi2) * math.sin(dlambda/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return EARTH_RADIUS * c
+
+
+def haversine_many(lat, lon, lats, lons):
+    """Distances in meters from one point to arrays of points (vectorized haversine)."""
+    phi1 = math.radians(lat)
+    phi2 = np.radians(lats)
+    dphi = phi2 - phi1
+    dlambda = np.radians(lons) - math.radians(lon)
+
+    a = np.sin(dphi/2)**2 + math.cos(phi1) * np.cos(phi2) * np.sin(dlambda/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def distance_matrix(lats1, lons1, lats2, lons2):
+    """Distances in meters between every point of set 1 (rows) and every point of set 2 (columns)."""
+    phi1 = np.radians(np.asarray(lats1, dtype=float))[:, None]
+    phi2 = np.radians(np.asarray(lats2, dtype=float))[None, :]
+    dlambda = np.radians(np.asarray(lons2, dtype=float))[None, :] - np.radians(np.asarray(lons1, dtype=float))[:, None]
+
+    a = np.sin((phi2 - phi1)/2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex:
+    """Points bucketed into a fixed lat/lon grid for radius and nearest-neighbour lookups.
+
+    Keys are anything hashable (place names, order ids). Adding a key again moves it.
+    """
+
+    def __init__(self, cell_metres=GEO_CELL_METRES):
+        self.cell_deg = cell_metres / _METRES_PER_DEG
+        self._points = {}
+        self._cells = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def add(self, key, lat, lon):
+        if lat is None or lon is None:
+            self.remove(key)
+            return
+        self.remove(key)
+        self._points[key] = (lat, lon)
+        self._cells.setdefault(self._cell(lat, lon), set()).add(key)
+
+    def remove(self, key):
+        point = self._points.pop(key, None)
+        if point is None:
+            return
+        cell = self._cell(*point)
+        keys = self._cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+
+    def clear(self):
+        self._points.clear()
+        self._cells.clear()
+
+    def get(self, key):
+        return self._points.get(key)
+
+    def _candidates(self, lat, lon, radius):
+        # Cells overlapping the bounding box of the circle; longitude degrees shrink with cos(lat)
+        dlat = radius / _METRES_PER_DEG
+        dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+        lat0, lon0 = self._cell(lat - dlat, lon - dlon)
+        lat1, lon1 = self._cell(lat + dlat, lon + dlon)
+        if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > len(self._cells):
+            # Radius is large compared to the data: scanning the occupied cells is cheaper
+            return [key for keys in self._cells.values() for key in keys]
+        keys = []
+        for i in range(lat0, lat1 + 1):
+            for j in range(lon0, lon1 + 1):
+                keys.extend(self._cells.get((i, j), ()))
+        return keys
+
+    def within(self, lat, lon, radius):
+        """[(key, meters)] for every point within radius meters, nearest first."""
+        keys = self._candidates(lat, lon, radius)
+        if not keys:
+            return []
+        if len(keys) < _VECTOR_MIN:
+            found = [(key, haversine(lat, lon, *self._points[key])) for key in keys]
+            return sorted((item for item in found if item[1] <= radius), key=lambda item: item[1])
+        coords = np.array([self._points[key] for key in keys], dtype=float)
+        distances = haversine_many(lat, lon, coords[:, 0], coords[:, 1])
+        order = np.argsort(distances)
+        return [(keys[i], float(distances[i])) for i in order if distances[i] <= radius]
+
+    def nearest(self, lat, lon, max_radius=None):
+        """(key, meters) of the closest point, or None. Doubles the search radius until something is found."""
+        if not self._points:
+            return None
+        # Half the Earth's circumference covers every point
+        limit = math.pi * EARTH_RADIUS if max_radius is None else max_radius
+        radius = self.cell_deg * _METRES_PER_DEG
+        while True:
+            radius = min(radius, limit)
+            found = self.within(lat, lon, radius)
+            if found:
+                return found[0]
+            if radius >= limit:
+                return None
+            radius *= 2
+
+
+# Static places. dev_set_loc moves every place at once, so call rebuild_places() after editing the dicts.
+restaurants = GridIndex()
+blocks = GridIndex()
+
+# Delivery points of orders that are still in progress, keyed by order id
+active_deliveries = GridIndex()
+
+
+def rebuild_places():
+    restaurants.clear()
+    for name, (lat, lon) in RESTAURANTS.items():
+        restaurants.add(name, lat, lon)
+    blocks.clear()
+    for name, (lat, lon) in BLOCKS.items():
+        blocks.add(name, lat, lon)
+
+
+def nearest_block(lat, lon, max_radius=ALLOWED_RADIUS):
+    """(block name, meters) of the closest dorm block within max_radius, or None."""
+    return blocks.nearest(lat, lon, max_radius)
+
+
+def nearest_restaurant(lat, lon, max_radius=ALLOWED_RADIUS):
+    return restaurants.nearest(lat, lon, max_radius)
+
+
+def deliveries_within(lat, lon, radius):
+    """[(order_id, meters)] of active deliveries within radius meters of a point (e.g. a deliverer)."""
+    return active_deliveries.within(lat, lon, radius)
+
+
+def load_active_deliveries(orders):
+    """Replaces the active delivery index with the delivery points of the given orders."""
+    active_deliveries.clear()
+    for order in orders:
+        active_deliveries.add(order.order_id, order.delivery_lat, order.delivery_lon)
+
+
+rebuild_places()
@@ -0,0 +1,140 @@
+import logging
+import os
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# SQLite has no NOTIFY, so the log is polled this often (seconds)
+INVALIDATION_POLL_INTERVAL = float(os.getenv("INVALIDATION_POLL_INTERVAL", 1))
+# On PostgreSQL the log is still read this often in case a notification was missed (e.g. during a reconnect)
+INVALIDATION_PG_POLL_INTERVAL = float(os.getenv("INVALIDATION_PG_POLL_INTERVAL", 30))
+# Log rows older than this (seconds) are deleted
+INVALIDATION_RETENTION = int(os.getenv("INVALIDATION_RETENTION", 3600))
+# Rows are re-read this far behind the newest seen seq: a PostgreSQL transaction can commit
+# a lower seq after a higher one, and it must not be skipped
+_LOOKBACK = 100
+
+
+class InvalidationListener:
+    """Applies cache invalidations written by other processes (see database._publish).
+
+    Runs in a daemon thread. Handlers are registered per topic with on(topic, fn) and are
+    called as fn(keys) with the set of keys that changed since the last poll, so a burst
+    of changes to one topic costs one call. Rows this process wrote are skipped.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._listen_conn = None
+        self._last_seq = None
+        self._applied = set()
+        self._last_trim = 0.0
+        self.stats = {'applied': 0, 'polls': 0, 'notifies': 0}
+
+    def on(self, topic, fn):
+        self._handlers.setdefault(topic, []).append(fn)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        # Start from the current end of the log; everything before it is already in what the caller loaded
+        self._last_seq = database.latest_invalidation_seq()
+        self._applied = {row[0] for row in database.read_invalidations(max(self._last_seq - _LOOKBACK, 0))}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='invalidation', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._close_listen()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._wait()
+                self.poll()
+            except Exception as e:
+                logger.warning(f"Invalidation poll failed: {e}")
+                self._close_listen()
+                self._stop.wait(INVALIDATION_POLL_INTERVAL)
+
+    def _wait(self):
+        if not database.DATABASE_URL:
+            self._stop.wait(INVALIDATION_POLL_INTERVAL)
+            return
+        if self._listen_conn is None:
+            conn = psycopg2.connect(database.DATABASE_URL)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {database.INVALIDATION_CHANNEL}")
+            self._listen_conn = conn
+        # Wakes on a NOTIFY, or after the fallback interval; stop() is noticed within a second
+        deadline = time.monotonic() + INVALIDATION_PG_POLL_INTERVAL
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            if select.select([self._listen_conn], [], [], 1)[0]:
+                self._listen_conn.poll()
+                if self._listen_conn.notifies:
+                    self.stats['notifies'] += len(self._listen_conn.notifies)
+                    self._listen_conn.notifies.clear()
+                    return
+
+    def _close_listen(self):
+        if self._listen_conn is not None:
+            try:
+                self._listen_conn.close()
+            except Exception:
+                pass
+            self._listen_conn = None
+
+    def poll(self):
+        """Reads new log rows and runs the handlers for their topics. Returns the number of rows applied."""
+        self.stats['polls'] += 1
+        rows = database.read_invalidations(max(self._last_seq - _LOOKBACK, 0))
+        changed = {}
+        for seq, topic, key, origin in rows:
+            if seq in self._applied:
+                continue
+            self._applied.add(seq)
+            self._last_seq = max(self._last_seq, seq)
+            if origin != database.PROCESS_ORIGIN:
+                changed.setdefault(topic, set()).add(key)
+        floor = self._last_seq - _LOOKBACK
+        self._applied = {seq for seq in self._applied if seq > floor}
+
+        applied = 0
+        for topic, keys in changed.items():
+            for fn in self._handlers.get(topic, ()):
+                try:
+                    fn(keys)
+                except Exception as e:
+                    logger.warning(f"Invalidation handler for '{topic}' failed: {e}")
+            applied += len(keys)
+        self.stats['applied'] += applied
+
+        now = time.time()
+        if now - self._last_trim > INVALIDATION_RETENTION / 6:
+            self._last_trim = now
+            database.trim_invalidations(now - INVALIDATION_RETENTION)
+        return applied
+
+
+def _invalidate_users(keys):
+    for key in keys:
+        database.user_cache.invalidate(int(key))
+
+
+listener = InvalidationListener()
+# Caches that live in database.py; bots add their own topics (e.g. 'menu') before start()
+listener.on('user', _invalidate_users)
+listener.on('ban', lambda keys: database.load_banned_ids())
@@ -1,10 +1,12 @@
-from flask import Flask
+from flask import Flask, Response, jsonify, request, abort
 from threading import Thread
 import os
 import time
 import requests
 import logging
 
+import metrics
+
 # Configure logging: INFO for this script, ERROR for libraries
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
@@ -15,15 +17,35 @@ werkzeug_logger.setLevel(logging.ERROR)
 # Mute 'urllib3' (used by requests) just in case
 logging.getLogger('urllib3').setLevel(logging.ERROR)
 
+# If set, /metrics and /debug/state need ?token=... or an "Authorization: Bearer ..." header
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
 app = Flask('')
 
 @app.route('/')
 def home():
     return "I am alive"
 
-def run():
+def _check_token():
+    if not METRICS_TOKEN:
+        return
+    supplied = request.args.get('token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if supplied != METRICS_TOKEN:
+        abort(403)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    _check_token()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/state')
+def debug_state():
+    _check_token()
+    return jsonify(metrics.debug_state())
+
+def run(port=None):
     # Bind to the port provided by the hosting env (e.g., Render)
-    port = int(os.environ.get("PORT", 8080))
+    port = port or int(os.environ.get("PORT", 8080))
     try:
         app.run(host='0.0.0.0', port=port)
     except Exception as e:
@@ -68,9 +90,11 @@ def start_pinger(urls=None):
     p.daemon = True
     p.start()
 
-def keep_alive():
-    t = Thread(target=run)
+def start_server(port=None):
+    t = Thread(target=run, args=(port,))
     t.daemon = True
     t.start()
-    
+
+def keep_alive():
+    start_server()
     start_pinger()
@@ -0,0 +1,218 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+
+from telegram.ext import ApplicationHandlerStop
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, shared by every histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_STARTED = time.time()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram per label set, rendered in Prometheus text format."""
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def snapshot(self):
+        """{labels: (count, sum)}."""
+        with self._lock:
+            return {labels: (entry[2], entry[1]) for labels, entry in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, [list(entry[0]), entry[1], entry[2]]) for labels, entry in self._values.items())
+        for labels, (counts, total, count) in items:
+            running = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                running += n
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, [le])} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Values read from a callback at scrape time: fn() returns {label tuple: value} (or a number without labels).
+
+    kind='counter' is for totals something else already keeps (e.g. outbox.stats).
+    """
+
+    def __init__(self, name, help, labels, fn, kind='gauge'):
+        self.name, self.help, self.labels, self.fn, self.kind = name, help, tuple(labels), fn, kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items(), key=lambda item: str(item[0])):
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+handler_seconds = Histogram('bedorme_handler_seconds', 'Time spent in each update handler callback.', ['handler'])
+handler_errors = Counter('bedorme_handler_errors_total', 'Handler callbacks that raised.', ['handler'])
+db_seconds = Histogram('bedorme_db_seconds', 'Time spent in database.py helpers called through async_database, by function.', ['function'])
+telegram_seconds = Histogram('bedorme_telegram_request_seconds', 'Bot API request latency, by method.', ['method'])
+telegram_requests = Counter('bedorme_telegram_requests_total', 'Bot API requests by method and HTTP status (429 = flood control).', ['method', 'code'])
+
+_metrics = [handler_seconds, handler_errors, db_seconds, telegram_seconds, telegram_requests]
+# name -> fn() returning something JSON-serializable, for /debug/state
+_state = {}
+
+
+def gauge(name, help, labels, fn, kind='gauge'):
+    """Registers a gauge read at scrape time. A gauge registered again under the same name replaces the old one."""
+    _metrics[:] = [m for m in _metrics if m.name != name] + [Gauge(name, help, labels, fn, kind)]
+
+
+def state(name, fn):
+    """Registers a section of /debug/state."""
+    _state[name] = fn
+
+
+def render():
+    """Every metric in Prometheus text exposition format."""
+    lines = []
+    for metric in list(_metrics):
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            # One failing callback (e.g. the database is down) must not hide the rest
+            logger.warning(f"Metric {metric.name} failed: {e}")
+    lines.append("# HELP bedorme_uptime_seconds Seconds since this process started.")
+    lines.append("# TYPE bedorme_uptime_seconds gauge")
+    lines.append(f"bedorme_uptime_seconds {time.time() - _STARTED:.0f}")
+    return "\n".join(lines) + "\n"
+
+
+def debug_state():
+    """JSON-ready dict of every registered state section, plus handler and DB latency summaries."""
+    result = {'uptime': round(time.time() - _STARTED)}
+    for name, fn in list(_state.items()):
+        try:
+            result[name] = fn()
+        except Exception as e:
+            result[name] = {'error': str(e)}
+    for key, histogram in (('handlers', handler_seconds), ('db', db_seconds)):
+        result[key] = {labels[0]: {'count': count, 'avg_ms': round(total / count * 1000, 2)}
+                       for labels, (count, total) in sorted(histogram.snapshot().items(), key=lambda item: -item[1][1])}
+    result['telegram'] = {f"{method} {code}": n for (method, code), n in sorted(telegram_requests.snapshot().items())}
+    return result
+
+
+def timed_handler(callback, name=None):
+    """Wraps an async handler callback so its duration lands in bedorme_handler_seconds."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except ApplicationHandlerStop:
+            # Flow control (e.g. check_banned stopping the update), not a failure
+            raise
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+
+    wrapper.__wrapped_handler__ = True
+    return wrapper
+
+
+def instrument_handlers(application):
+    """Times every registered handler callback, including those inside ConversationHandlers and the callback router. Call once handlers are added."""
+    def visit(handler):
+        if hasattr(handler, 'entry_points'):
+            for inner in handler.entry_points + [h for hs in handler.states.values() for h in hs] + handler.fallbacks:
+                visit(inner)
+            return
+        callback = getattr(handler, 'callback', None)
+        routes = getattr(getattr(callback, '__self__', None), 'routes', None)
+        if isinstance(routes, dict):
+            # callbacks.CallbackRouter: time each action, not the shared dispatcher
+            for action, fn in routes.items():
+                if not getattr(fn, '__wrapped_handler__', False):
+                    routes[action] = timed_handler(fn)
+            return
+        if callback is not None and not getattr(callback, '__wrapped_handler__', False):
+            handler.callback = timed_handler(callback)
+
+    count = 0
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            visit(handler)
+            count += 1
+    return count
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that counts every Bot API call by method and status code, and times it."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        code = 'error'
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            return code, payload
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, api_method)
+            telegram_requests.inc(api_method, str(code))
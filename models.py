@@ -0,0 +1,115 @@
+from dataclasses import dataclass, fields
+from typing import Optional
+
+
+# Row objects returned by database.py. Field order matches the column lists the queries select,
+# so a row tuple maps straight onto the constructor: User(*row).
+# Treat them as read-only: user rows are shared through user_cache, so derive copies with dataclasses.replace().
+
+@dataclass(slots=True)
+class User:
+    user_id: int
+    username: Optional[str] = None
+    name: Optional[str] = None
+    student_id: Optional[str] = None
+    block: Optional[str] = None
+    dorm_number: Optional[str] = None
+    phone: Optional[str] = None
+    gender: Optional[str] = None
+    is_deliverer: int = 0
+    balance: float = 0
+    tokens: int = 0
+    language: Optional[str] = None
+    is_banned: int = 0
+
+
+@dataclass(slots=True)
+class Order:
+    order_id: int
+    customer_id: Optional[int] = None
+    deliverer_id: Optional[int] = None
+    restaurant: Optional[str] = None
+    items: Optional[str] = None
+    total_price: Optional[float] = None
+    status: str = 'pending'
+    order_type: str = 'regular'
+    verification_code: Optional[str] = None
+    mid_delivery_proof: Optional[str] = None
+    proof_timestamp: Optional[float] = None
+    delivery_proof: Optional[str] = None
+    delivery_lat: Optional[float] = None
+    delivery_lon: Optional[float] = None
+    pickup_lat: Optional[float] = None
+    pickup_lon: Optional[float] = None
+    created_at: Optional[float] = None
+    delivered_at: Optional[float] = None
+    admin_message_id: Optional[int] = None
+    status_changed_at: Optional[float] = None
+
+
+@dataclass(slots=True)
+class Contract:
+    id: int
+    user_id: Optional[int] = None
+    cafe_name: Optional[str] = None
+    phone: Optional[str] = None
+    username: Optional[str] = None
+    full_name: Optional[str] = None
+    contract_id: Optional[str] = None
+    list_order: Optional[int] = None
+    total_paid: float = 0
+    balance_used: float = 0
+    current_balance: float = 0
+    credit_meals: int = 0
+    start_date: Optional[float] = None
+
+
+@dataclass(slots=True)
+class OrderItem:
+    item_id: int
+    order_id: int
+    restaurant: Optional[str] = None
+    item: Optional[str] = None
+    price: float = 0
+    delivery_fee: float = 0
+    pickup_lat: Optional[float] = None
+    pickup_lon: Optional[float] = None
+
+
+# Order lifecycle: each status and the statuses it may move to. database.transition_order() is the only
+# writer of orders.status and refuses anything not listed here.
+# about_to_pay -> accepted is the customer declining the purchase; contract orders skip the payment steps.
+ORDER_TRANSITIONS = {
+    'pending': ('accepted', 'cancelled'),
+    'accepted': ('about_to_pay', 'arrived', 'complete', 'cancelled'),
+    'about_to_pay': ('accepted', 'confirmed', 'arrived', 'cancelled'),
+    'confirmed': ('arrived', 'paid', 'complete'),
+    'arrived': ('paid', 'complete'),
+    'paid': ('complete',),
+    'complete': (),
+    'cancelled': (),
+}
+# Orders still in progress, and the subset a deliverer is holding
+ACTIVE_STATUSES = tuple(status for status, after in ORDER_TRANSITIONS.items() if after)
+HELD_STATUSES = tuple(status for status in ACTIVE_STATUSES if status != 'pending')
+
+
+USER_COLUMNS = tuple(f.name for f in fields(User))
+ORDER_COLUMNS = tuple(f.name for f in fields(Order))
+CONTRACT_COLUMNS = tuple(f.name for f in fields(Contract))
+ORDER_ITEM_COLUMNS = tuple(f.name for f in fields(OrderItem))
+
+
+def from_row(cls, row):
+    """Builds a row object from a tuple in column order, or returns None for a missing row."""
+    return cls(*row) if row else None
+
+
+def from_rows(cls, rows):
+    return [cls(*row) for row in rows]
+
+
+def as_tuple(obj):
+    """Values in column order, e.g. for CSV export."""
+    return tuple(getattr(obj, f.name) for f in fields(obj))
+
@@ -0,0 +1,339 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from geo import haversine
+
+logger = logging.getLogger(__name__)
+
+# Priority classes: lower goes first when several messages are waiting
+PRIORITY_PAYMENT = 0
+PRIORITY_ORDER = 1
+PRIORITY_TRACKING = 2
+
+# Telegram limits: ~30 messages/s per bot, 20 messages/min per group, ~1 message/s per private chat
+OUTBOX_GLOBAL_PER_SEC = float(os.getenv("OUTBOX_GLOBAL_PER_SEC", 30))
+OUTBOX_GROUP_PER_MIN = float(os.getenv("OUTBOX_GROUP_PER_MIN", 20))
+OUTBOX_GROUP_BURST = int(os.getenv("OUTBOX_GROUP_BURST", 5))
+OUTBOX_PRIVATE_PER_SEC = float(os.getenv("OUTBOX_PRIVATE_PER_SEC", 1))
+OUTBOX_PRIVATE_BURST = int(os.getenv("OUTBOX_PRIVATE_BURST", 3))
+# A message that keeps getting RetryAfter is dropped (with the error raised to the caller) after this many tries
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", 5))
+# Live-location edits: at most one per message per interval (seconds), and none for moves under this many metres
+LIVE_EDIT_INTERVAL = float(os.getenv("LIVE_EDIT_INTERVAL", 15))
+LIVE_EDIT_MIN_METRES = float(os.getenv("LIVE_EDIT_MIN_METRES", 20))
+
+# Bot methods that post to a chat and therefore count against its limits
+_ROUTED = {
+    'send_message', 'send_photo', 'send_location', 'send_document',
+    'edit_message_text', 'edit_message_live_location', 'edit_message_reply_markup',
+}
+
+
+class _TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # Set from RetryAfter: Telegram told us to leave this chat alone until then
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Request:
+    __slots__ = ('method', 'chat_id', 'kwargs', 'future', 'attempts', 'not_before')
+
+    def __init__(self, method, chat_id, kwargs, future):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class _LiveMessage:
+    __slots__ = ('sent_point', 'sent_at', 'pending', 'timer', 'inflight')
+
+    def __init__(self):
+        self.sent_point = None
+        self.sent_at = 0.0
+        self.pending = None
+        self.timer = None
+        # Future of the edit queued or being sent; the next one is not queued until it resolves
+        self.inflight = None
+
+
+class Outbox:
+    """Central queue for outgoing Telegram messages.
+
+    Every routed call (``await outbox.send_message(chat_id=..., text=..., priority=...)``)
+    waits for a token from its chat's bucket and from the global bucket, so bursts are
+    spread out instead of tripping 429s. When several messages are ready, the lowest
+    priority class goes first. A RetryAfter pauses that chat and re-queues the message.
+    The call returns whatever the Bot method returns, or raises its error.
+
+    Handlers that do not need the result use ``outbox.post('send_message', chat_id=..., ...)``
+    instead, which queues the message and returns at once, so a busy group chat never holds
+    up the rest of the handler.
+    """
+
+    def __init__(self):
+        self._bot = None
+        self._queues = {}
+        self._buckets = {}
+        self._global = None
+        self._seq = itertools.count()
+        self._pending = 0
+        self._wakeup = None
+        self._worker = None
+        self._inflight = set()
+        # (chat_id, message_id) -> _LiveMessage, and -> (error, time) from coalesced edits waiting to be reported
+        self._live = {}
+        self._live_errors = {}
+        self.stats = {'sent': 0, 'failed': 0, 'retry_after': 0, 'live_coalesced': 0, 'live_skipped': 0}
+
+    def start(self, bot):
+        loop = asyncio.get_running_loop()
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._global = _TokenBucket(OUTBOX_GLOBAL_PER_SEC, OUTBOX_GLOBAL_PER_SEC, loop.time())
+        self._worker = asyncio.create_task(self._run(), name='outbox')
+
+    async def stop(self, timeout=10):
+        """Gives queued messages up to `timeout` seconds to go out, then cancels the rest."""
+        if self._worker is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self._pending or self._inflight) and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        self._worker.cancel()
+        for live in self._live.values():
+            if live.timer is not None:
+                live.timer.cancel()
+        self._live.clear()
+        self._live_errors.clear()
+        for heap in self._queues.values():
+            for *_, request in heap:
+                request.future.cancel()
+        self._queues.clear()
+        self._pending = 0
+        self._worker = None
+
+    @property
+    def pending(self):
+        """Requests queued and not yet sent."""
+        return self._pending
+
+    def __getattr__(self, name):
+        if name not in _ROUTED:
+            raise AttributeError(f"Outbox does not route '{name}'")
+
+        async def call(*, chat_id, priority=PRIORITY_ORDER, **kwargs):
+            return await self.submit(name, chat_id, priority, **kwargs)
+
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+
+    def submit(self, method, chat_id, priority=PRIORITY_ORDER, **kwargs):
+        """Queues a Bot method call and returns a future for its result."""
+        if self._worker is None:
+            raise RuntimeError("Outbox has not been started")
+        future = asyncio.get_running_loop().create_future()
+        kwargs['chat_id'] = chat_id
+        self._push(priority, _Request(method, chat_id, kwargs, future))
+        return future
+
+    def post(self, method, chat_id, priority=PRIORITY_ORDER, **kwargs):
+        """Fire-and-forget submit(): queues the call and returns its future; a failure is only logged."""
+        future = self.submit(method, chat_id, priority, **kwargs)
+        future.add_done_callback(lambda f: self._log_failure(method, chat_id, f))
+        return future
+
+    def _log_failure(self, method, chat_id, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"Outbox: {method} to chat {chat_id} failed: {future.exception()}")
+
+    async def edit_live_location(self, chat_id, message_id, latitude, longitude):
+        """Moves a live location, coalescing rapid updates into one edit per message per LIVE_EDIT_INTERVAL.
+
+        Only the newest point is kept while an edit is waiting, and points within LIVE_EDIT_MIN_METRES
+        of what the message already shows are dropped. A message never has more than one edit in
+        the queue: the next one is scheduled only once the previous one has gone out, so a busy
+        chat (the admin group's 20/min) gets fewer tracking edits rather than a growing backlog. The edit happens in the background, so an error
+        from it (e.g. the message was deleted) is raised by the next call for the same message,
+        which lets the caller fall back to sending a fresh location.
+        """
+        key = (chat_id, message_id)
+        error, _ = self._live_errors.pop(key, (None, None))
+        if error is not None:
+            raise error
+        live = self._live.get(key)
+        if live is None:
+            live = self._live[key] = _LiveMessage()
+        point = (latitude, longitude)
+        if live.sent_point is not None and haversine(*live.sent_point, *point) < LIVE_EDIT_MIN_METRES:
+            live.pending = None
+            self.stats['live_skipped'] += 1
+            return
+        if live.pending is not None:
+            self.stats['live_coalesced'] += 1
+        live.pending = point
+        self._arm_live(key, live)
+
+    def _arm_live(self, key, live):
+        if live.timer is None and live.inflight is None:
+            loop = asyncio.get_running_loop()
+            delay = max(0.0, live.sent_at + LIVE_EDIT_INTERVAL - loop.time())
+            live.timer = loop.call_later(delay, self._flush_live, key)
+
+    def _flush_live(self, key):
+        live = self._live.get(key)
+        if live is None:
+            return
+        live.timer = None
+        if live.pending is None or self._worker is None:
+            return
+        (latitude, longitude), live.pending = live.pending, None
+        live.sent_point = (latitude, longitude)
+        live.sent_at = asyncio.get_running_loop().time()
+        chat_id, message_id = key
+        live.inflight = self.submit('edit_message_live_location', chat_id, PRIORITY_TRACKING,
+                                    message_id=message_id, latitude=latitude, longitude=longitude)
+        live.inflight.add_done_callback(lambda f: self._live_done(key, f))
+
+    def _live_done(self, key, future):
+        live = self._live.get(key)
+        if live is not None and live.inflight is future:
+            live.inflight = None
+        error = None if future.cancelled() else future.exception()
+        if error is not None and 'not modified' not in str(error).lower():
+            self._live.pop(key, None)
+            self._live_errors[key] = (error, asyncio.get_running_loop().time())
+            return
+        # Points that arrived while this edit was queued go out in the next one
+        if live is not None and live.pending is not None:
+            self._arm_live(key, live)
+
+    def prune_live(self, max_age=3600):
+        """Forgets live messages, and unreported edit errors, untouched for max_age seconds (live periods are an hour)."""
+        now = asyncio.get_running_loop().time()
+        stale = [key for key, live in self._live.items()
+                 if live.timer is None and live.inflight is None and now - live.sent_at > max_age]
+        for key in stale:
+            del self._live[key]
+        expired = [key for key, (_, failed_at) in self._live_errors.items() if now - failed_at > max_age]
+        for key in expired:
+            del self._live_errors[key]
+        return len(stale) + len(expired)
+
+    def _push(self, priority, request):
+        heapq.heappush(self._queues.setdefault(request.chat_id, []), (priority, next(self._seq), request))
+        self._pending += 1
+        self._wakeup.set()
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups/channels
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = _TokenBucket(OUTBOX_GROUP_PER_MIN / 60, OUTBOX_GROUP_BURST, now)
+            else:
+                bucket = _TokenBucket(OUTBOX_PRIVATE_PER_SEC, OUTBOX_PRIVATE_BURST, now)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = loop.time()
+            best, best_key, wait = None, None, None
+            for chat_id, heap in self._queues.items():
+                priority, seq, request = heap[0]
+                chat_wait = max(self._bucket(chat_id, now).wait_time(now), request.not_before - now)
+                if chat_wait <= 0:
+                    if best_key is None or (priority, seq) < best_key:
+                        best, best_key = chat_id, (priority, seq)
+                elif wait is None or chat_wait < wait:
+                    wait = chat_wait
+
+            if best is None:
+                # Nothing sendable yet: sleep until the nearest chat frees up or something new arrives
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            heap = self._queues[best]
+            _, _, request = heapq.heappop(heap)
+            if not heap:
+                del self._queues[best]
+            self._pending -= 1
+            self._buckets[best].take()
+            self._global.take()
+            task = asyncio.create_task(self._deliver(request))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, request):
+        if request.future.cancelled():
+            return
+        request.attempts += 1
+        try:
+            result = await getattr(self._bot, request.method)(**request.kwargs)
+        except RetryAfter as e:
+            self.stats['retry_after'] += 1
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            logger.warning(f"Outbox: RetryAfter {delay}s for chat {request.chat_id} ({request.method})")
+            if request.attempts >= OUTBOX_MAX_RETRIES:
+                self.stats['failed'] += 1
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            now = asyncio.get_running_loop().time()
+            self._bucket(request.chat_id, now).blocked_until = now + delay
+            request.not_before = now + delay
+            # Back to the front of its chat's queue, ahead of anything queued since
+            self._push(-1, request)
+        except Exception as e:
+            self.stats['failed'] += 1
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            self.stats['sent'] += 1
+            if not request.future.done():
+                request.future.set_result(result)
+
+
+outbox = Outbox()
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from async_database import db
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+class DatabasePersistence(BasePersistence):
+    """Stores bot state in the persistence_data table, one row per key.
+
+    PicklePersistence rewrites the whole file on every flush. Here each bot_data key,
+    user, chat and conversation entry is its own pickled row, so an update interval
+    only writes what actually changed (detected by comparing pickle digests).
+
+    user_data and chat_data are loaded lazily: nothing is read at startup, and a
+    user's row is fetched the first time one of their updates is processed.
+    bot_data and conversation states are small and needed up front, so they load eagerly.
+    """
+
+    def __init__(self, store_data=None, update_interval=60, legacy_pickle=None):
+        if store_data is None:
+            store_data = PersistenceInput(callback_data=False)
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        # Optional PicklePersistence file to import once, when the table is still empty
+        self.legacy_pickle = legacy_pickle
+        self._legacy_data = None
+        # kind -> {row key -> digest of what is in the database}
+        self._digests = {}
+        # user/chat ids whose rows have already been merged into the in-memory dicts
+        self._refreshed = {'user': set(), 'chat': set()}
+        self._unpicklable = set()
+
+    # --- encoding ---
+
+    @staticmethod
+    def _row_key(key):
+        # bot_data keys keep their type through the pickled (key, value) pair; the row key is only an identity
+        return json.dumps(list(key)) if isinstance(key, tuple) else repr(key)
+
+    def _dump(self, kind, key, value):
+        try:
+            return pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            # One unpicklable value must not stop the rest of the state from being saved
+            if (kind, key) not in self._unpicklable:
+                self._unpicklable.add((kind, key))
+                logger.warning(f"Not persisting {kind} key {key!r}: {e}")
+            return None
+
+    async def _load_kind(self, kind):
+        rows = await db.load_persisted(kind)
+        digests = self._digests.setdefault(kind, {})
+        result = {}
+        for row_key, blob in rows.items():
+            try:
+                key, value = pickle.loads(blob)
+            except Exception as e:
+                logger.warning(f"Dropping unreadable persisted {kind} row {row_key}: {e}")
+                continue
+            digests[row_key] = _digest(blob)
+            result[key] = value
+        return result
+
+    async def _save_changes(self, kind, items, replace_all=False):
+        """Writes the (key, value) pairs whose pickles changed. With replace_all, rows missing from items are deleted."""
+        digests = self._digests.setdefault(kind, {})
+        changed, seen = [], set()
+        for key, value in items:
+            row_key = self._row_key(key)
+            seen.add(row_key)
+            blob = self._dump(kind, key, value)
+            if blob is None:
+                continue
+            digest = _digest(blob)
+            if digests.get(row_key) != digest:
+                changed.append((row_key, blob, digest))
+        deleted = [row_key for row_key in digests if row_key not in seen] if replace_all else []
+        if not changed and not deleted:
+            return
+        await db.save_persisted(kind, [(row_key, blob) for row_key, blob, _ in changed], deleted)
+        for row_key, _, digest in changed:
+            digests[row_key] = digest
+        for row_key in deleted:
+            digests.pop(row_key, None)
+
+    # --- legacy import ---
+
+    async def _legacy(self, section):
+        """Returns one section of the old PicklePersistence file, if it is being imported."""
+        if self._legacy_data is None:
+            self._legacy_data = {}
+            if self.legacy_pickle and os.path.exists(self.legacy_pickle) and not await db.load_persisted('bot'):
+                try:
+                    with open(self.legacy_pickle, 'rb') as f:
+                        self._legacy_data = pickle.load(f)
+                    logger.info(f"Importing state from {self.legacy_pickle}")
+                except Exception as e:
+                    logger.warning(f"Could not import {self.legacy_pickle}: {e}")
+        return self._legacy_data.get(section) or {}
+
+    # --- BasePersistence API ---
+
+    async def get_bot_data(self):
+        legacy = await self._legacy('bot_data')
+        if legacy:
+            await self._save_changes('bot', legacy.items(), replace_all=True)
+            return dict(legacy)
+        return await self._load_kind('bot')
+
+    async def get_user_data(self):
+        for user_id, data in (await self._legacy('user_data')).items():
+            await self.update_user_data(user_id, data)
+        # Loaded per user in refresh_user_data
+        return {}
+
+    async def get_chat_data(self):
+        for chat_id, data in (await self._legacy('chat_data')).items():
+            await self.update_chat_data(chat_id, data)
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        legacy = (await self._legacy('conversations')).get(name)
+        if legacy:
+            await self._save_changes(f'conv:{name}', legacy.items(), replace_all=True)
+            return dict(legacy)
+        return await self._load_kind(f'conv:{name}')
+
+    async def update_conversation(self, name, key, new_state):
+        kind = f'conv:{name}'
+        if new_state is None:
+            row_key = self._row_key(key)
+            if row_key in self._digests.get(kind, {}):
+                await db.save_persisted(kind, deleted=[row_key])
+                self._digests[kind].pop(row_key, None)
+            return
+        await self._save_changes(kind, [(key, new_state)])
+
+    async def update_bot_data(self, data):
+        await self._save_changes('bot', data.items(), replace_all=True)
+
+    async def update_user_data(self, user_id, data):
+        await self._save_changes('user', [(user_id, data)])
+
+    async def update_chat_data(self, chat_id, data):
+        await self._save_changes('chat', [(chat_id, data)])
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        await self._drop('user', user_id)
+
+    async def drop_chat_data(self, chat_id):
+        await self._drop('chat', chat_id)
+
+    async def _drop(self, kind, key):
+        row_key = self._row_key(key)
+        await db.save_persisted(kind, deleted=[row_key])
+        self._digests.get(kind, {}).pop(row_key, None)
+        self._refreshed[kind].discard(key)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh('chat', chat_id, chat_data)
+
+    async def _refresh(self, kind, key, target):
+        # Runs before every update; only the first one per id touches the database
+        if key in self._refreshed[kind]:
+            return
+        self._refreshed[kind].add(key)
+        row_key = self._row_key(key)
+        blob = await db.load_persisted_key(kind, row_key)
+        if blob is None:
+            return
+        try:
+            _, value = pickle.loads(blob)
+        except Exception as e:
+            logger.warning(f"Dropping unreadable persisted {kind} row {row_key}: {e}")
+            return
+        self._digests.setdefault(kind, {})[row_key] = _digest(blob)
+        # Anything set before the first refresh (there shouldn't be) wins over the stored copy
+        target.update({k: v for k, v in value.items() if k not in target})
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Every update_* call already wrote its changes
+        if self._legacy_data and self.legacy_pickle and os.path.exists(self.legacy_pickle):
+            os.replace(self.legacy_pickle, self.legacy_pickle + '.imported')
+            self._legacy_data = {}
+
+    async def reset(self):
+        """Deletes all stored user, chat and bot state (used by the admin 'Intentional restart' reset)."""
+        await db.clear_persisted(['user', 'chat', 'bot'])
+        for kind in ('user', 'chat', 'bot'):
+            self._digests.pop(kind, None)
+        for ids in self._refreshed.values():
+            ids.clear()
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """A new SQLite database for one test, with the in-process caches emptied."""
+    path = str(tmp_path / 'bedorme.db')
+    database.close_pool()
+    monkeypatch.setattr(database, 'DATABASE_URL', None)
+    monkeypatch.setattr(database, 'DB_PATH', path)
+    monkeypatch.setattr(database._pool, 'path', path)
+    database.init_db()
+    database.user_cache.clear()
+    database._location_buffer.clear()
+    yield path
+    database.close_pool()
+
+
+@pytest.fixture
+def count_queries(monkeypatch):
+    """Counts database.execute_query calls; returns the list of statements run."""
+    statements = []
+    real = database.execute_query
+
+    def counting(conn, query, params=()):
+        statements.append(query)
+        return real(conn, query, params)
+
+    monkeypatch.setattr(database, 'execute_query', counting)
+    return statements
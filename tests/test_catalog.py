@@ -0,0 +1,26 @@
+import database
+from catalog import MenuCatalog, item_button
+
+MENUS = {'Alpha': {'Tea': 10, 'Bread': 5}, 'Beta': {'Juice': 30}}
+
+
+def test_reload_reads_only_the_given_restaurants(fresh_db):
+    catalog = MenuCatalog(menus=MENUS, contract_menus={})
+    catalog.reload()
+    # Another process takes one item off each menu
+    with database.db_connection() as conn:
+        database.execute_query(conn, "INSERT INTO unavailable_items (restaurant, item) VALUES (?, ?)", ('Alpha', 'Tea'))
+        database.execute_query(conn, "INSERT INTO unavailable_items (restaurant, item) VALUES (?, ?)", ('Beta', 'Juice'))
+        conn.commit()
+
+    assert catalog.reload({'Alpha'}) == {'Alpha'}
+    assert not catalog.is_available('Alpha', 'Tea')
+    assert catalog.is_available('Alpha', 'Bread')
+    # Beta is left as it was until its own invalidation arrives
+    assert catalog.is_available('Beta', 'Juice')
+    assert [button.text for row in catalog.item_keyboard('Alpha').keyboard for button in row] == [item_button('Bread', 5)]
+
+    assert catalog.reload({'Beta'}) == {'Beta'}
+    assert not catalog.is_available('Beta', 'Juice')
+    assert not catalog.is_available('Alpha', 'Tea')
+
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import database
+from ephemeral import NAMESPACES, EphemeralStore
+from persistence import DatabasePersistence
+
+ENTRIES = 200
+ROUNDS = 5
+# Past the longest TTL, so everything written in a round has expired by the next sweep
+STEP = max(spec.ttl for spec in NAMESPACES.values()) + 1
+
+
+def test_store_stays_bounded_as_entries_expire(fresh_db, monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    bot_data = {}
+    store = EphemeralStore(bot_data)
+    persistence = DatabasePersistence()
+
+    async def persisted_bytes():
+        await persistence.update_bot_data(bot_data)
+        return database.get_persisted_sizes()['bot'][1]
+
+    async def soak():
+        peaks, floors = [], []
+        for round_no in range(ROUNDS):
+            # Fresh ids every round, as new orders and users keep arriving (all pickled at the same width)
+            for i in range(ENTRIES):
+                key = 100_000 + round_no * ENTRIES + i
+                for namespace in NAMESPACES:
+                    store.set(namespace, key, {'message_id': key, 'note': 'x' * 20})
+            assert store.counts() == {namespace: ENTRIES for namespace in NAMESPACES}
+            peaks.append(await persisted_bytes())
+
+            clock[0] += STEP
+            assert store.sweep() == ENTRIES * len(NAMESPACES)
+            assert store.size() == 0
+            floors.append(await persisted_bytes())
+        return peaks, floors
+
+    peaks, floors = asyncio.run(soak())
+    # Expired entries leave nothing behind: every sweep gets back to the same empty buckets
+    assert len(set(floors)) == 1
+    assert floors[0] < peaks[0]
+    # and each round costs the same, rather than growing with everything written before it
+    assert len(set(peaks)) == 1
@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bedorme
+import database
+from outbox import outbox
+from workflow import workflow
+
+CUSTOMER, DELIVERER = 10, 20
+# Drop-off well away from where the deliverer is, so no arrival is triggered
+DROP_OFF = (9.0300, 38.7600)
+DELIVERER_AT = (9.0400, 38.7700)
+
+
+class FakeBot:
+    async def send_message(self, **kwargs):
+        return SimpleNamespace(message_id=100)
+
+    send_location = edit_message_text = edit_message_live_location = send_message
+
+
+def location_update(user_id, lat, lon, chat_id=None):
+    message = SimpleNamespace(chat_id=chat_id or user_id, from_user=SimpleNamespace(id=user_id),
+                              location=SimpleNamespace(latitude=lat, longitude=lon))
+    return SimpleNamespace(update_id=1, effective_message=message)
+
+
+@pytest.fixture
+def order(fresh_db):
+    database.add_user(CUSTOMER, 'cust', 'Customer', 'S1', 'B1', '101', '0911')
+    database.add_user(DELIVERER, 'deliv', 'Deliverer', 'S2', 'B2', '202', '0922')
+    order_id = database.create_order(CUSTOMER, 'R', 'item', 100, '1234', lat=DROP_OFF[0], lon=DROP_OFF[1])
+    assert database.assign_deliverer(order_id, DELIVERER)
+    bedorme.last_location_update.clear()
+    bedorme.active_deliveries.clear()
+    return order_id
+
+
+async def steady_state(order_id):
+    """Relay and admin live-location messages already exist, as after the first update of a delivery."""
+    outbox.start(FakeBot())
+    await workflow.load()
+    await workflow.put('tracking_relays', DELIVERER, {'chat_id': CUSTOMER, 'message_id': 7, 'order_id': order_id})
+    for user_id in (CUSTOMER, DELIVERER):
+        await workflow.put('admin_live', user_id, {'message_id': 8, 'order_id': order_id})
+
+
+def run_update(order_id, count_queries, update):
+    async def run():
+        await steady_state(order_id)
+        context = SimpleNamespace(bot_data={})
+        count_queries.clear()
+        await bedorme.relay_location_updates(update, context)
+        statements = list(count_queries)
+        await outbox.stop(timeout=0)
+        return statements
+
+    return asyncio.run(run())
+
+
+def test_customer_location_update_is_one_query(order, count_queries):
+    statements = run_update(order, count_queries, location_update(CUSTOMER, *DROP_OFF))
+    assert statements == [database._ACTIVE_ORDER_CONTEXT_SQL]
+
+
+def test_deliverer_location_update_is_one_query(order, count_queries):
+    # The arrival check reuses the order and customer from the joined query
+    statements = run_update(order, count_queries, location_update(DELIVERER, *DELIVERER_AT, chat_id=bedorme.ADMIN_CHAT_ID))
+    assert statements == [database._ACTIVE_ORDER_CONTEXT_SQL]
@@ -0,0 +1,15 @@
+import database
+
+CUSTOMER, FIRST, SECOND = 10, 111, 222
+
+
+def test_second_accept_does_not_take_a_held_order(fresh_db):
+    database.add_user(CUSTOMER, 'cust', 'Customer', 'S1', 'B1', '101', '0911')
+    order_id = database.create_order(CUSTOMER, 'R', 'item', 100, '1234')
+    assert database.assign_deliverer(order_id, FIRST)
+    assert database.transition_order(order_id, 'about_to_pay')
+
+    # about_to_pay -> accepted is allowed, but not as a way for another deliverer to claim the order
+    assert not database.assign_deliverer(order_id, SECOND)
+    order = database.get_order(order_id)
+    assert (order.status, order.deliverer_id) == ('about_to_pay', FIRST)
@@ -0,0 +1,92 @@
+import asyncio
+import contextlib
+import os
+
+from telegram.ext import BaseUpdateProcessor
+
+# Updates handled at the same time (across different users). 1 restores strictly sequential processing.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 32))
+# Updates admitted beyond that, waiting for their user's previous update to finish
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", 4 * CONCURRENT_UPDATES))
+
+
+class KeyedLocks:
+    """asyncio locks by key, created on first use and dropped when nobody holds or waits for them.
+
+    The map only ever holds keys with an update in flight, so it is bounded by the
+    processor's admission limit rather than by the number of users ever seen.
+    """
+
+    def __init__(self):
+        # key -> [lock, holders + waiters]
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __contains__(self, key):
+        return key in self._locks
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def update_key(update):
+    """What an update is serialized on: its user, else its chat, else nothing."""
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return ('user', user.id)
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return ('chat', chat.id)
+    return None
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently and each user's updates in arrival order.
+
+    One user's conversation steps and button clicks (e.g. confirm against cancel on the same
+    order) never interleave, so ConversationHandler state and read-then-write handlers behave
+    as they did with sequential processing. asyncio.Lock wakes waiters first come first served,
+    and PTB starts the processing tasks in arrival order, so order within a user is kept.
+
+    The base class semaphore admits limit + backlog updates; the `limit` running slots are taken
+    only once an update holds its user's lock, so a user with a queue of clicks does not sit on
+    slots other users could run in.
+    """
+
+    def __init__(self, limit=CONCURRENT_UPDATES, backlog=UPDATE_BACKLOG):
+        super().__init__(limit + backlog)
+        self.limit = limit
+        self.locks = KeyedLocks()
+        self._running = asyncio.BoundedSemaphore(limit)
+        self.stats = {'processed': 0, 'waited': 0}
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+        else:
+            if key in self.locks:
+                self.stats['waited'] += 1
+            async with self.locks.hold(key), self._running:
+                await coroutine
+        self.stats['processed'] += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
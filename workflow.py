@@ -0,0 +1,305 @@
+import json
+import os
+import threading
+import time
+
+import database
+from async_database import db
+
+# 'database' shares the state with every worker through the workflow_state table.
+# 'cached' writes through to the same table but answers reads from a copy in this process (one worker only).
+# 'memory' keeps it in this process only (one worker, local runs without a shared database).
+# 'auto' is 'cached' on SQLite, where every query waits on the one database thread, and 'database' otherwise.
+WORKFLOW_BACKEND = os.getenv("WORKFLOW_BACKEND", "auto").lower()
+# How many times update() re-reads and retries after losing a compare-and-set race
+WORKFLOW_CAS_RETRIES = int(os.getenv("WORKFLOW_CAS_RETRIES", 5))
+# Deleted entries stay behind as tombstones this long (seconds) so their version is not reused
+WORKFLOW_TOMBSTONE_TTL = int(os.getenv("WORKFLOW_TOMBSTONE_TTL", 3600))
+
+# Order workflow state that used to live in one process's bot_data, with a TTL backstop like ephemeral.py.
+# The order status itself is in the orders table (database.transition_order); these are message ids and relays.
+# Keys are Telegram user ids or order ids. scope says which: order-scoped entries are dropped by forget_order().
+NAMESPACES = {
+    # order_id -> {'message_id', 'accepted', 'admin_id'} for the admin group order message
+    'admin_orders': (48 * 3600, 'order'),
+    # order_id -> {'chat_id', 'message_id'} of the customer's cancel button
+    'user_cancel_msgs': (48 * 3600, 'order'),
+    # deliverer id -> {'chat_id', 'message_id', 'order_id'}: where their live location is relayed
+    'tracking_relays': (48 * 3600, 'user'),
+    # customer id -> {'message_id', 'order_id', ...}: the customer's live location in the admin group
+    'admin_live': (48 * 3600, 'user'),
+    'pending_order': (6 * 3600, 'user'),
+    # customer id -> order_id while we wait for their payment screenshot
+    'waiting_payment_proof': (24 * 3600, 'user'),
+}
+
+
+class ConflictError(Exception):
+    """update() lost the compare-and-set race WORKFLOW_CAS_RETRIES times in a row."""
+
+
+def _decode_key(key):
+    return int(key) if key.lstrip('-').isdigit() else key
+
+
+class MemoryBackend:
+    """In-process stand-in for the workflow_state table, with the same versioning rules."""
+
+    # Methods WorkflowStore runs on the database executor
+    blocking = frozenset()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (namespace, str key) -> [json or None, version, expires_at]
+        self._rows = {}
+
+    def replace(self, rows):
+        """Replaces the contents with [(namespace, key, json, version, expires_at)] rows."""
+        loaded = {(namespace, str(key)): [value, version, expires_at] for namespace, key, value, version, expires_at in rows}
+        with self._lock:
+            self._rows = loaded
+
+    def store(self, namespace, key, value, version, expires_at):
+        """Sets a row unconditionally, for a copy of a table that already did the compare-and-set."""
+        with self._lock:
+            self._rows[(namespace, str(key))] = [value, version, expires_at]
+
+    def get(self, namespace, key, now=None):
+        now = time.time() if now is None else now
+        row = self._rows.get((namespace, str(key)))
+        if row is None:
+            return None, 0
+        value, version, expires_at = row
+        return (value if expires_at is None or expires_at >= now else None), version
+
+    def items(self, namespace, now=None):
+        now = time.time() if now is None else now
+        return {key: value for (ns, key), (value, _, expires_at) in list(self._rows.items())
+                if ns == namespace and value is not None and (expires_at is None or expires_at >= now)}
+
+    def cas(self, namespace, key, expected_version, value, expires_at):
+        with self._lock:
+            row = self._rows.get((namespace, str(key)))
+            version = row[1] if row else 0
+            if version != expected_version:
+                return False
+            self._rows[(namespace, str(key))] = [value, version + 1, expires_at]
+            return True
+
+    def clear(self, namespaces):
+        with self._lock:
+            for row_key in [k for k in self._rows if k[0] in namespaces]:
+                del self._rows[row_key]
+
+    def counts(self, now=None):
+        now = time.time() if now is None else now
+        counts = {}
+        for (namespace, _), (value, _, expires_at) in list(self._rows.items()):
+            if value is not None and (expires_at is None or expires_at >= now):
+                counts[namespace] = counts.get(namespace, 0) + 1
+        return counts
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [k for k, (_, _, expires_at) in self._rows.items() if expires_at is not None and expires_at < now]
+            for row_key in expired:
+                del self._rows[row_key]
+            return len(expired)
+
+
+class DatabaseBackend:
+    """Workflow state in the workflow_state table, shared by every process on the same database."""
+
+    blocking = frozenset({'get', 'items', 'cas', 'clear', 'sweep'})
+
+    get = staticmethod(database.get_workflow_state)
+    items = staticmethod(database.get_workflow_namespace)
+    cas = staticmethod(database.cas_workflow_state)
+    clear = staticmethod(database.clear_workflow_state)
+    sweep = staticmethod(database.sweep_workflow_state)
+    counts = staticmethod(database.count_workflow_state)
+
+
+class CachedBackend:
+    """DatabaseBackend with a write-through copy of the table in this process.
+
+    Reads (two per live-location update) are answered from memory; put/pop/compare-and-set
+    writes go to the table first and then to the copy, so the state still survives restarts.
+    Only one process may write the state: a compare-and-set the table refuses means someone
+    else did, and reloads the copy before update() retries.
+    """
+
+    blocking = frozenset({'cas', 'clear', 'sweep', 'load'})
+
+    def __init__(self):
+        self.memory = MemoryBackend()
+        self.get = self.memory.get
+        self.items = self.memory.items
+        self.counts = self.memory.counts
+
+    def load(self):
+        rows = database.get_workflow_rows()
+        self.memory.replace(rows)
+        return len(rows)
+
+    def cas(self, namespace, key, expected_version, value, expires_at):
+        if database.cas_workflow_state(namespace, key, expected_version, value, expires_at):
+            self.memory.store(namespace, key, value, expected_version + 1, expires_at)
+            return True
+        # Another process wrote the table: take its view, and update() retries against it
+        self.load()
+        return False
+
+    def clear(self, namespaces):
+        database.clear_workflow_state(namespaces)
+        self.memory.clear(namespaces)
+
+    def sweep(self):
+        self.memory.sweep()
+        return database.sweep_workflow_state()
+
+
+class WorkflowStore:
+    """Namespaced order workflow state with compare-and-set, e.g. ``await workflow.get('admin_orders', order_id)``.
+
+    Values are anything JSON can hold (dict keys come back as strings). Every write bumps the
+    entry's version; put()/pop() overwrite whatever is there, while add() and update() only
+    write if nobody else changed the entry since it was read, so two workers handling clicks
+    for the same order cannot overwrite each other's changes.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def _call(self, method, *args):
+        fn = getattr(self.backend, method)
+        if method in self.backend.blocking:
+            return await db.run(fn, *args)
+        return fn(*args)
+
+    async def load(self):
+        """Fills a cached backend from the table (startup). Returns the rows read, or None for other backends."""
+        if hasattr(self.backend, 'load'):
+            return await self._call('load')
+        return None
+
+    @staticmethod
+    def _expires(namespace):
+        if namespace not in NAMESPACES:
+            raise KeyError(f"Unknown workflow namespace '{namespace}'")
+        return time.time() + NAMESPACES[namespace][0]
+
+    async def get_versioned(self, namespace, key):
+        """(value, version); value is None if missing. Pass the version to cas()."""
+        raw, version = await self._call('get', namespace, key)
+        return (json.loads(raw) if raw is not None else None), version
+
+    async def get(self, namespace, key, default=None):
+        value, _ = await self.get_versioned(namespace, key)
+        return default if value is None else value
+
+    async def items(self, namespace):
+        """{key: value} of every live entry in a namespace."""
+        rows = await self._call('items', namespace)
+        return {_decode_key(key): json.loads(raw) for key, raw in rows.items()}
+
+    async def cas(self, namespace, key, expected_version, value):
+        """Writes value (None deletes) if the entry is still at expected_version. Returns True on success."""
+        if value is None:
+            raw, expires_at = None, time.time() + WORKFLOW_TOMBSTONE_TTL
+        else:
+            raw, expires_at = json.dumps(value), self._expires(namespace)
+        return await self._call('cas', namespace, key, expected_version, raw, expires_at)
+
+    async def add(self, namespace, key, value):
+        """Stores value only if the key has no live entry. Returns True if this call stored it."""
+        current, version = await self.get_versioned(namespace, key)
+        return current is None and await self.cas(namespace, key, version, value)
+
+    async def update(self, namespace, key, fn):
+        """Read-modify-write: stores fn(current value or None) and returns it; fn returning None deletes the entry."""
+        for _ in range(WORKFLOW_CAS_RETRIES):
+            current, version = await self.get_versioned(namespace, key)
+            value = fn(current)
+            if value is None and current is None:
+                return None
+            if await self.cas(namespace, key, version, value):
+                return value
+        raise ConflictError(f"{namespace}/{key} kept changing under update()")
+
+    async def put(self, namespace, key, value):
+        await self.update(namespace, key, lambda _: value)
+
+    async def pop(self, namespace, key, default=None):
+        """Deletes an entry and returns the value it had."""
+        removed = []
+
+        def take(current):
+            removed[:] = [current]
+            return None
+
+        await self.update(namespace, key, take)
+        return removed[0] if removed and removed[0] is not None else default
+
+    async def pop_where(self, namespace, predicate):
+        """Deletes every entry whose value matches predicate. Returns the keys removed."""
+        removed = []
+        for key, value in (await self.items(namespace)).items():
+            if predicate(value) and await self.pop(namespace, key) is not None:
+                removed.append(key)
+        return removed
+
+    async def forget_order(self, order_id):
+        """Drops all workflow state for a finished or cancelled order. Returns how many entries went."""
+        removed = 0
+        for namespace, (_, scope) in NAMESPACES.items():
+            if scope == 'order':
+                removed += await self.pop(namespace, order_id) is not None
+        for namespace in ('tracking_relays', 'admin_live'):
+            removed += len(await self.pop_where(namespace, lambda v: isinstance(v, dict) and v.get('order_id') == order_id))
+        return removed
+
+    async def order_ids(self):
+        """Every order id that still has workflow state."""
+        ids = set()
+        for namespace, (_, scope) in NAMESPACES.items():
+            entries = await self.items(namespace)
+            if scope == 'order':
+                ids.update(entries)
+            else:
+                ids.update(v['order_id'] for v in entries.values() if isinstance(v, dict) and v.get('order_id'))
+        return ids
+
+    async def clear(self, namespaces=None):
+        await self._call('clear', list(namespaces or NAMESPACES))
+
+    async def sweep(self):
+        """Removes expired entries and old tombstones. Returns how many went."""
+        return await self._call('sweep')
+
+    def counts(self):
+        """{namespace: live entries}. Blocking, for callers outside the event loop (metrics)."""
+        return self.backend.counts()
+
+    async def import_bot_data(self, bot_data):
+        """Moves workflow state from bot_data (single-worker releases) into the store. Returns entries moved."""
+        moved = 0
+        for namespace in NAMESPACES:
+            entries = bot_data.pop(namespace, None) or {}
+            for key, value in entries.items():
+                moved += await self.add(namespace, key, value)
+        # Pending orders and payment-proof waits used to be ephemeral namespaces
+        for namespace in ('pending_order', 'waiting_payment_proof'):
+            for key, (_, value) in (bot_data.pop('ephemeral:' + namespace, None) or {}).items():
+                moved += await self.add(namespace, key, value)
+        return moved
+
+
+def _backend(name):
+    if name == 'auto':
+        name = 'cached' if db.max_workers == 1 else 'database'
+    return {'memory': MemoryBackend, 'cached': CachedBackend}.get(name, DatabaseBackend)()
+
+
+workflow = WorkflowStore(_backend(WORKFLOW_BACKEND))